@@ -0,0 +1,190 @@
+# analysis_cache.py
+"""
+Content-addressed cache for clause analyses.
+
+Entries are keyed by a hash of the model name, the prompt version and the
+normalized change payload, so re-analyzing an unchanged paragraph returns the
+stored ClauseAnalysisResponse without calling the LLM. A bounded in-memory LRU
+sits in front of a persistent SQLite tier; both tiers expire entries after a TTL.
+Disk writes are made by a writer thread (see sqlite_store.py).
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from sqlite_store import StoreWriter, connect
+
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "1024"))
+ANALYSIS_CACHE_TTL = float(os.getenv("ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+ANALYSIS_CACHE_DISK_SIZE = int(os.getenv("ANALYSIS_CACHE_DISK_SIZE", "100000"))
+# Set ANALYSIS_CACHE_DB to an empty string to disable the on-disk tier
+ANALYSIS_CACHE_DB = os.getenv(
+    "ANALYSIS_CACHE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "analysis_cache.sqlite3")
+)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _normalize_text(value: Any) -> Any:
+    if isinstance(value, str):
+        return _WHITESPACE.sub(" ", value).strip()
+    return value
+
+
+def normalize_change_json(change_json: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Reduces a change payload to the parts that influence the analysis.
+    Whitespace is collapsed and the client-side paragraph_id is dropped.
+    """
+    return {
+        "original_text": _normalize_text(change_json.get("original_text")),
+        "modified_text": _normalize_text(change_json.get("modified_text")),
+        "changes": [
+            {"type": _normalize_text(c.get("type")), "description": _normalize_text(c.get("description"))}
+            for c in change_json.get("changes", [])
+        ],
+    }
+
+
+def make_cache_key(model: str, prompt_version: str, change_json: Dict[str, Any]) -> str:
+    payload = json.dumps(
+        {"model": model, "prompt_version": prompt_version, "change": normalize_change_json(change_json)},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    """
+    Two-tier cache: a bounded LRU dict in memory and an optional SQLite table on disk.
+    Values are JSON-serializable dicts.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 7 * 24 * 3600,
+                 db_path: Optional[str] = None, max_disk_entries: int = 100000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writer: Optional[StoreWriter] = None
+        self._disk_writes = 0
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if db_path:
+            self._db = connect(db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analysis_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS analysis_cache_created ON analysis_cache (created_at)")
+            self._db.commit()
+            self._writer = StoreWriter("analysis_cache", db_path, self._db, self._lock)
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl > 0 and now - created_at > self.ttl
+
+    def _remember(self, key: str, value: Dict[str, Any], created_at: float) -> None:
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM analysis_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    if not self._expired(row[1], now):
+                        value = json.loads(row[0])
+                        self._remember(key, value, row[1])
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return value
+                    self._writer.submit(lambda db: db.execute("DELETE FROM analysis_cache WHERE key = ?", (key,)))
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._db is not None:
+                row = (key, json.dumps(value, ensure_ascii=False), now)
+                self._writer.submit(lambda db: db.execute(
+                    "INSERT OR REPLACE INTO analysis_cache (key, value, created_at) VALUES (?, ?, ?)", row
+                ))
+                self._disk_writes += 1
+                # Trim the disk tier every so often instead of on every write
+                if self._disk_writes % 256 == 0:
+                    self._writer.submit(lambda db: self._trim_disk(db, now))
+
+    def _trim_disk(self, db: sqlite3.Connection, now: float) -> None:
+        if self.ttl > 0:
+            db.execute("DELETE FROM analysis_cache WHERE created_at < ?", (now - self.ttl,))
+        db.execute(
+            "DELETE FROM analysis_cache WHERE key IN ("
+            "SELECT key FROM analysis_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+
+    def flush(self) -> None:
+        """
+        Waits for the queued disk writes; called on shutdown.
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        if self._writer is not None:
+            self._writer.submit(lambda db: db.execute("DELETE FROM analysis_cache"))
+            self._writer.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            disk_entries = None
+            if self._db is not None:
+                disk_entries = self._db.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+            }
+
+
+analysis_cache = AnalysisCache(
+    max_entries=ANALYSIS_CACHE_SIZE,
+    ttl=ANALYSIS_CACHE_TTL,
+    db_path=ANALYSIS_CACHE_DB or None,
+    max_disk_entries=ANALYSIS_CACHE_DISK_SIZE,
+)
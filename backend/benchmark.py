@@ -0,0 +1,221 @@
+# benchmark.py
+"""
+Load benchmark for the analysis endpoints.
+
+Drives /analyze_changes_batch, /analyze_clause_changes and /analyze-clause of a
+running backend at one or more concurrency levels and reports throughput,
+p50/p95/p99 latency and error rate per endpoint and level. Run it against a
+backend that talks to mock_gemini.py to measure the service without spending
+quota:
+
+    python benchmark.py --url http://127.0.0.1:8000 --concurrency 1,8,32 --requests 200
+
+Every clause is distinct so the analysis caches do not short-circuit the run.
+Payloads are generated from a seed that is recorded with the run; passing the
+same --seed again replays them exactly (against warm caches, unless the
+backend was restarted with in-memory caches). Each
+run is appended as one JSON line to the output file; with --baseline the run
+is compared with an earlier one and the exit code is 1 on a regression.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+ENDPOINTS = ["/analyze_changes_batch", "/analyze_clause_changes", "/analyze-clause"]
+
+_VOCABULARY = (
+    "recipient discloser confidential information party agreement obligation term disclosure third "
+    "purpose affiliate employee advisor written consent notice period breach remedy injunctive relief "
+    "return destroy copies records obligation survive termination governing law jurisdiction court "
+    "exclusive non-exclusive license trade secret know-how documentation reasonable care protect "
+    "unauthorized access publicly available independently developed lawfully obtained required by law"
+).split()
+
+
+def _clause(rng: random.Random, words: int = 40) -> str:
+    return "The " + " ".join(rng.choice(_VOCABULARY) for _ in range(words)) + "."
+
+
+def _changelog(rng: random.Random) -> List[Dict[str, str]]:
+    return [
+        {"type": "Deleted", "text": " ".join(rng.choice(_VOCABULARY) for _ in range(3)), "author": "Benchmark"},
+        {"type": "Added", "text": " ".join(rng.choice(_VOCABULARY) for _ in range(4)), "author": "Benchmark"},
+    ]
+
+
+def make_payload(endpoint: str, rng: random.Random, batch_size: int) -> Dict[str, Any]:
+    if endpoint == "/analyze-clause":
+        return {"text": _clause(rng)}
+    if endpoint == "/analyze_clause_changes":
+        return {"paragraph": _clause(rng), "changelog": _changelog(rng)}
+    return {"items": [
+        {"paragraphIndex": i, "paragraph": _clause(rng), "changelog": _changelog(rng)} for i in range(batch_size)
+    ]}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = q / 100 * (len(ordered) - 1)
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def _batch_failures(response: httpx.Response) -> int:
+    return sum(1 for entry in response.json().get("results", {}).values() if "error" in entry)
+
+
+async def run_level(client: httpx.AsyncClient, url: str, endpoint: str, concurrency: int, requests: int,
+                    batch_size: int, seed: int) -> Dict[str, Any]:
+    rng = random.Random(f"{seed}:{endpoint}:{concurrency}")
+    payloads = [make_payload(endpoint, rng, batch_size) for _ in range(requests)]
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    failed_items = 0
+    next_payload = iter(payloads)
+
+    async def worker() -> None:
+        nonlocal failed_items
+        for payload in next_payload:
+            started = time.perf_counter()
+            error = None
+            try:
+                response = await client.post(url + endpoint, json=payload)
+                if response.status_code != 200:
+                    error = f"HTTP {response.status_code}"
+                elif endpoint == "/analyze_changes_batch":
+                    failed_items += _batch_failures(response)
+            except httpx.HTTPError as e:
+                error = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    items = requests * (batch_size if endpoint == "/analyze_changes_batch" else 1)
+    result = {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": requests,
+        "elapsedSeconds": round(elapsed, 3),
+        "throughputRps": round(requests / elapsed, 3),
+        "p50Ms": _ms(percentile(latencies, 50)),
+        "p95Ms": _ms(percentile(latencies, 95)),
+        "p99Ms": _ms(percentile(latencies, 99)),
+        "errorRate": round(sum(errors.values()) / requests, 4),
+        "errors": errors,
+    }
+    if endpoint == "/analyze_changes_batch":
+        result["paragraphsPerSecond"] = round(items / elapsed, 3)
+        result["paragraphErrorRate"] = round(failed_items / items, 4)
+    return result
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_regressions(run: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Compares matching (endpoint, concurrency) results; p95 latency or throughput worse than the
+    baseline by more than `tolerance` (a fraction), or a higher error rate, is a regression.
+    """
+    previous = {(r["endpoint"], r["concurrency"]): r for r in baseline["results"]}
+    checks = [
+        ("p95Ms", lambda new, old: new > old * (1 + tolerance)),
+        ("throughputRps", lambda new, old: new < old * (1 - tolerance)),
+        ("errorRate", lambda new, old: new > old + tolerance / 10),
+    ]
+    regressions = []
+    for result in run["results"]:
+        old = previous.get((result["endpoint"], result["concurrency"]))
+        if old is None:
+            continue
+        for metric, worse in checks:
+            if result[metric] is not None and old[metric] is not None and worse(result[metric], old[metric]):
+                regressions.append(
+                    f"{result['endpoint']} @ {result['concurrency']}: {metric} {old[metric]} -> {result[metric]}"
+                )
+    return regressions
+
+
+def load_baseline(path: str) -> Dict[str, Any]:
+    """
+    Reads the last run of a benchmark output file.
+    """
+    with open(path, encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1])
+
+
+async def main(args: argparse.Namespace) -> int:
+    levels = [int(level) for level in args.concurrency.split(",")]
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    endpoints = args.endpoints.split(",") if args.endpoints else ENDPOINTS
+    run: Dict[str, Any] = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "label": args.label,
+        "python": platform.python_version(),
+        "settings": {
+            "url": args.url, "requests": args.requests, "batchSize": args.batch_size, "seed": seed,
+        },
+        "results": [],
+    }
+    limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for endpoint in endpoints:
+            for level in levels:
+                result = await run_level(client, args.url, endpoint, level, args.requests, args.batch_size, seed)
+                run["results"].append(result)
+                print(
+                    f"{endpoint:<24} c={level:<4} {result['throughputRps']:>8} req/s  "
+                    f"p50={result['p50Ms']}ms p95={result['p95Ms']}ms p99={result['p99Ms']}ms  "
+                    f"errors={result['errorRate']:.2%}"
+                )
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run) + "\n")
+    if args.baseline:
+        regressions = find_regressions(run, load_baseline(args.baseline), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the analysis endpoints.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--endpoints", default="", help="Comma-separated subset of " + ",".join(ENDPOINTS))
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per endpoint and level")
+    parser.add_argument("--batch-size", type=int, default=10, help="Paragraphs per batch request")
+    parser.add_argument("--seed", type=int, default=None, help="Replays the payloads of an earlier run")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--label", default="", help="Free-form description of the run")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="Runs are appended as JSON lines")
+    parser.add_argument("--baseline", default="", help="Output file whose last run is the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative slowdown")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,176 @@
+# benchmark_serialization.py
+"""
+Serialization benchmark for batch responses.
+
+Measures, in process, what it costs to turn the analyses of one batch into the
+HTTP response, per paragraph:
+
+- items: building each result entry, the old way (an AnalyzeChangesRequest
+  re-validated per item and `.dict()` on the result) versus the current one
+  (the change json built from the already validated item, one `model_dump()`)
+- response: the whole batch response through FastAPI, returned as a dict and
+  validated against the response_model, as a standard library JSONResponse, or
+  as FastJSONResponse (orjson when installed, no re-validation)
+
+    python benchmark_serialization.py --paragraphs 500 --repeats 20
+
+Results are printed and appended as one JSON line to the output file.
+"""
+import argparse
+import asyncio
+import json
+import time
+import warnings
+from datetime import datetime, timezone
+from statistics import median
+from typing import Any, Callable, Dict, List
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+from clause_analysis import ClauseAnalysisResponse
+from main import (
+    AnalyzeChangesBatchItem, AnalyzeChangesBatchResponse, AnalyzeChangesRequest, build_change_json,
+)
+from serialization import FastJSONResponse, orjson
+
+_TEXT = (
+    "The Recipient shall keep the Confidential Information strictly confidential and shall not disclose it "
+    "to any third party without the prior written consent of the Discloser, except to its employees and "
+    "professional advisers who need to know it for the Purpose and are bound by equivalent obligations. "
+)
+
+
+def make_analysis(i: int) -> ClauseAnalysisResponse:
+    return ClauseAnalysisResponse(
+        clauseIdentifier=f"Clause {i}",
+        originalClauseText=_TEXT * 2,
+        analysis={
+            "clauseCategory": "Confidentiality Obligations",
+            "summary": _TEXT,
+            "risksDisclosingParty": _TEXT,
+            "risksReceivingParty": _TEXT,
+            "improvementsDisclosingParty": _TEXT,
+            "improvementsReceivingParty": _TEXT,
+            "suggestedWording": _TEXT * 2,
+            "comments_on_changes": _TEXT,
+        },
+    )
+
+
+def make_items(paragraphs: int) -> List[AnalyzeChangesBatchItem]:
+    return [
+        AnalyzeChangesBatchItem(
+            paragraphIndex=i,
+            paragraph=_TEXT * 2,
+            changelog=[{"type": "Added", "text": "strictly", "author": "Benchmark"},
+                       {"type": "Deleted", "text": "reasonably", "author": "Benchmark"}],
+        )
+        for i in range(paragraphs)
+    ]
+
+
+def build_entries_old(items: List[AnalyzeChangesBatchItem], analyses: List[ClauseAnalysisResponse]) -> List[dict]:
+    entries = []
+    for item, analysis in zip(items, analyses):
+        request = AnalyzeChangesRequest(paragraph=item.paragraph, changelog=item.changelog)
+        build_change_json(request.paragraph, request.changelog, request.paragraph_id)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            entry = analysis.dict()
+        entry["paragraphIndex"] = item.paragraphIndex
+        entries.append(entry)
+    return entries
+
+
+def build_entries_new(items: List[AnalyzeChangesBatchItem], analyses: List[ClauseAnalysisResponse]) -> List[dict]:
+    entries = []
+    for item, analysis in zip(items, analyses):
+        build_change_json(item.paragraph, item.changelog)
+        entries.append({**analysis.model_dump(), "paragraphIndex": item.paragraphIndex})
+    return entries
+
+
+def make_app(content: Dict[str, Any]) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/response_model", response_model=AnalyzeChangesBatchResponse)
+    async def validated():
+        return content
+
+    @app.get("/json")
+    async def standard():
+        return JSONResponse(content)
+
+    @app.get("/fast", response_model=AnalyzeChangesBatchResponse)
+    async def fast():
+        return FastJSONResponse(content)
+
+    return app
+
+
+def time_per_run(run: Callable[[], Any], repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+    return median(timings)
+
+
+async def time_requests(client: httpx.AsyncClient, path: str, repeats: int) -> float:
+    # One request to warm up, then the median of the timed ones
+    (await client.get(path)).raise_for_status()
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        (await client.get(path)).raise_for_status()
+        timings.append(time.perf_counter() - started)
+    return median(timings)
+
+
+async def main(args: argparse.Namespace) -> None:
+    items = make_items(args.paragraphs)
+    analyses = [make_analysis(i) for i in range(args.paragraphs)]
+    results: Dict[str, Dict[str, float]] = {}
+    for name, build in (("items_old", build_entries_old), ("items_new", build_entries_new)):
+        seconds = time_per_run(lambda: build(items, analyses), args.repeats)
+        results[name] = {"ms": round(seconds * 1000, 3), "us_per_item": round(seconds / args.paragraphs * 1e6, 2)}
+
+    entries = build_entries_new(items, analyses)
+    # A few failed paragraphs, as in real batches
+    for entry in entries[::50]:
+        entries[entry["paragraphIndex"]] = {"paragraphIndex": entry["paragraphIndex"], "error": "502: Error in clause analysis"}
+    content = {"results": {entry["paragraphIndex"]: entry for entry in entries}}
+    transport = httpx.ASGITransport(app=make_app(content))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        bodies = {path: (await client.get(path)).json() for path in ("/response_model", "/json", "/fast")}
+        # The response_model only adds the unset optional fields as nulls
+        assert bodies["/json"] == bodies["/fast"], "serializations differ"
+        assert bodies["/response_model"]["results"].keys() == bodies["/fast"]["results"].keys()
+        for path in ("/response_model", "/json", "/fast"):
+            seconds = await time_requests(client, path, args.repeats)
+            results["response" + path.replace("/", "_")] = {
+                "ms": round(seconds * 1000, 3), "us_per_item": round(seconds / args.paragraphs * 1e6, 2)
+            }
+
+    run = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "paragraphs": args.paragraphs,
+        "repeats": args.repeats,
+        "orjson": orjson is not None,
+        "results": results,
+    }
+    for name, result in results.items():
+        print(f"{name:<24} {result['ms']:>9.3f} ms  {result['us_per_item']:>8.2f} us/item")
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batch response serialization.")
+    parser.add_argument("--paragraphs", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--output", default="benchmark_serialization.jsonl", help="Runs are appended as JSON lines")
+    asyncio.run(main(parser.parse_args()))
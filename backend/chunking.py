@@ -0,0 +1,172 @@
+# chunking.py
+"""
+Map-reduce analysis of oversized clauses.
+
+Some "paragraphs" are whole schedules thousands of words long. Those are split
+at sub-clause numbering (1.1., 1.2., ...) into chunks within a token budget,
+every tracked change is mapped to the chunks that contain its text, and only
+the changed chunks are analyzed (in parallel), each with a short outline of
+the rest of the clause as context. The chunk analyses are then reduced into
+one ClauseAnalysisResponse for the whole clause.
+"""
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from few_shot import estimate_tokens
+
+CHUNKING_ENABLED = os.getenv("CHUNKING_ENABLED", "1") == "1"
+# Clauses with more estimated tokens than this are analyzed in chunks
+CHUNK_THRESHOLD_TOKENS = int(os.getenv("CHUNK_THRESHOLD_TOKENS", "1500"))
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", "600"))
+# Words of each unchanged chunk shown in the outline
+OUTLINE_WORDS = 12
+
+# Sub-clause numbers such as "1.1", "2.3." or "4.1.2." at the start of the text or after a sentence/line end
+_NUMBERING = re.compile(r"(?:^|(?<=[.;:\n\v])|(?<=[.;:\n\v]\s))\s*(\d{1,3}(?:\.\d{1,3})+\.?)(?=\s)")
+_SENTENCE_END = re.compile(r"(?<=[.;:])\s+(?=[A-Z(\"“])")
+
+ANALYSIS_FIELDS = [
+    "summary",
+    "risksDisclosingParty",
+    "risksReceivingParty",
+    "improvementsDisclosingParty",
+    "improvementsReceivingParty",
+    "comments_on_changes",
+]
+
+
+@dataclass
+class Chunk:
+    label: str
+    text: str
+    changes: List[Dict[str, Any]] = field(default_factory=list)
+
+
+def _segments(text: str) -> List[str]:
+    starts = sorted({match.start(1) for match in _NUMBERING.finditer(text)} | {0})
+    return [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)]) if text[start:end].strip()]
+
+
+def _split_oversized(segment: str, budget: int) -> List[str]:
+    if estimate_tokens(segment) <= budget:
+        return [segment]
+    return [part for part in _SENTENCE_END.split(segment) if part.strip()]
+
+
+def split_clause(text: str, budget: int = CHUNK_TOKEN_BUDGET) -> List[str]:
+    """
+    Splits a clause at sub-clause numbering (falling back to sentence ends for oversized
+    sub-clauses) and greedily merges consecutive pieces up to the token budget.
+    """
+    pieces = [piece for segment in _segments(text) for piece in _split_oversized(segment, budget)]
+    chunks: List[str] = []
+    current = ""
+    for piece in pieces:
+        if current and estimate_tokens(current + piece) > budget:
+            chunks.append(current)
+            current = ""
+        current = f"{current} {piece}" if current and not current[-1].isspace() else current + piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _label(text: str, position: int) -> str:
+    match = _NUMBERING.match(text)
+    return match.group(1) if match else f"Part {position + 1}"
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def make_chunks(change_json: Dict[str, Any]) -> Optional[List[Chunk]]:
+    """
+    Returns the chunks of an oversized clause with their tracked changes, or None if the clause
+    should be analyzed whole. A change goes to every chunk containing its text as whole words
+    (so a deleted "not" is not located in "notice"); changes that cannot be located go to every
+    changed chunk (or the first chunk if none is changed).
+    """
+    text = str(change_json.get("original_text") or "")
+    if not CHUNKING_ENABLED or estimate_tokens(text) <= CHUNK_THRESHOLD_TOKENS:
+        return None
+    texts = split_clause(text)
+    if len(texts) < 2:
+        return None
+    chunks = [Chunk(_label(chunk_text.lstrip(), i), chunk_text) for i, chunk_text in enumerate(texts)]
+    normalized = [_normalize(chunk.text) for chunk in chunks]
+    unmapped = []
+    for change in change_json.get("changes", []):
+        needle = _normalize(str(change.get("description") or ""))
+        pattern = re.compile(rf"(?<!\w){re.escape(needle)}(?!\w)") if needle else None
+        owners = [i for i, haystack in enumerate(normalized) if pattern is not None and pattern.search(haystack)]
+        if not owners:
+            unmapped.append(change)
+        for i in owners:
+            chunks[i].changes.append(change)
+    if unmapped:
+        changed = [chunk for chunk in chunks if chunk.changes] or chunks[:1]
+        for chunk in changed:
+            chunk.changes.extend(unmapped)
+    return chunks
+
+
+def _outline(chunks: List[Chunk], current: Chunk) -> str:
+    lines = []
+    for chunk in chunks:
+        if chunk is current:
+            lines.append(f"{chunk.label} [this part]")
+        else:
+            words = chunk.text.split()
+            lines.append(" ".join(words[:OUTLINE_WORDS]) + (" …" if len(words) > OUTLINE_WORDS else ""))
+    return "\n".join(lines)
+
+
+def chunk_change_json(change_json: Dict[str, Any], chunks: List[Chunk], chunk: Chunk) -> Dict[str, Any]:
+    """
+    The change json sent for one changed chunk: the chunk in full plus an abbreviated outline
+    of the whole clause.
+    """
+    return {
+        "paragraph_id": change_json.get("paragraph_id"),
+        "original_text": chunk.text,
+        "modified_text": chunk.text,
+        "changes": [{"type": c.get("type"), "description": c.get("description")} for c in chunk.changes],
+        "clause_context": "This is one part of a longer clause. Outline of the whole clause:\n" + _outline(chunks, chunk),
+    }
+
+
+def changed_chunks(chunks: List[Chunk]) -> List[Chunk]:
+    """
+    The chunks to analyze: those with tracked changes, or all of them if nothing was changed.
+    """
+    return [chunk for chunk in chunks if chunk.changes] or chunks
+
+
+def reduce_analyses(change_json: Dict[str, Any], chunks: List[Chunk], analyzed: List[Chunk],
+                    analyses: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Combines the analyses of the analyzed chunks into one ClauseAnalysisResponse dict. Text fields
+    are listed per sub-clause, and the suggested wording is the whole clause, one chunk per line,
+    with each analyzed chunk replaced by its suggestion.
+    """
+    def per_chunk(name: str) -> str:
+        values = [(chunk.label, analysis["analysis"][name]) for chunk, analysis in zip(analyzed, analyses)]
+        if len(values) == 1:
+            return values[0][1]
+        return "\n\n".join(f"{label}: {value}" for label, value in values)
+
+    suggestions = {id(chunk): analysis["analysis"]["suggestedWording"] for chunk, analysis in zip(analyzed, analyses)}
+    categories = list(dict.fromkeys(analysis["analysis"]["clauseCategory"] for analysis in analyses))
+    identifiers = list(dict.fromkeys(analysis["clauseIdentifier"] for analysis in analyses))
+    return {
+        "clauseIdentifier": "; ".join(identifiers),
+        "originalClauseText": str(change_json.get("original_text") or ""),
+        "analysis": {
+            "clauseCategory": "; ".join(categories),
+            **{name: per_chunk(name) for name in ANALYSIS_FIELDS},
+            "suggestedWording": "\n".join(suggestions.get(id(chunk), chunk.text).strip() for chunk in chunks),
+        },
+    }
@@ -3,15 +3,33 @@
 This module provides a function to analyze a clause change summary (from /analyze_changes)
 and return a structured analysis using an LLM API (prompt placeholder included).
 """
-import os
-import requests
-import re
+import asyncio
+import httpx
 import json as pyjson
-from typing import Any, Dict, Optional
-from pydantic import BaseModel
-
-GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-GOOGLE_API_URL_BASE = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-lite:generateContent"
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from pydantic import BaseModel, ValidationError
+
+from analysis_cache import analysis_cache, make_cache_key
+from chunking import Chunk, changed_chunks, chunk_change_json, make_chunks, reduce_analyses
+from context_cache import context_cache
+from few_shot import ExampleLibrary, change_query_text
+from gemini_client import generate_content
+from hedging import hedger
+from deadlines import DeadlineExceeded
+from metrics import OUTPUT_REPAIRS, PACK_FALLBACKS, PARSE_FAILURES, STAGE_SECONDS
+from near_duplicate import NEAR_DUP_ENABLED, near_duplicate_index
+from packing import packed_payload, parse_packed_array
+from profiling import traced
+from routing import TIER_SECONDS, Tier, config_tag as routing_config_tag, escalation, route
+from single_flight import SingleFlight
+from structured_output import (
+    GEMINI_STRUCTURED_OUTPUT, REPAIR_PROMPT_ENABLED, StructuredOutputError, array_schema, complete_fields,
+    gemini_schema, parse_json, repair_prompt,
+)
+from triage import triage_analysis
+
+# Bump whenever the prompt below changes so cached analyses are not reused
+PROMPT_VERSION = "nda-fewshot-v2"
 
 prompt = """
 **Objective:**
@@ -507,7 +525,7 @@ Please ensure that your final output for any analysis task based on this prompt
 
 {
   "clauseIdentifier": "Clause 1 - Confidential Information Definition",
-  "originalClauseText": "1. Confidential Information. The confidential information (“Confidential Information”) includes any information that is only known by the Disclosing Party, and not known by the general public at the time it is disclosed, whether tangible or intangible, and through whatever means it is disclosed.\nConfidential Information does not include information that:\n1.1.   The Receiving Party lawfully gained before the Disclosing Party actually disclosed it;\n1.2.   Becomes available to the general public by no fault of the Receiving Party.",
+  "originalClauseText": "1. Confidential Information. The confidential information (“Confidential Information”) includes any information that is only known by the Disclosing Party [...]",
   "analysis": {
     "clauseCategory": "Confidential Information Definition",
     "summary": "Defines Confidential Information unspecified; excludes info known previously or becoming public.",
@@ -515,8 +533,8 @@ Please ensure that your final output for any analysis task based on this prompt
     "risksReceivingParty": "Potentially, all possible information of the disclosing party falls under the definition",
     "improvementsDisclosingParty": "Clarify: 'Receiving Party bears the burden of proof to demonstrate that information falls within exceptions.'",
     "improvementsReceivingParty": "Clarify: list examples for confidential information, even if not exclusively",
-    "suggestedWording": "1.   Confidential Information. The confidential information (“Confidential Information”) includes any information that is only known by the Disclosing Party, and not known by the general public at the time it is disclosed, whether tangible or intangible, and through whatever means it is disclosed.\n1.1.   Confidential Information includes in particular, but is not limited to, information that:\n1.1.1.   technical data;\n1.1.2.   trade secrets;\n1.1.3.   research;\n1.1.4.   financial information;\n1.1.5.   other business or technical information or industry knowledge disclosed by the Disclosing Party.\n1.2.   Confidential Information does not include information that:\n1.2.1.   The Receiving Party lawfully gained before the Disclosing Party actually disclosed it;\n1.2.2.   Becomes available to the general public by no fault of the Receiving Party.\nThe Receiving Party shall bear the burden of proof to demonstrate that the information falls within the exceptions.",
-"comments_on_changes": "[Add here information if changes need to specifically checked]"
+    "suggestedWording": "[The complete revised clause text, as in the examples above]",
+    "comments_on_changes": "[Add here information if changes need to specifically checked]"
   }
 }
 
@@ -525,6 +543,10 @@ Now please analyze the following clause on your own:
 """
 
 
+# Indexed few-shot examples, so each request only carries the most relevant ones
+example_library = ExampleLibrary.from_prompt(prompt)
+
+
 class ClauseAnalysis(BaseModel):
     clauseCategory: str
     summary: str
@@ -539,49 +561,284 @@ class ClauseAnalysisResponse(BaseModel):
     clauseIdentifier: str
     originalClauseText: str
     analysis: ClauseAnalysis
+    # Set when the analysis was produced by local triage instead of the LLM
+    triageRule: Optional[str] = None
+    # Set when the analysis was reused from a near-identical, previously analyzed clause
+    reusedSimilarity: Optional[float] = None
+    # Model tier that produced the analysis (see routing.py)
+    modelTier: Optional[str] = None
+
+# responseSchema for a single analysis and for packed analyses (see structured_output.py)
+ANALYSIS_SCHEMA = gemini_schema(ClauseAnalysisResponse)
+PACKED_SCHEMA = array_schema(ANALYSIS_SCHEMA, paragraphIndex={"type": "INTEGER"})
+
+# Coalesces concurrent analyses of the same normalized clause and changelog
+analysis_flights = SingleFlight()
+
+def _candidate_texts(data: Dict[str, Any]):
+    for candidate in data.get("candidates", []):
+        for part in candidate.get("content", {}).get("parts", []):
+            yield part.get("text", "")
+
+async def _generate_after_prefix(query: str, payload: str, response_schema: Optional[Dict[str, Any]],
+                                 model: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Sends the clause payload after the prompt prefix: the full static prompt from the provider's
+    context cache when available (see context_cache.py), else the few-shot prompt selected for the query.
+    """
+    def build_prompt() -> str:
+        with STAGE_SECONDS.time("prompt_assembly"):
+            return example_library.build_prompt(query) + payload
+
+    return await context_cache.generate(prompt, payload, build_prompt, model=model, response_schema=response_schema)
 
 # Utility function to call Google Generative AI API
-def call_google_gemini_api(prompt: str) -> Optional[Dict[str, Any]]:
-    if not GOOGLE_API_KEY:
-        raise Exception("Google API key not configured.")
-    payload = {"contents": [{"parts": [{"text": prompt}]}]}
-    headers = {"Content-Type": "application/json"}
-    params = {"key": GOOGLE_API_KEY}
+@traced("call_google_gemini_api")
+async def call_google_gemini_api(prompt: str, response_schema: Optional[Dict[str, Any]] = None,
+                                 prefix_query: Optional[str] = None, tier: Optional[Tier] = None,
+                                 accept: Optional[Callable[[Dict[str, Any]], bool]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Returns the first JSON object in the model's answer, repairing common syntax defects.
+    Raises StructuredOutputError (with the raw answer) if there is none.
+    With a prefix_query, `prompt` is only the clause payload and is sent after the analysis prompt.
+    With a tier, the call goes to that tier's model (see routing.py) instead of GEMINI_MODEL.
+    Slow calls may be hedged with a duplicate call (see hedging.py); the first answer that `accept`
+    accepts wins.
+    """
+    return await hedger.run(lambda: _request_json(prompt, response_schema, prefix_query, tier), accept)
+
+async def _request_json(prompt: str, response_schema: Optional[Dict[str, Any]],
+                        prefix_query: Optional[str], tier: Optional[Tier]) -> Dict[str, Any]:
+    model = tier.model if tier is not None else None
     try:
-        response = requests.post(GOOGLE_API_URL_BASE, json=payload, headers=headers, params=params, timeout=60)
-        response.raise_for_status()
-        data = response.json()
-        candidates = data.get("candidates", [])
-        for candidate in candidates:
-            parts = candidate.get("content", {}).get("parts", [])
-            for part in parts:
-                text = part.get("text", "")
-                match = re.search(r'{[\s\S]*}', text)
-                if match:
-                    json_str = match.group(0)
-                    try:
-                        return pyjson.loads(json_str)
-                    except Exception:
-                        continue
-        raise Exception("No valid JSON returned from Gemini API.")
-    except requests.RequestException as e:
+        with STAGE_SECONDS.time("upstream"), TIER_SECONDS.time(tier.name if tier is not None else "default"):
+            if prefix_query is not None:
+                data = await _generate_after_prefix(prefix_query, prompt, response_schema, model)
+            else:
+                data = await generate_content(prompt, response_schema=response_schema, model=model)
+    except httpx.HTTPError as e:
         raise Exception(f"Error communicating with Gemini API: {str(e)}")
+    texts = list(_candidate_texts(data))
+    with STAGE_SECONDS.time("json_extraction"):
+        for text in texts:
+            value = parse_json(text)
+            if isinstance(value, dict):
+                return value
+    PARSE_FAILURES.inc("no_json")
+    raise StructuredOutputError("No valid JSON returned from Gemini API.", "\n".join(texts))
+
+
+def analysis_namespace() -> str:
+    # Analyses come from the routed tier models (see routing.py), not GEMINI_MODEL
+    return f"{routing_config_tag()}:{PROMPT_VERSION}:{example_library.config_tag()}"
+
 
+def _analysis_cache_key(change_json: Dict[str, Any]) -> str:
+    return make_cache_key(routing_config_tag(), f"{PROMPT_VERSION}:{example_library.config_tag()}", change_json)
 
-def analyze_clause_change(change_json: Dict[str, Any]) -> ClauseAnalysisResponse:
-    
-    # Step 1: Compose the prompt for the clause analysis
-    final_prompt = prompt + str(change_json)
 
-    # Append the change json to the prompt
-    result = call_google_gemini_api(final_prompt)
-    if not result:
-        raise Exception("No valid response from Gemini API.")
-    return ClauseAnalysisResponse(**result)
+def _remember_analysis(change_json: Dict[str, Any], cache_key: str, response: ClauseAnalysisResponse) -> None:
+    analysis = response.model_dump()
+    analysis_cache.set(cache_key, analysis)
+    if NEAR_DUP_ENABLED:
+        near_duplicate_index.add(analysis_namespace(), change_json, analysis)
+
+
+def _local_analysis(change_json: Dict[str, Any], cache_key: str) -> Optional[ClauseAnalysisResponse]:
+    """
+    Answers without the LLM when possible: trivial edits are triaged locally, repeat
+    analyses of the same clause and changelog are served from the cache, and analyses
+    of near-identical clauses are reused.
+    """
+    triaged = triage_analysis(change_json)
+    if triaged is not None:
+        return ClauseAnalysisResponse(**triaged)
+    cached = analysis_cache.get(cache_key)
+    if cached is not None:
+        return ClauseAnalysisResponse(**cached)
+    if NEAR_DUP_ENABLED:
+        match = near_duplicate_index.lookup(analysis_namespace(), change_json)
+        if match is not None:
+            similarity, analysis = match
+            return ClauseAnalysisResponse(**{
+                **analysis,
+                "originalClauseText": str(change_json.get("original_text") or ""),
+                "reusedSimilarity": round(similarity, 3),
+            })
+    return None
+
+
+@traced("analyze_clause_change")
+async def analyze_clause_change(change_json: Dict[str, Any]) -> ClauseAnalysisResponse:
+    cache_key = _analysis_cache_key(change_json)
+    local = _local_analysis(change_json, cache_key)
+    if local is not None:
+        return local
+
+    # Identical analyses that are already in flight share one upstream call (or set of chunk calls)
+    chunks = make_chunks(change_json)
+    if chunks is not None:
+        return await analysis_flights.do(cache_key, lambda: _analyze_chunked(change_json, cache_key, chunks))
+    return await analysis_flights.do(cache_key, lambda: _analyze_clause_change_uncached(change_json, cache_key))
+
+async def _analyze_chunked(change_json: Dict[str, Any], cache_key: str, chunks: List[Chunk]) -> ClauseAnalysisResponse:
+    """
+    Analyzes the changed sub-clauses of an oversized clause in parallel and reduces them into
+    one analysis (see chunking.py). Each chunk is cached on its own.
+    """
+    analyzed = changed_chunks(chunks)
+    responses = await asyncio.gather(
+        *(analyze_clause_change(chunk_change_json(change_json, chunks, chunk)) for chunk in analyzed)
+    )
+    response = ClauseAnalysisResponse(
+        **reduce_analyses(change_json, chunks, analyzed, [r.model_dump() for r in responses])
+    )
+    _remember_analysis(change_json, cache_key, response)
+    return response
+
+async def _analyze_clause_change_uncached(change_json: Dict[str, Any], cache_key: str) -> ClauseAnalysisResponse:
+    tier = route([change_json])
+    while True:
+        # The change json is sent after the analysis prompt
+        try:
+            result = await call_google_gemini_api(
+                str(change_json), _response_schema(ANALYSIS_SCHEMA), prefix_query=change_query_text(change_json),
+                tier=tier, accept=_is_valid_analysis,
+            )
+            response = _validate_analysis(result, change_json)
+            break
+        except StructuredOutputError as e:
+            # An invalid answer from the fast tier is worth a full analysis by the strong tier
+            stronger = escalation(tier)
+            if stronger is None:
+                response = await _repair_analysis(e, change_json, tier)
+                break
+            tier = stronger
+    response.modelTier = tier.name
+    _remember_analysis(change_json, cache_key, response)
+    return response
+
+def _response_schema(schema: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    return schema if GEMINI_STRUCTURED_OUTPUT else None
+
+def _is_valid_analysis(result: Dict[str, Any]) -> bool:
+    try:
+        ClauseAnalysisResponse.model_validate(result)
+    except ValidationError:
+        return False
+    return True
 
-def analyze_clause_change_for_changes_response(change_json: Dict[str, Any]) -> ClauseAnalysisResponse:
+def _validate_analysis(result: Dict[str, Any], change_json: Dict[str, Any]) -> ClauseAnalysisResponse:
+    """
+    Validates a parsed answer, completing a few missing or misplaced fields locally if needed.
+    Raises StructuredOutputError if the answer cannot be repaired.
+    """
+    with STAGE_SECONDS.time("validation"):
+        try:
+            return ClauseAnalysisResponse(**result)
+        except ValidationError as e:
+            PARSE_FAILURES.inc("validation")
+            defaults = {"originalClauseText": change_json.get("original_text") or "", "clauseIdentifier": "Clause"}
+            completed = complete_fields(result, ClauseAnalysisResponse, defaults)
+            if completed is None:
+                raise StructuredOutputError(f"Invalid analysis returned from Gemini API: {e}", pyjson.dumps(result))
+            OUTPUT_REPAIRS.inc("local")
+            return ClauseAnalysisResponse(**completed)
+
+async def _repair_analysis(error: StructuredOutputError, change_json: Dict[str, Any],
+                           tier: Optional[Tier] = None) -> ClauseAnalysisResponse:
+    """
+    Last resort for answers that could not be repaired locally: asks the model to fix its own
+    output with a short prompt instead of repeating the full few-shot analysis.
+    """
+    if not REPAIR_PROMPT_ENABLED or not error.text.strip():
+        raise error
+    OUTPUT_REPAIRS.inc("prompt")
+    result = await call_google_gemini_api(
+        repair_prompt(error.text, ANALYSIS_SCHEMA, str(error)), _response_schema(ANALYSIS_SCHEMA), tier=tier,
+        accept=_is_valid_analysis,
+    )
+    return _validate_analysis(result, change_json)
+
+async def analyze_clause_change_for_changes_response(change_json: Dict[str, Any]) -> ClauseAnalysisResponse:
     """
     Calls the LLM and maps the result to the AnalyzeChangesResponse structure, returning ClauseAnalysisResponse.
     """
-    llm_result = analyze_clause_change(change_json)
+    llm_result = await analyze_clause_change(change_json)
     return llm_result
+
+async def _request_pack(query: str, pending: List[Tuple[int, Dict[str, Any]]], tier: Tier) -> List[Dict[str, Any]]:
+    with STAGE_SECONDS.time("upstream"), TIER_SECONDS.time(tier.name):
+        data = await _generate_after_prefix(query, packed_payload(pending), _response_schema(PACKED_SCHEMA), tier.model)
+    with STAGE_SECONDS.time("json_extraction"):
+        return [entry for text in _candidate_texts(data) for entry in parse_packed_array(text)]
+
+def _complete_pack(entries: List[Dict[str, Any]], by_index: Dict[int, Dict[str, Any]]) -> bool:
+    """
+    Whether a packed answer holds a valid analysis for every item of the pack.
+    """
+    valid = {entry.get("paragraphIndex") for entry in entries if _is_valid_analysis(entry)}
+    return all(index in valid for index in by_index)
+
+@traced("analyze_clause_pack")
+async def analyze_clause_pack(items: List[Tuple[int, Dict[str, Any]]]) -> Dict[int, Union[ClauseAnalysisResponse, Exception]]:
+    """
+    Analyzes several (paragraphIndex, change_json) pairs with a single LLM call that returns a JSON array.
+    Triaged and cached items are served directly; items missing from or malformed in the returned array are retried
+    individually. Each value is either the analysis or the exception of its individual retry.
+    """
+    results: Dict[int, Union[ClauseAnalysisResponse, Exception]] = {}
+    pending: List[Tuple[int, Dict[str, Any]]] = []
+    oversized: List[Tuple[int, Dict[str, Any]]] = []
+    for paragraph_index, change_json in items:
+        local = _local_analysis(change_json, _analysis_cache_key(change_json))
+        if local is not None:
+            results[paragraph_index] = local
+        elif make_chunks(change_json) is not None:
+            # Oversized clauses are analyzed in chunks below instead of being packed
+            oversized.append((paragraph_index, change_json))
+        else:
+            pending.append((paragraph_index, change_json))
+
+    if len(pending) > 1:
+        query = "\n".join(change_query_text(change_json) for _, change_json in pending)
+        by_index = dict(pending)
+        tier = route(change_json for _, change_json in pending)
+        try:
+            # Like single analyses, slow pack calls may be hedged; an answer wins once every item in it is valid
+            entries = await hedger.run(
+                lambda: _request_pack(query, pending, tier), lambda entries: _complete_pack(entries, by_index)
+            )
+        except (httpx.HTTPError, DeadlineExceeded):
+            # Every item of the pack is analyzed individually below
+            PACK_FALLBACKS.inc("upstream_error", amount=len(pending))
+        else:
+            if not entries:
+                PARSE_FAILURES.inc("packed_no_array")
+            invalid = set()
+            for entry in entries:
+                paragraph_index = entry.pop("paragraphIndex", None)
+                if paragraph_index not in by_index or paragraph_index in results:
+                    continue
+                change_json = by_index[paragraph_index]
+                try:
+                    response = _validate_analysis(entry, change_json)
+                except StructuredOutputError:
+                    invalid.add(paragraph_index)
+                    continue
+                response.modelTier = tier.name
+                results[paragraph_index] = response
+                _remember_analysis(change_json, _analysis_cache_key(change_json), response)
+            invalid.difference_update(results)
+            PACK_FALLBACKS.inc("invalid", amount=len(invalid))
+            absent = [index for index in by_index if index not in results and index not in invalid]
+            PACK_FALLBACKS.inc("missing", amount=len(absent))
+
+    missing = [(paragraph_index, change_json) for paragraph_index, change_json in pending if paragraph_index not in results]
+    missing.extend(oversized)
+    retried = await asyncio.gather(
+        *(analyze_clause_change(change_json) for _, change_json in missing), return_exceptions=True
+    )
+    for (paragraph_index, _), result in zip(missing, retried):
+        results[paragraph_index] = result
+    return results
@@ -0,0 +1,186 @@
+# context_cache.py
+"""
+Explicit context caching of the static prompt prefix with Gemini `cachedContents`.
+
+The methodology and few-shot examples are registered once as cached content;
+afterwards each call only sends the per-clause suffix and references the
+cache by name, so the prefix is neither re-uploaded nor re-processed. Cached
+contents belong to one API key and model, so each provider of the pool that
+supports caching gets its own cache per model. The cache is created lazily, its TTL is extended when it is used close to expiry,
+and it is deleted on shutdown. When caching is disabled, rejected by the API
+(e.g. the model does not support it) or the cache has vanished, calls fall
+back to sending the full prompt and creation on that provider and model is
+retried after a pause. Creating and refreshing a cache are upstream calls like
+any other: they are scheduled and paced by the provider's budgets, bounded by
+the request deadline, and calls that need a cache while it is being created
+send the full prompt instead of waiting for it.
+"""
+import hashlib
+import os
+import time
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+import httpx
+
+from few_shot import estimate_tokens
+from gemini_client import (
+    GEMINI_MODEL, RETRYABLE_STATUS_CODES, generate_content, get_client, provider_pool, provider_request,
+)
+from providers import Provider
+
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "1") == "1"
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+# Extend the TTL when a call happens less than this many seconds before expiry
+CONTEXT_CACHE_REFRESH_MARGIN = int(os.getenv("CONTEXT_CACHE_REFRESH_MARGIN", "300"))
+# Pause before trying to create the cache again after it failed
+CONTEXT_CACHE_RETRY = int(os.getenv("CONTEXT_CACHE_RETRY", "600"))
+
+# Status codes with which Gemini rejects a request that refers to a missing or foreign cache; apart from 404,
+# they only mean that when the error is about the cached content
+_STALE_CACHE_STATUS_CODES = {400, 403, 404}
+
+
+def _stale_cache_error(response: httpx.Response) -> bool:
+    if response.status_code == 404:
+        return True
+    if response.status_code not in _STALE_CACHE_STATUS_CODES:
+        return False
+    try:
+        message = str(response.json()["error"]["message"])
+    except (ValueError, KeyError, TypeError):
+        return False
+    return "cache" in message.lower()
+
+
+class ContextCache:
+    def __init__(self, enabled: bool = True, ttl: int = 3600, refresh_margin: int = 300, retry_after: int = 600):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        # Per provider, model and prefix hash: (cachedContents name, local expiry time, provider)
+        self._entries: Dict[str, tuple] = {}
+        # Keys whose cache is being created or refreshed
+        self._updating: Set[str] = set()
+        # Per (provider name, model): when to try creating caches again after a failure
+        self._unavailable_until: Dict[Tuple[str, str], float] = {}
+        self.created = 0
+        self.refreshed = 0
+        self.hits = 0
+        self.fallbacks = 0
+        self.failures = 0
+
+    async def _request(self, provider: Provider, method: str, path: str, body: Optional[Dict[str, Any]] = None,
+                       params: Optional[Dict[str, str]] = None, tokens: int = 0) -> Dict[str, Any]:
+        return await provider_request(
+            provider, method, f"{provider.api_base}/{path}", body, {"key": provider.api_key, **(params or {})}, tokens
+        )
+
+    async def _create(self, provider: Provider, prefix: str, model: str) -> str:
+        body = {
+            "model": f"models/{model}",
+            "displayName": "specter-law-prompt",
+            "contents": [{"role": "user", "parts": [{"text": prefix}]}],
+            "ttl": f"{self.ttl}s",
+        }
+        created = await self._request(provider, "POST", "cachedContents", body, tokens=estimate_tokens(prefix))
+        self.created += 1
+        return created["name"]
+
+    async def get(self, prefix: str, model: str = GEMINI_MODEL, provider: Optional[Provider] = None) -> Optional[str]:
+        """
+        Returns the cachedContents name for the prefix on the given model and provider (by default
+        the first one that supports caching), creating or refreshing it if needed, or None if
+        caching is unavailable or the cache is still being created by another call.
+        Raises DeadlineExceeded when the request deadline passes while creating or refreshing it.
+        """
+        provider = provider or provider_pool.caching_provider()
+        if not self.enabled or provider is None or not provider.supports_caching:
+            return None
+        now = time.monotonic()
+        if now < self._unavailable_until.get((provider.name, model), 0.0):
+            return None
+        key = hashlib.sha256(f"{provider.name}\n{model}\n{prefix}".encode("utf-8")).hexdigest()
+        entry = self._entries.get(key)
+        usable = entry is not None and now < entry[1]
+        if usable and (now < entry[1] - self.refresh_margin or key in self._updating):
+            self.hits += 1
+            return entry[0]
+        if key in self._updating:
+            return None
+        self._updating.add(key)
+        try:
+            if usable:
+                await self._request(provider, "PATCH", entry[0], {"ttl": f"{self.ttl}s"}, {"updateMask": "ttl"})
+                name = entry[0]
+                self.refreshed += 1
+            else:
+                name = await self._create(provider, prefix, model)
+        except (httpx.HTTPError, KeyError, ValueError):
+            self.failures += 1
+            self._entries.pop(key, None)
+            self._unavailable_until[(provider.name, model)] = now + self.retry_after
+            return None
+        finally:
+            self._updating.discard(key)
+        self._entries[key] = (name, now + self.ttl, provider)
+        return name
+
+    def invalidate(self, name: str) -> None:
+        self._entries = {key: entry for key, entry in self._entries.items() if entry[0] != name}
+
+    async def generate(self, prefix: str, suffix: str, build_fallback_prompt: Callable[[], str],
+                       model: Optional[str] = None, **kwargs: Any) -> Dict[str, Any]:
+        """
+        Sends `suffix` referencing the cached `prefix`; without a usable cache, sends the prompt
+        returned by `build_fallback_prompt` instead. Keyword arguments go to generate_content.
+        The provider is picked by the pool first, so caching does not defeat load balancing.
+        """
+        provider = provider_pool.choose()
+        name = await self.get(prefix, model or GEMINI_MODEL, provider) if provider is not None else None
+        if name is not None:
+            try:
+                return await generate_content(suffix, cached_content=name, model=model, provider=provider, **kwargs)
+            except httpx.TransportError:
+                # The provider holding the cache is struggling; another one can take the full prompt
+                pass
+            except httpx.HTTPStatusError as e:
+                if _stale_cache_error(e.response):
+                    # Expired, deleted or unusable for this request: recreate it next time
+                    self.invalidate(name)
+                elif e.response.status_code not in RETRYABLE_STATUS_CODES:
+                    raise
+        self.fallbacks += 1
+        return await generate_content(build_fallback_prompt(), model=model, **kwargs)
+
+    async def close(self) -> None:
+        """
+        Deletes the cached contents so they stop accruing storage cost.
+        """
+        entries, self._entries = self._entries, {}
+        for name, _, provider in entries.values():
+            try:
+                # Sent directly: shutdown should not wait for the request budgets
+                response = await get_client().delete(f"{provider.api_base}/{name}", params={"key": provider.api_key})
+                response.raise_for_status()
+            except httpx.HTTPError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "created": self.created,
+            "refreshed": self.refreshed,
+            "hits": self.hits,
+            "fallbacks": self.fallbacks,
+            "failures": self.failures,
+        }
+
+
+context_cache = ContextCache(
+    enabled=CONTEXT_CACHE_ENABLED,
+    ttl=CONTEXT_CACHE_TTL,
+    refresh_margin=CONTEXT_CACHE_REFRESH_MARGIN,
+    retry_after=CONTEXT_CACHE_RETRY,
+)
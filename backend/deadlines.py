@@ -0,0 +1,174 @@
+# deadlines.py
+"""
+Request deadlines and cancellation of abandoned work.
+
+A client can give a request a time budget (the X-Request-Deadline header, in
+seconds, or `deadlineSeconds` in batch requests). The absolute deadline is kept
+in a context variable, so it reaches every upstream call made on behalf of the
+request, including calls in tasks spawned for it, without being passed through
+the pipeline. Upstream calls are bounded by the remaining time (queueing,
+quota waits and retries included) and calls that would start after the
+deadline are not sent at all.
+
+Requests whose client disconnects are cancelled together with all of their
+queued and in-flight work. Cancellations and the upstream calls they saved are
+counted on /metrics and /upstream_stats.
+"""
+import asyncio
+import os
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, Optional, TypeVar
+
+from metrics import Counter
+
+DEADLINE_HEADER = "X-Request-Deadline"
+# Applied to requests that do not set a deadline (0 = none)
+DEFAULT_REQUEST_DEADLINE = float(os.getenv("DEFAULT_REQUEST_DEADLINE", "0"))
+# Upper bound for client-supplied deadlines (0 = none)
+MAX_REQUEST_DEADLINE = float(os.getenv("MAX_REQUEST_DEADLINE", "0"))
+
+REQUESTS_CANCELLED = Counter(
+    "specter_requests_cancelled_total",
+    "Requests whose outstanding work was cancelled, by reason (disconnect, deadline).",
+    ["reason"],
+)
+UPSTREAM_CALLS_CANCELLED = Counter(
+    "specter_upstream_calls_cancelled_total",
+    "Upstream calls saved by cancellation, by stage (expired = deadline passed before the call, "
+    "queued = waiting for a slot, quota or retry, in_flight = request aborted).",
+    ["stage"],
+)
+
+T = TypeVar("T")
+
+
+class Deadline:
+    """
+    The deadline of one request, shared by reference with every task spawned for it.
+    """
+    __slots__ = ("at", "expired", "_closed")
+
+    def __init__(self, seconds: float):
+        # time.monotonic() value
+        self.at = time.monotonic() + seconds
+        # Set once an upstream call of the request was abandoned because of the deadline
+        self.expired = False
+        self._closed = False
+
+    def close(self) -> None:
+        """
+        Called once the request is answered, to count it if the deadline cut its work short.
+        """
+        if self.expired and not self._closed:
+            REQUESTS_CANCELLED.inc("deadline")
+        self._closed = True
+
+
+_deadline: ContextVar[Optional[Deadline]] = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, message: str = "Request deadline exceeded."):
+        super().__init__(message)
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def parse_deadline(header: Optional[str], field: Optional[float] = None) -> Optional[Deadline]:
+    """
+    The request's deadline from the body field or the header (a time budget in seconds), capped by
+    MAX_REQUEST_DEADLINE, or DEFAULT_REQUEST_DEADLINE if neither is set. None means no deadline.
+    """
+    seconds = field
+    if seconds is None and header:
+        try:
+            seconds = float(header)
+        except ValueError:
+            seconds = None
+    if seconds is None or seconds <= 0:
+        seconds = DEFAULT_REQUEST_DEADLINE or None
+    if seconds is not None and MAX_REQUEST_DEADLINE:
+        seconds = min(seconds, MAX_REQUEST_DEADLINE)
+    return None if seconds is None else Deadline(seconds)
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left until the current request's deadline, or None without a deadline.
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline.at - time.monotonic()
+
+
+def exceeded() -> DeadlineExceeded:
+    """
+    Marks the current request's deadline as having cut its work short; returns the error to raise.
+    """
+    deadline = _deadline.get()
+    if deadline is not None:
+        deadline.expired = True
+    return DeadlineExceeded()
+
+
+def abandon_call(stage: str) -> DeadlineExceeded:
+    """
+    Records an upstream call abandoned at `stage` because the deadline passed; returns the error to raise.
+    """
+    UPSTREAM_CALLS_CANCELLED.inc(stage)
+    return exceeded()
+
+
+async def run_with_deadline(awaitable: Awaitable[T], deadline: Optional[Deadline]) -> T:
+    """
+    Awaits `awaitable` with its upstream calls bounded by `deadline`. A shorter deadline
+    already set by an enclosing request is kept.
+    """
+    current = _deadline.get()
+    if deadline is None or (current is not None and current.at <= deadline.at):
+        return await awaitable
+    token = _deadline.set(deadline)
+    try:
+        return await awaitable
+    finally:
+        _deadline.reset(token)
+
+
+async def _until_disconnected(receive) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(receive, awaitable: Awaitable[T]) -> T:
+    """
+    Awaits `awaitable`, cancelling it if the client disconnects first (`receive` is the
+    request's ASGI receive channel, whose body has already been read). Raises ClientDisconnected then.
+    """
+    work = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_until_disconnected(receive))
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        abandoned = not work.done()
+        if abandoned:
+            work.cancel()
+            # Nobody awaits the cancelled work; don't report what it raises while unwinding
+            work.add_done_callback(lambda task: task.cancelled() or task.exception())
+    if abandoned:
+        REQUESTS_CANCELLED.inc("disconnect")
+        raise ClientDisconnected()
+    return work.result()
+
+
+def cancellation_stats() -> Dict[str, Any]:
+    return {
+        "requests": {reason: int(REQUESTS_CANCELLED.value(reason)) for reason in ("disconnect", "deadline")},
+        "upstream_calls_saved": {
+            stage: int(UPSTREAM_CALLS_CANCELLED.value(stage)) for stage in ("expired", "queued", "in_flight")
+        },
+    }
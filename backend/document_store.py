@@ -0,0 +1,96 @@
+# document_store.py
+"""
+Per-document paragraph fingerprints for incremental re-analysis.
+
+When a batch carries a documentId, the result of every analyzed paragraph is
+stored under a fingerprint of its normalized text and changelog and of the
+analysis namespace (model, prompt version and examples). On the next submission
+of the same document, paragraphs whose fingerprint is already known are answered
+from the store (even if they moved to another paragraphIndex) and only new or
+edited paragraphs are sent to the analysis pipeline. Stored results expire after
+DOCUMENT_TTL seconds. Writes are made by a writer thread (see sqlite_store.py).
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable
+
+from analysis_cache import normalize_change_json
+from sqlite_store import StoreWriter, connect
+
+DOCUMENT_DB = os.getenv(
+    "DOCUMENT_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "documents.sqlite3")
+)
+DOCUMENT_TTL = float(os.getenv("DOCUMENT_TTL", str(30 * 24 * 3600)))
+
+
+def paragraph_fingerprint(change_json: Dict[str, Any], namespace: str) -> str:
+    payload = json.dumps([namespace, normalize_change_json(change_json)], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DocumentStore:
+    def __init__(self, db_path: str, ttl: float = DOCUMENT_TTL):
+        self.ttl = ttl
+        self._db = connect(db_path)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS document_paragraphs ("
+                "document_id TEXT NOT NULL, fingerprint TEXT NOT NULL, result TEXT NOT NULL, "
+                "updated_at REAL NOT NULL, PRIMARY KEY (document_id, fingerprint))"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS document_paragraphs_updated_at ON document_paragraphs (updated_at)"
+            )
+            self._db.commit()
+        self._writer = StoreWriter("documents", db_path, self._db, self._lock)
+
+    def results(self, document_id: str) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the unexpired result entries of a document by paragraph fingerprint.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT fingerprint, result FROM document_paragraphs WHERE document_id = ? AND updated_at >= ?",
+                (document_id, time.time() - self.ttl),
+            ).fetchall()
+        return {fingerprint: json.loads(result) for fingerprint, result in rows}
+
+    def retain(self, document_id: str, fingerprints: Iterable[str]) -> None:
+        """
+        Drops stored paragraphs that are no longer part of the document's latest submission,
+        and the expired paragraphs of every document.
+        """
+        keep = set(fingerprints)
+        expired_before = time.time() - self.ttl
+
+        def write(db: sqlite3.Connection) -> None:
+            db.execute("DELETE FROM document_paragraphs WHERE updated_at < ?", (expired_before,))
+            stored = [row[0] for row in db.execute(
+                "SELECT fingerprint FROM document_paragraphs WHERE document_id = ?", (document_id,)
+            )]
+            stale = [(document_id, fingerprint) for fingerprint in stored if fingerprint not in keep]
+            db.executemany("DELETE FROM document_paragraphs WHERE document_id = ? AND fingerprint = ?", stale)
+
+        self._writer.submit(write)
+
+    def save(self, document_id: str, fingerprint: str, entry: Dict[str, Any]) -> None:
+        row = (document_id, fingerprint, json.dumps(entry, ensure_ascii=False), time.time())
+        self._writer.submit(lambda db: db.execute(
+            "INSERT OR REPLACE INTO document_paragraphs (document_id, fingerprint, result, updated_at) "
+            "VALUES (?, ?, ?, ?)",
+            row,
+        ))
+
+    def flush(self) -> None:
+        """
+        Waits for the queued writes; called on shutdown.
+        """
+        self._writer.flush()
+
+
+document_store = DocumentStore(DOCUMENT_DB)
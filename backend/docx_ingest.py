@@ -0,0 +1,142 @@
+# docx_ingest.py
+"""
+Server-side extraction of tracked changes from .docx files.
+
+`word/document.xml` is read straight from the zip archive with a streaming
+XML parser (ElementTree.iterparse). Every top-level paragraph is cleared as
+soon as it has been processed, so memory stays bounded by the largest
+paragraph rather than the size of the document. Only paragraphs that contain
+tracked changes are yielded, in the same shape the Word add-in sends to
+/analyze_changes_batch (paragraphIndex, paragraph, changelog). Uploads larger
+than DOCX_MAX_BYTES and document parts that inflate beyond DOCX_MAX_XML_BYTES
+are rejected, so a small zip bomb cannot keep a worker parsing for minutes.
+"""
+import os
+import zipfile
+from typing import IO, Any, Dict, Iterator, List, Optional, Union
+from xml.etree import ElementTree
+
+DOCX_MAX_BYTES = int(os.getenv("DOCX_MAX_BYTES", str(25 * 1024 * 1024)))
+DOCX_MAX_XML_BYTES = int(os.getenv("DOCX_MAX_XML_BYTES", str(200 * 1024 * 1024)))
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+DOCUMENT_PART = "word/document.xml"
+
+# Revision elements and the change type the Office.js add-in reports for them
+CHANGE_TYPES = {
+    f"{W}ins": "Added",
+    f"{W}moveTo": "Added",
+    f"{W}del": "Deleted",
+    f"{W}moveFrom": "Deleted",
+}
+_TEXT = {f"{W}t", f"{W}delText"}
+_BREAKS = {f"{W}tab": "\t", f"{W}br": "\n", f"{W}cr": "\n"}
+
+
+class DocxError(ValueError):
+    pass
+
+
+class DocxTooLarge(DocxError):
+    pass
+
+
+class _LimitedReader:
+    """
+    Reads a zip member, raising DocxTooLarge once more than `limit` bytes were inflated.
+    The size in the zip directory is checked up front, but it is not trusted.
+    """
+
+    def __init__(self, member: IO[bytes], limit: int):
+        self.member = member
+        self.limit = limit
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.member.read(size)
+        self.size += len(data)
+        if self.size > self.limit:
+            raise DocxTooLarge(f"{DOCUMENT_PART} is larger than {self.limit} bytes uncompressed.")
+        return data
+
+
+def _change(change_type: str, author: Optional[str]) -> Dict[str, Any]:
+    return {"type": change_type, "text": "", "author": author or ""}
+
+
+def iter_tracked_paragraphs(source: Union[str, IO[bytes]],
+                            max_xml_bytes: int = DOCX_MAX_XML_BYTES) -> Iterator[Dict[str, Any]]:
+    """
+    Yields {"paragraphIndex", "paragraph", "changelog"} for every paragraph with tracked changes.
+    Paragraph indices count all body paragraphs (including those in tables) in document order,
+    like Word's body.paragraphs. As in Word's markup view, the paragraph text contains both
+    inserted and deleted text. Formatting revisions (w:rPrChange) are reported as "Formatted".
+    Raises DocxError for invalid files and DocxTooLarge if the document part inflates beyond
+    `max_xml_bytes`.
+    """
+    try:
+        archive = zipfile.ZipFile(source)
+        info = archive.getinfo(DOCUMENT_PART)
+        if info.file_size > max_xml_bytes:
+            archive.close()
+            raise DocxTooLarge(f"{DOCUMENT_PART} is larger than {max_xml_bytes} bytes uncompressed.")
+        document = archive.open(info)
+    except (zipfile.BadZipFile, KeyError) as e:
+        raise DocxError(f"Not a valid .docx file: {e}")
+    with archive, document:
+        body = None
+        paragraph_index = -1
+        # Open revision elements inside the current paragraph, innermost last
+        revisions: List[Dict[str, Any]] = []
+        text: List[str] = []
+        changelog: List[Dict[str, Any]] = []
+        run_format_change: Optional[Dict[str, Any]] = None
+        depth = 0  # paragraph nesting (text boxes contain paragraphs of their own)
+        try:
+            for event, elem in ElementTree.iterparse(_LimitedReader(document, max_xml_bytes), events=("start", "end")):
+                tag = elem.tag
+                if event == "start":
+                    if tag == f"{W}body":
+                        body = elem
+                    elif tag == f"{W}p":
+                        depth += 1
+                        if depth == 1:
+                            paragraph_index += 1
+                            text, changelog, revisions = [], [], []
+                    elif depth == 1 and tag in CHANGE_TYPES:
+                        revision = _change(CHANGE_TYPES[tag], elem.get(f"{W}author"))
+                        revisions.append(revision)
+                        changelog.append(revision)
+                    elif depth == 1 and tag == f"{W}r":
+                        run_format_change = None
+                    continue
+                if depth == 1:
+                    if tag in _TEXT or tag in _BREAKS:
+                        value = (elem.text or "") if tag in _TEXT else _BREAKS[tag]
+                        text.append(value)
+                        if revisions:
+                            revisions[-1]["text"] += value
+                        elif run_format_change is not None:
+                            run_format_change["text"] += value
+                    elif tag == f"{W}rPrChange" and not revisions:
+                        run_format_change = _change("Formatted", elem.get(f"{W}author"))
+                        changelog.append(run_format_change)
+                    elif tag in CHANGE_TYPES:
+                        revisions.pop()
+                    elif tag == f"{W}r":
+                        run_format_change = None
+                if tag == f"{W}p":
+                    depth -= 1
+                    if depth == 0:
+                        # Paragraph-mark revisions carry no text and are not reported
+                        changelog = [change for change in changelog if change["text"]]
+                        if changelog:
+                            yield {"paragraphIndex": paragraph_index, "paragraph": "".join(text), "changelog": changelog}
+                        # Paragraphs inside tables are only released with their table otherwise
+                        elem.clear()
+                if body is not None and depth == 0 and tag != f"{W}body" and elem in body:
+                    # A top-level body element is complete: release it
+                    body.remove(elem)
+        except ElementTree.ParseError as e:
+            raise DocxError(f"Malformed {DOCUMENT_PART}: {e}")
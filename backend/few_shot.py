@@ -0,0 +1,154 @@
+# few_shot.py
+"""
+Relevance-based few-shot example selection.
+
+The analysis prompt in clause_analysis.py is split into its instructions, an
+indexed library of example analyses and its closing output requirements. For
+each clause only the examples most similar to it (local TF-IDF cosine
+similarity, no network) are included, within a token budget. When selection is
+disabled or nothing matches, the full prompt is used.
+"""
+import math
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+FEW_SHOT_SELECTION = os.getenv("FEW_SHOT_SELECTION", "1") == "1"
+FEW_SHOT_TOP_K = int(os.getenv("FEW_SHOT_TOP_K", "2"))
+# Approximate number of tokens that may be spent on examples per request
+FEW_SHOT_TOKEN_BUDGET = int(os.getenv("FEW_SHOT_TOKEN_BUDGET", "2500"))
+
+SECTION_SEPARATOR = "\n---\n"
+EXAMPLE_MARKER = "**Example Analysis:"
+
+_TOKEN = re.compile(r"[a-z][a-z0-9]+")
+_STOPWORDS = frozenset(
+    "the and for that this with any all are not from its into shall will may must such other been have has "
+    "was were which who whom their them they than then there these those under upon within without".split()
+)
+_EXAMPLE_TITLE = re.compile(r"\*\*Example Analysis:\s*(.*?)\*\*")
+_ORIGINAL_TEXT = re.compile(r"```legal\s*([\s\S]*?)```")
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English prose
+    return len(text) // 4 + 1
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN.findall(text.lower()) if t not in _STOPWORDS]
+
+
+@dataclass
+class FewShotExample:
+    title: str
+    original_text: str
+    text: str
+    tokens: int
+    vector: Dict[str, float] = field(default_factory=dict)
+
+
+class ExampleLibrary:
+    def __init__(self, instructions: str, examples: List[FewShotExample], closing: str, full_prompt: str):
+        self.instructions = instructions
+        self.examples = examples
+        self.closing = closing
+        self.full_prompt = full_prompt
+        self._idf: Dict[str, float] = {}
+        self._build_index()
+
+    @classmethod
+    def from_prompt(cls, prompt: str) -> "ExampleLibrary":
+        """
+        Splits a prompt made of `---`-separated sections into instructions,
+        `**Example Analysis: ...**` sections and the closing sections.
+        """
+        sections = prompt.split(SECTION_SEPARATOR)
+        example_positions = [i for i, s in enumerate(sections) if s.strip().startswith(EXAMPLE_MARKER)]
+        if not example_positions:
+            return cls(prompt, [], "", prompt)
+        first, last = example_positions[0], example_positions[-1]
+        examples = []
+        for section in sections[first:last + 1]:
+            title_match = _EXAMPLE_TITLE.search(section)
+            text_match = _ORIGINAL_TEXT.search(section)
+            examples.append(FewShotExample(
+                title=title_match.group(1).strip() if title_match else "",
+                original_text=text_match.group(1).strip() if text_match else section,
+                text=section,
+                tokens=estimate_tokens(section),
+            ))
+        instructions = SECTION_SEPARATOR.join(sections[:first])
+        closing = SECTION_SEPARATOR.join(sections[last + 1:])
+        return cls(instructions, examples, closing, prompt)
+
+    def _build_index(self) -> None:
+        documents = [Counter(tokenize(e.title + " " + e.original_text)) for e in self.examples]
+        document_frequency = Counter(term for doc in documents for term in doc)
+        n = len(documents)
+        self._idf = {term: math.log((1 + n) / (1 + df)) + 1 for term, df in document_frequency.items()}
+        for example, doc in zip(self.examples, documents):
+            example.vector = self._normalized_vector(doc)
+
+    def _normalized_vector(self, counts: Counter) -> Dict[str, float]:
+        vector = {term: (1 + math.log(tf)) * self._idf[term] for term, tf in counts.items() if term in self._idf}
+        norm = math.sqrt(sum(w * w for w in vector.values()))
+        return {term: w / norm for term, w in vector.items()} if norm else {}
+
+    def rank(self, query: str) -> List[Tuple[float, FewShotExample]]:
+        """
+        Returns (cosine similarity, example) pairs for examples that share terms with the query, best first.
+        """
+        query_vector = self._normalized_vector(Counter(tokenize(query)))
+        scored = []
+        for example in self.examples:
+            score = sum(w * example.vector.get(term, 0.0) for term, w in query_vector.items())
+            if score > 0:
+                scored.append((score, example))
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        return scored
+
+    def select(self, query: str, top_k: int = FEW_SHOT_TOP_K,
+               token_budget: int = FEW_SHOT_TOKEN_BUDGET) -> List[FewShotExample]:
+        selected: List[FewShotExample] = []
+        used = 0
+        for _, example in self.rank(query):
+            if len(selected) >= top_k:
+                break
+            if used + example.tokens > token_budget:
+                continue
+            selected.append(example)
+            used += example.tokens
+        # Keep the original document order so the examples read naturally
+        return sorted(selected, key=self.examples.index)
+
+    def build_prompt(self, query: str) -> str:
+        """
+        Returns the prompt prefix (everything before the clause payload) for a clause.
+        Falls back to the full prompt when selection is disabled or no example matches.
+        """
+        if not FEW_SHOT_SELECTION or FEW_SHOT_TOP_K <= 0 or not self.examples:
+            return self.full_prompt
+        selected = self.select(query)
+        if not selected:
+            return self.full_prompt
+        return SECTION_SEPARATOR.join([self.instructions] + [e.text for e in selected] + [self.closing])
+
+    def config_tag(self) -> str:
+        """
+        Identifies the selection settings, for use in cache keys.
+        """
+        if not FEW_SHOT_SELECTION or FEW_SHOT_TOP_K <= 0:
+            return "full"
+        return f"top{FEW_SHOT_TOP_K}-budget{FEW_SHOT_TOKEN_BUDGET}"
+
+
+def change_query_text(change_json: Dict) -> str:
+    """
+    Text used to find relevant examples: the clause plus the tracked change descriptions.
+    """
+    parts = [str(change_json.get("original_text") or "")]
+    parts.extend(str(c.get("description") or "") for c in change_json.get("changes", []))
+    return "\n".join(parts)
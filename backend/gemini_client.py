@@ -0,0 +1,280 @@
+# gemini_client.py
+"""
+Shared async HTTP client for the Google Gemini API and the other LLM providers.
+
+All calls to Gemini go through one pooled httpx.AsyncClient so that connections
+(and TLS sessions) are kept alive and reused between paragraphs instead of being
+re-established for every request. HTTP/2 is used when the optional `h2` package
+is installed. Pool limits and timeouts are configurable through the environment.
+
+Calls are balanced over a pool of providers (API keys and OpenAI-compatible
+endpoints, see providers.py), each paced by its own requests-per-minute and
+tokens-per-minute budgets. Transient failures (429, 5xx, timeouts) are retried
+on another provider or with jittered exponential backoff, and each provider's
+circuit breaker fails fast while it is unhealthy (see rate_limit.py).
+Each attempt takes its provider's request and token budgets and then a slot from
+the priority scheduler (see scheduler.py), so interactive calls are paced ahead
+of queued batch calls and do not wait behind them for the budgets while holding
+a slot. Calls are bounded
+by the deadline of the request they serve (see deadlines.py).
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from deadlines import UPSTREAM_CALLS_CANCELLED, abandon_call, cancellation_stats, exceeded, remaining
+from few_shot import estimate_tokens
+from metrics import UPSTREAM_RESPONSES, UPSTREAM_TOKENS
+from profiling import annotate, traced
+from providers import GeminiProvider, OpenAICompatibleProvider, Provider, ProviderPool
+from rate_limit import CircuitOpenError, backoff_delay, parse_retry_after
+from scheduler import INTERACTIVE, request_priority, scheduler
+
+GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
+# Further keys (comma-separated); each one is a provider with its own quota (see providers.py)
+GOOGLE_API_KEYS = [key.strip() for key in os.getenv("GOOGLE_API_KEYS", "").split(",") if key.strip()]
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-lite")
+
+# OpenAI-compatible endpoints (comma-separated base URLs such as http://localhost:8080/v1), e.g. for on-prem inference
+OPENAI_COMPAT_BASE_URLS = [url.strip() for url in os.getenv("OPENAI_COMPAT_BASE_URLS", "").split(",") if url.strip()]
+OPENAI_COMPAT_MODEL = os.getenv("OPENAI_COMPAT_MODEL", "default")
+OPENAI_COMPAT_API_KEY = os.getenv("OPENAI_COMPAT_API_KEY", "")
+OPENAI_COMPAT_RPM = float(os.getenv("OPENAI_COMPAT_RPM", "0"))
+OPENAI_COMPAT_TPM = float(os.getenv("OPENAI_COMPAT_TPM", "0"))
+
+# Connection pool and timeout configuration
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "200"))
+GEMINI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("GEMINI_MAX_KEEPALIVE_CONNECTIONS", "50"))
+GEMINI_KEEPALIVE_EXPIRY = float(os.getenv("GEMINI_KEEPALIVE_EXPIRY", "30"))
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", "10"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+
+# Quota (per API key) and retry configuration (a budget of 0 disables that limit)
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "0"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "0"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# A rejected key only rules out that provider, not the request
+AUTH_FAILURE_STATUS_CODES = {401, 403}
+
+_client: Optional[httpx.AsyncClient] = None
+retry_count = 0
+
+
+def _build_pool() -> ProviderPool:
+    breaker = {"breaker_failures": GEMINI_BREAKER_FAILURES, "breaker_reset": GEMINI_BREAKER_RESET}
+    keys = list(dict.fromkeys(([GOOGLE_API_KEY] if GOOGLE_API_KEY else []) + GOOGLE_API_KEYS))
+    members: List[Provider] = [
+        GeminiProvider(f"gemini-{i + 1}", key, GEMINI_API_BASE, rpm=GEMINI_RPM, tpm=GEMINI_TPM, **breaker)
+        for i, key in enumerate(keys)
+    ]
+    members.extend(
+        OpenAICompatibleProvider(f"openai-{i + 1}", url, OPENAI_COMPAT_MODEL, OPENAI_COMPAT_API_KEY,
+                                 rpm=OPENAI_COMPAT_RPM, tpm=OPENAI_COMPAT_TPM, **breaker)
+        for i, url in enumerate(OPENAI_COMPAT_BASE_URLS)
+    )
+    return ProviderPool(members)
+
+
+provider_pool = _build_pool()
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Returns the shared AsyncClient, creating it on first use.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=_http2_available(),
+            limits=httpx.Limits(
+                max_connections=GEMINI_MAX_CONNECTIONS,
+                max_keepalive_connections=GEMINI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(GEMINI_TIMEOUT, connect=GEMINI_CONNECT_TIMEOUT),
+            headers={"Content-Type": "application/json"},
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+@traced("generate_content")
+async def generate_content(prompt: str, timeout: Optional[float] = None,
+                           response_schema: Optional[Dict[str, Any]] = None,
+                           cached_content: Optional[str] = None, model: Optional[str] = None,
+                           provider: Optional[Provider] = None) -> Dict[str, Any]:
+    """
+    Sends a single-turn prompt in the Gemini `generateContent` format and returns the response
+    in that format, whichever provider of the pool served it. With a response_schema, the model
+    is constrained to JSON output matching it; with cached_content (a cachedContents name), the
+    prompt continues that cached context and must be sent to the provider that holds it.
+    `model` overrides GEMINI_MODEL for this call.
+    Transient failures are retried, on another provider when one is available; raises
+    httpx.HTTPError once retries are exhausted, on other non-2xx responses, or immediately
+    while every provider's circuit breaker is open. A call pinned to one `provider` is not
+    retried while other providers are available, so the caller can send it elsewhere instead.
+    Within a request deadline (see deadlines.py), the call including queueing and retries is
+    abandoned with DeadlineExceeded when the deadline passes, and not started after it.
+    """
+    if not provider_pool.members:
+        raise Exception("Google API key not configured.")
+    budget = remaining()
+    if budget is not None and budget <= 0:
+        raise abandon_call("expired")
+    # Where the call is, for counting the calls saved by cancellation
+    stage = ["queued"]
+    call = _generate_with_retries(prompt, timeout, response_schema, cached_content, model, provider, stage)
+    try:
+        if budget is None:
+            return await call
+        return await asyncio.wait_for(call, budget)
+    except asyncio.TimeoutError:
+        raise abandon_call(stage[0])
+    except asyncio.CancelledError:
+        # The request was abandoned (e.g. its client disconnected)
+        UPSTREAM_CALLS_CANCELLED.inc(stage[0])
+        raise
+
+
+async def _generate_with_retries(prompt: str, timeout: Optional[float], response_schema: Optional[Dict[str, Any]],
+                                 cached_content: Optional[str], model: Optional[str], provider: Optional[Provider],
+                                 stage: List[str]) -> Dict[str, Any]:
+    global retry_count
+    request_timeout = httpx.Timeout(timeout, connect=GEMINI_CONNECT_TIMEOUT) if timeout else httpx.USE_CLIENT_DEFAULT
+    prompt_tokens = estimate_tokens(prompt)
+    tried: List[Provider] = []
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        stage[0] = "queued"
+        member = provider or provider_pool.choose(exclude=tried)
+        try:
+            member.circuit_breaker.before_call()
+        except CircuitOpenError:
+            UPSTREAM_RESPONSES.inc("circuit_open")
+            raise
+        url, payload, params, headers = member.build_request(prompt, model or GEMINI_MODEL, response_schema, cached_content)
+        retry_after = None
+        member.calls += 1
+        annotate(provider=member.name, model=model or GEMINI_MODEL, attempts=attempt + 1)
+        try:
+            member.in_flight += 1
+            try:
+                async with _paced(member, prompt_tokens):
+                    started = time.monotonic()
+                    stage[0] = "in_flight"
+                    response = await get_client().post(
+                        url, json=payload, params=params, headers=headers, timeout=request_timeout
+                    )
+            finally:
+                member.in_flight -= 1
+            UPSTREAM_RESPONSES.inc(str(response.status_code))
+            annotate(status=response.status_code)
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                retry_after = parse_retry_after(response)
+            response.raise_for_status()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            if isinstance(e, httpx.TransportError):
+                UPSTREAM_RESPONSES.inc("transport_error")
+            status = None if isinstance(e, httpx.TransportError) else e.response.status_code
+            rejected_key = provider is None and status in AUTH_FAILURE_STATUS_CODES and len(provider_pool.members) > 1
+            if status is not None and status not in RETRYABLE_STATUS_CODES and not rejected_key:
+                # The API is reachable; the request itself is at fault
+                member.circuit_breaker.record_success()
+                raise
+            member.circuit_breaker.record_failure()
+            member.record_failure(retry_after)
+            tried.append(member)
+            if attempt == GEMINI_MAX_RETRIES or (provider is not None and provider_pool.has_alternative(tried)):
+                raise
+            retry_count += 1
+            # Another healthy provider can take the retry right away
+            if provider is not None or not provider_pool.has_alternative(tried):
+                await asyncio.sleep(backoff_delay(attempt, GEMINI_BACKOFF_BASE, GEMINI_BACKOFF_MAX, retry_after))
+            continue
+        member.circuit_breaker.record_success()
+        member.record_success(time.monotonic() - started)
+        data = member.to_gemini_response(response.json())
+        _record_usage(data)
+        return data
+
+
+@asynccontextmanager
+async def _paced(member: Provider, tokens: int) -> AsyncIterator[None]:
+    """
+    Takes the provider's request and token budgets and then holds a scheduler slot for one
+    upstream request. Waiting for the budgets outside the slot keeps a rate-limited batch call
+    from occupying a slot an interactive call could use, and interactive calls are given the
+    budgets ahead of waiting batch calls.
+    """
+    urgent = request_priority() == INTERACTIVE
+    await member.request_bucket.acquire(1, urgent)
+    await member.token_bucket.acquire(tokens, urgent)
+    async with scheduler.slot():
+        yield
+
+
+async def provider_request(member: Provider, method: str, url: str, body: Optional[Dict[str, Any]] = None,
+                           params: Optional[Dict[str, str]] = None, tokens: int = 0) -> Dict[str, Any]:
+    """
+    Sends a request other than a generation (e.g. managing cached contents) to one provider,
+    paced by the scheduler and the provider's budgets like generate_content, and returns the
+    JSON body. Not retried; raises httpx.HTTPError on failure and DeadlineExceeded when the
+    request deadline passes first.
+    """
+    budget = remaining()
+    if budget is not None and budget <= 0:
+        raise exceeded()
+
+    async def send() -> httpx.Response:
+        async with _paced(member, tokens):
+            return await get_client().request(method, url, json=body, params=params)
+
+    try:
+        response = await (send() if budget is None else asyncio.wait_for(send(), budget))
+    except asyncio.TimeoutError:
+        raise exceeded()
+    response.raise_for_status()
+    return response.json() if response.content else {}
+
+
+def _record_usage(data: Dict[str, Any]) -> None:
+    usage = data.get("usageMetadata") or {}
+    UPSTREAM_TOKENS.inc("prompt", amount=usage.get("promptTokenCount", 0))
+    UPSTREAM_TOKENS.inc("cached", amount=usage.get("cachedContentTokenCount", 0))
+    UPSTREAM_TOKENS.inc("response", amount=usage.get("candidatesTokenCount", 0))
+
+
+def upstream_stats() -> Dict[str, Any]:
+    return {
+        "retries": retry_count,
+        "rate_limited_waits": sum(
+            member.request_bucket.waits + member.token_bucket.waits for member in provider_pool.members
+        ),
+        "providers": provider_pool.stats(),
+        "scheduler": scheduler.stats(),
+        "cancellations": cancellation_stats(),
+    }
@@ -0,0 +1,125 @@
+# hedging.py
+"""
+Hedged requests against upstream stragglers.
+
+If an LLM call has not produced a valid result after an adaptive percentile
+of recent call latencies (p90 by default), a duplicate call is started; the
+first valid result (one the caller's check accepts, e.g. a schema-valid
+analysis rather than merely parseable JSON) wins and the other call is
+cancelled. Hedges are paid for
+from a budget that grows by HEDGE_BUDGET per call, which caps the extra
+upstream traffic at that fraction of all calls.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from metrics import Counter, Gauge
+
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "90"))
+# Maximum share of calls that may be hedged
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.05"))
+# Calls observed before hedging starts, and how many recent latencies are kept
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.05"))
+
+# Unused budget is capped so an idle period cannot fund a burst of hedges
+_MAX_CREDITS = 10.0
+
+HEDGES = Counter(
+    "specter_hedged_requests_total",
+    "Hedged upstream calls by outcome (issued, won = the hedge answered first, lost = the original did).",
+    ["outcome"],
+)
+
+T = TypeVar("T")
+
+
+class Hedger:
+    def __init__(self, enabled: bool = False, percentile: float = 90, budget: float = 0.05,
+                 min_samples: int = 20, window: int = 200, min_delay: float = 0.05):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._latencies: deque = deque(maxlen=window)
+        self._delay: Optional[float] = None
+        self._samples_since_update = 0
+        self._credits = 0.0
+
+    def _record(self, latency: float) -> None:
+        self._latencies.append(latency)
+        self._samples_since_update += 1
+        # Re-sorting the window on every call is unnecessary; the percentile moves slowly
+        if len(self._latencies) >= self.min_samples and (self._delay is None or self._samples_since_update >= 10):
+            ordered = sorted(self._latencies)
+            index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+            self._delay = max(self.min_delay, ordered[index])
+            self._samples_since_update = 0
+
+    async def run(self, attempt: Callable[[], Awaitable[T]], accept: Optional[Callable[[T], bool]] = None) -> T:
+        """
+        Runs `attempt`, starting a second one if the first is slow and the budget allows it.
+        Returns the first successful result that `accept` (if given) accepts, else the first
+        successful result; raises only if every attempt failed.
+        """
+        if not self.enabled:
+            return await attempt()
+        self._credits = min(_MAX_CREDITS, self._credits + self.budget)
+        delay = self._delay
+        started = time.monotonic()
+        tasks = {asyncio.ensure_future(attempt())}
+        hedge = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self._credits >= 1:
+                    self._credits -= 1
+                    HEDGES.inc("issued")
+                    hedge = asyncio.ensure_future(attempt())
+                    tasks.add(hedge)
+            error: Optional[BaseException] = None
+            rejected: List[Tuple[asyncio.Future, float]] = []
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if accept is not None and not accept(task.result()):
+                            rejected.append((task, time.monotonic() - started))
+                            continue
+                        return self._won(task, hedge, time.monotonic() - started)
+                    error = error or task.exception()
+            if rejected:
+                # No answer passed the check: the first one is returned for the caller to deal with
+                task, latency = rejected[0]
+                return self._won(task, hedge, latency)
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _won(self, task: "asyncio.Future[T]", hedge: Optional[asyncio.Future], latency: float) -> T:
+        self._record(latency)
+        if hedge is not None:
+            HEDGES.inc("won" if task is hedge else "lost")
+        return task.result()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "delay": self._delay, "samples": len(self._latencies)}
+
+
+hedger = Hedger(
+    enabled=HEDGING_ENABLED,
+    percentile=HEDGE_PERCENTILE,
+    budget=HEDGE_BUDGET,
+    min_samples=HEDGE_MIN_SAMPLES,
+    window=HEDGE_WINDOW,
+    min_delay=HEDGE_MIN_DELAY,
+)
+Gauge("specter_hedge_delay_seconds", "Current latency after which a call is hedged (0 = not yet known).",
+      lambda: hedger._delay or 0)
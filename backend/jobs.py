@@ -0,0 +1,241 @@
+# jobs.py
+"""
+Persistent job queue for whole-document analysis.
+
+Batch requests can be submitted as jobs instead of being analyzed within one
+HTTP request. Job state and every finished paragraph are stored in SQLite, so
+partial results can be polled while a job runs and unfinished jobs are resumed
+(only their pending paragraphs) after a process restart. A pool of background
+asyncio workers drains the queue. Every write is committed (job progress must
+survive a restart), so the workers make their writes from a worker thread
+instead of blocking the event loop.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from sqlite_store import connect
+
+JOBS_DB = os.getenv("JOBS_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.sqlite3"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+# Turns a batch request dict into units of work for its paragraphs except the finished
+# ones (a set of paragraphIndex). Each unit resolves to a list of result entries
+# ({"paragraphIndex": ..., ...} or {"paragraphIndex": ..., "error": ...})
+BatchRunner = Callable[[Dict[str, Any], Set[int]], List[Awaitable[List[Dict[str, Any]]]]]
+
+
+class JobStore:
+    def __init__(self, db_path: str):
+        self._db = connect(db_path)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    request TEXT NOT NULL,
+                    total INTEGER NOT NULL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+                CREATE TABLE IF NOT EXISTS job_results (
+                    job_id TEXT NOT NULL,
+                    paragraph_index INTEGER NOT NULL,
+                    failed INTEGER NOT NULL,
+                    result TEXT NOT NULL,
+                    PRIMARY KEY (job_id, paragraph_index)
+                );
+                """
+            )
+            self._db.commit()
+
+    def create(self, request: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, status, request, total, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(request, ensure_ascii=False), len(request.get("items", [])), now, now),
+            )
+            self._db.commit()
+        return job_id
+
+    def set_status(self, job_id: str, status: str, error: Optional[str] = None,
+                   only_if: Optional[List[str]] = None) -> bool:
+        query = "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?"
+        params: List[Any] = [status, error, time.time(), job_id]
+        if only_if:
+            query += " AND status IN (%s)" % ",".join("?" * len(only_if))
+            params.extend(only_if)
+        with self._lock:
+            changed = self._db.execute(query, params).rowcount
+            self._db.commit()
+        return changed > 0
+
+    def claim_next(self) -> Optional[str]:
+        """
+        Marks the oldest queued job as running and returns its id.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?", (RUNNING, time.time(), row[0])
+            )
+            self._db.commit()
+        return row[0]
+
+    def requeue_running(self) -> int:
+        """
+        Puts jobs that were running when the process stopped back in the queue.
+        """
+        with self._lock:
+            count = self._db.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE status = ?", (QUEUED, time.time(), RUNNING)
+            ).rowcount
+            self._db.commit()
+        return count
+
+    def count(self, status: str) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def save_results(self, job_id: str, entries: List[Dict[str, Any]]) -> None:
+        """
+        Stores the result entries of one unit of work (a paragraph or a pack) in one transaction.
+        """
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO job_results (job_id, paragraph_index, failed, result) VALUES (?, ?, ?, ?)",
+                [
+                    (job_id, entry["paragraphIndex"], int("error" in entry), json.dumps(entry, ensure_ascii=False))
+                    for entry in entries
+                ],
+            )
+            self._db.commit()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, request, total, error, created_at, updated_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            results = self._db.execute(
+                "SELECT paragraph_index, failed, result FROM job_results WHERE job_id = ?", (job_id,)
+            ).fetchall()
+        return {
+            "jobId": job_id,
+            "status": row[0],
+            "request": json.loads(row[1]),
+            "total": row[2],
+            "error": row[3],
+            "createdAt": row[4],
+            "updatedAt": row[5],
+            "completed": len(results),
+            "failed": sum(failed for _, failed, _ in results),
+            "results": {paragraph_index: json.loads(result) for paragraph_index, _, result in results},
+        }
+
+
+class JobQueue:
+    def __init__(self, store: JobStore, run_batch: BatchRunner, workers: int = JOB_WORKERS,
+                 poll_interval: float = JOB_POLL_INTERVAL):
+        self.store = store
+        self.run_batch = run_batch
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._worker_tasks: List[asyncio.Task] = []
+        self._running_jobs: Dict[str, asyncio.Task] = {}
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self.store.requeue_running)
+        self._wakeup = asyncio.Event()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(max(1, self.workers))]
+        self._wakeup.set()
+
+    async def stop(self) -> None:
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        # Jobs interrupted here stay "running" in the database and are requeued on the next start
+
+    async def submit(self, request: Dict[str, Any]) -> str:
+        job_id = await asyncio.to_thread(self.store.create, request)
+        self._wakeup.set()
+        return job_id
+
+    async def cancel(self, job_id: str) -> bool:
+        cancelled = await asyncio.to_thread(self.store.set_status, job_id, CANCELLED, only_if=[QUEUED, RUNNING])
+        task = self._running_jobs.get(job_id)
+        if cancelled and task is not None:
+            task.cancel()
+        return cancelled
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await asyncio.to_thread(self.store.claim_next)
+            if job_id is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Let the other idle workers look for more work as well
+            self._wakeup.set()
+            task = asyncio.create_task(self._run_job(job_id))
+            self._running_jobs[job_id] = task
+            try:
+                # wait() does not re-raise when only the job was cancelled through cancel()
+                await asyncio.wait({task})
+            except asyncio.CancelledError:
+                # The worker itself is being stopped
+                task.cancel()
+                await asyncio.wait({task})
+                raise
+            finally:
+                self._running_jobs.pop(job_id, None)
+
+    async def _run_job(self, job_id: str) -> None:
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None:
+            return
+        try:
+            # Only analyze paragraphs without a stored result, so resumed jobs continue where they stopped.
+            # The runner still gets the whole request, which describes the whole document
+            finished = set(job["results"])
+            pending = [item for item in job["request"].get("items", []) if item["paragraphIndex"] not in finished]
+            tasks = [asyncio.ensure_future(unit) for unit in self.run_batch(job["request"], finished)] if pending else []
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    entries = await next_done
+                    await asyncio.to_thread(self.store.save_results, job_id, entries)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            await asyncio.to_thread(self.store.set_status, job_id, DONE, only_if=[RUNNING])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await asyncio.to_thread(self.store.set_status, job_id, FAILED, error=str(e), only_if=[RUNNING])
@@ -1,15 +1,54 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from typing import Awaitable, Collection, Dict, List, Optional, Tuple, Union
+import asyncio
 import os
-import requests
-from clause_analysis import analyze_clause_change, analyze_clause_change_for_changes_response, ClauseAnalysisResponse
+import time
+import uuid
+import httpx
+from analysis_cache import analysis_cache
+from clause_analysis import analysis_flights, analysis_namespace, analyze_clause_change, analyze_clause_change_for_changes_response, analyze_clause_pack, ClauseAnalysisResponse
+from gemini_client import close_client, generate_content, provider_pool, upstream_stats
+from context_cache import context_cache
+from deadlines import (
+    DEADLINE_HEADER, REQUESTS_CANCELLED, ClientDisconnected, Deadline, DeadlineExceeded, cancel_on_disconnect,
+    parse_deadline, run_with_deadline,
+)
+from document_store import document_store, paragraph_fingerprint
+from docx_ingest import DOCX_MAX_BYTES, DocxError, DocxTooLarge, iter_tracked_paragraphs
+from hedging import hedger
+from jobs import JOBS_DB, QUEUED, JobQueue, JobStore
+from metrics import BATCH_IN_FLIGHT, BATCH_QUEUE_DEPTH, BATCH_QUEUE_WAIT, CONTENT_TYPE, Gauge, render_metrics
+from near_duplicate import near_duplicate_index
+from packing import pack_items
+from profiling import ProfilingMiddleware, traced
+from routing import routing_stats
+from scheduler import BATCH, INTERACTIVE, run_as
+from serialization import FastJSONResponse, ndjson_line
+from triage import triage_stats
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Resume unfinished analysis jobs and start the background workers
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    # Wait for the cache and document writes still queued for their writer threads
+    analysis_cache.flush()
+    near_duplicate_index.flush()
+    document_store.flush()
+    # Delete the cached prompt prefix and release pooled upstream connections on shutdown
+    await context_cache.close()
+    await close_client()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # CORS middleware to allow requests from the frontend
 app.add_middleware(
@@ -18,12 +57,36 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the add-in read the name of the trace file of a profiled request
+    expose_headers=["X-Profile-Trace"],
 )
+# Opt-in per-request profiling (see profiling.py)
+app.add_middleware(ProfilingMiddleware)
 
-# Google AI API (Gemini-pro) configuration
+# Maximum number of paragraphs of one batch request analyzed at the same time
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-GOOGLE_API_URL_BASE = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-lite:generateContent"
+# Status for requests whose client disconnected before the response (nginx's "client closed request")
+CLIENT_CLOSED_REQUEST = 499
+
+def _client_id(http_request: Request) -> str:
+    return http_request.client.host if http_request.client else "unknown"
+
+async def _serve(http_request: Request, work: Awaitable, deadline: Optional[Deadline] = None):
+    """
+    Runs the work of a request within its deadline (see deadlines.py), cancelling it
+    together with its upstream calls if the client disconnects first.
+    """
+    if deadline is None:
+        deadline = parse_deadline(http_request.headers.get(DEADLINE_HEADER))
+    try:
+        return await cancel_on_disconnect(http_request.receive, run_with_deadline(work, deadline))
+    except ClientDisconnected:
+        # Nobody reads this response any more
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    finally:
+        if deadline is not None:
+            deadline.close()
 
 class ClauseAnalysisRequest(BaseModel):
     text: str
@@ -32,19 +95,14 @@ class ClauseSuggestion(BaseModel):
     suggestions: List[str]
 
 @app.post("/analyze-clause", response_model=ClauseSuggestion)
-def analyze_clause(request: ClauseAnalysisRequest):
-    if not GOOGLE_API_KEY:
+async def analyze_clause(request: ClauseAnalysisRequest, http_request: Request):
+    if not provider_pool.members:
         raise HTTPException(status_code=500, detail="Google API key not configured.")
     prompt = f"Analyze the following legal clause and suggest improvements or better alternatives. Return a list of suggestions.\n\nClause: {request.text}"
-    payload = {
-        "contents": [{"parts": [{"text": prompt}]}]
-    }
-    headers = {"Content-Type": "application/json"}
-    params = {"key": GOOGLE_API_KEY}
     try:
-        response = requests.post(GOOGLE_API_URL_BASE, json=payload, headers=headers, params=params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        data = await _serve(http_request, run_as(generate_content(prompt, timeout=30), INTERACTIVE, _client_id(http_request)))
+        if isinstance(data, Response):
+            return data
         # Extract suggestions from the response
         suggestions = []
         candidates = data.get("candidates", [])
@@ -57,8 +115,10 @@ def analyze_clause(request: ClauseAnalysisRequest):
         if not suggestions:
             raise HTTPException(status_code=502, detail="No suggestions returned from Gemini API.")
         return ClauseSuggestion(suggestions=suggestions)
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=f"Error communicating with Gemini API: {str(e)}")
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
 
 class ChangeLogItem(BaseModel):
     type: str
@@ -71,6 +131,14 @@ class AnalyzeChangesRequest(BaseModel):
     # Optionally allow paragraph_id for output
     paragraph_id: Optional[str] = None
 
+def build_change_json(paragraph: str, changelog: List[ChangeLogItem], paragraph_id: Optional[str] = None) -> dict:
+    return {
+        "paragraph_id": paragraph_id,
+        "original_text": paragraph,  # For now, use the input as both original and modified
+        "modified_text": paragraph,  # In real use, this would be the modified text
+        "changes": [{"type": c.type, "description": c.text} for c in changelog]
+    }
+
 class ChangeSummary(BaseModel):
     type: str
     description: str
@@ -81,19 +149,22 @@ class AnalyzeChangesResponse(BaseModel):
     modified_text: str
     changes: List[ChangeSummary]
 
-@app.post("/analyze_changes", response_model=ClauseAnalysisResponse)
-def analyze_changes(request: AnalyzeChangesRequest):
-    change_json = {
-        "paragraph_id": request.paragraph_id,
-        "original_text": request.paragraph,  # For now, use the input as both original and modified
-        "modified_text": request.paragraph,  # In real use, this would be the modified text
-        "changes": [{"type": c.type, "description": c.text} for c in request.changelog]
-    }
+def _analysis_error(e: Exception) -> HTTPException:
+    if isinstance(e, DeadlineExceeded):
+        return HTTPException(status_code=504, detail=str(e))
+    return HTTPException(status_code=502, detail=f"Error in clause analysis: {str(e)}")
+
+@traced("analyze_changes")
+async def _analyze_change_json(change_json: dict) -> ClauseAnalysisResponse:
     try:
-        result = analyze_clause_change_for_changes_response(change_json)
-        return result
+        return await analyze_clause_change_for_changes_response(change_json)
     except Exception as e:
-        raise HTTPException(status_code=502, detail=f"Error in clause analysis: {str(e)}")
+        raise _analysis_error(e)
+
+@app.post("/analyze_changes", response_model=ClauseAnalysisResponse)
+async def analyze_changes(request: AnalyzeChangesRequest, http_request: Request):
+    change_json = build_change_json(request.paragraph, request.changelog, request.paragraph_id)
+    return await _serve(http_request, _analyze_change_json(change_json))
 
 class AnalyzeChangesBatchItem(BaseModel):
     paragraphIndex: int
@@ -102,43 +173,291 @@ class AnalyzeChangesBatchItem(BaseModel):
 
 class AnalyzeChangesBatchRequest(BaseModel):
     items: List[AnalyzeChangesBatchItem]
+    # Analyze several paragraphs per LLM call (see packing.py)
+    packed: bool = False
+    # Identifies the document for incremental re-analysis (see document_store.py)
+    documentId: Optional[str] = None
+    # Time budget in seconds; overrides the X-Request-Deadline header (see deadlines.py)
+    deadlineSeconds: Optional[float] = None
+
+class AnalyzeChangesBatchResult(ClauseAnalysisResponse):
+    paragraphIndex: int
+    # Set when the result was reused from a previous run of the same document
+    unchanged: Optional[bool] = None
+
+class AnalyzeChangesBatchError(BaseModel):
+    paragraphIndex: int
+    error: str
 
 class AnalyzeChangesBatchResponse(BaseModel):
-    results: List[AnalyzeChangesResponse]
+    # Keyed by paragraphIndex
+    results: Dict[int, Union[AnalyzeChangesBatchResult, AnalyzeChangesBatchError]]
+
+def _batch_error_entry(paragraph_index: int, e: Exception) -> dict:
+    return {
+        "paragraphIndex": paragraph_index,
+        "error": str(e)
+    }
+
+@asynccontextmanager
+async def _batch_slot(semaphore: asyncio.Semaphore):
+    """
+    Holds one of the batch's concurrency slots, tracking queue depth and concurrency in /metrics.
+    """
+    BATCH_QUEUE_DEPTH.inc()
+    try:
+        with BATCH_QUEUE_WAIT.time():
+            await semaphore.acquire()
+    finally:
+        BATCH_QUEUE_DEPTH.dec()
+    BATCH_IN_FLIGHT.inc()
+    try:
+        yield
+    finally:
+        BATCH_IN_FLIGHT.dec()
+        semaphore.release()
+
+async def _analyze_batch_item(item: AnalyzeChangesBatchItem, semaphore: asyncio.Semaphore) -> List[dict]:
+    try:
+        async with _batch_slot(semaphore):
+            # The item was validated with the batch request; no need to build an AnalyzeChangesRequest
+            single_result = await _analyze_change_json(build_change_json(item.paragraph, item.changelog))
+        # Attach paragraphIndex for client reference
+        return [{**single_result.model_dump(), "paragraphIndex": item.paragraphIndex}]
+    except Exception as e:
+        return [_batch_error_entry(item.paragraphIndex, e)]
+
+async def _analyze_batch_pack(pack: List[Tuple[int, dict]], semaphore: asyncio.Semaphore) -> List[dict]:
+    try:
+        async with _batch_slot(semaphore):
+            pack_results = await analyze_clause_pack(pack)
+    except Exception as e:
+        return [_batch_error_entry(paragraph_index, _analysis_error(e)) for paragraph_index, _ in pack]
+    entries = []
+    for paragraph_index, _ in pack:
+        result = pack_results[paragraph_index]
+        if isinstance(result, Exception):
+            entries.append(_batch_error_entry(paragraph_index, _analysis_error(result)))
+        else:
+            entries.append({**result.model_dump(), "paragraphIndex": paragraph_index})
+    return entries
+
+async def _resolved(entries: List[dict]) -> List[dict]:
+    return entries
+
+async def _store_document_entries(unit: Awaitable[List[dict]], document_id: str, fingerprints: dict) -> List[dict]:
+    entries = await unit
+    for entry in entries:
+        # Failed paragraphs are not stored so that they are analyzed again next time
+        if "error" not in entry:
+            document_store.save(document_id, fingerprints[entry["paragraphIndex"]], entry)
+    return entries
+
+def _batch_work(request: AnalyzeChangesBatchRequest, client: Optional[str] = None,
+                finished: Collection[int] = ()) -> List[Awaitable[List[dict]]]:
+    """
+    Splits a batch into units of work (single paragraphs, or packs in packed mode), bounded by
+    BATCH_CONCURRENCY. Each unit resolves to the result entries of its paragraphs and never raises:
+    a failing paragraph only produces an error entry for its own paragraphIndex.
+    With a documentId, paragraphs analyzed in a previous run of the same document are answered
+    from the document store and only changed paragraphs become units of work.
+    Paragraphs in `finished` (a resumed job's paragraphs that already have a result) are skipped,
+    but still count as part of the document, so their stored results are kept.
+    Upstream calls are scheduled as batch work of the document (or else the client), see scheduler.py.
+    """
+    semaphore = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+    items = request.items
+    unchanged = []
+    if request.documentId:
+        namespace = analysis_namespace()
+        fingerprints = {
+            item.paragraphIndex: paragraph_fingerprint(build_change_json(item.paragraph, item.changelog), namespace)
+            for item in items
+        }
+        stored = document_store.results(request.documentId)
+        document_store.retain(request.documentId, fingerprints.values())
+        unchanged = [
+            {**stored[fingerprints[item.paragraphIndex]], "paragraphIndex": item.paragraphIndex, "unchanged": True}
+            for item in items if fingerprints[item.paragraphIndex] in stored
+        ]
+        items = [item for item in items if fingerprints[item.paragraphIndex] not in stored]
+    if finished:
+        unchanged = [entry for entry in unchanged if entry["paragraphIndex"] not in finished]
+        items = [item for item in items if item.paragraphIndex not in finished]
+    if request.packed:
+        packs = pack_items([
+            (item.paragraphIndex, build_change_json(item.paragraph, item.changelog)) for item in items
+        ])
+        units = [_analyze_batch_pack(pack, semaphore) for pack in packs]
+    else:
+        units = [_analyze_batch_item(item, semaphore) for item in items]
+    if request.documentId:
+        units = [_store_document_entries(unit, request.documentId, fingerprints) for unit in units]
+        if unchanged:
+            units.append(_resolved(unchanged))
+    flow = request.documentId or client or uuid.uuid4().hex
+    return [run_as(unit, BATCH, flow) for unit in units]
 
 @app.post("/analyze_changes_batch", response_model=AnalyzeChangesBatchResponse)
-def analyze_changes_batch(request: AnalyzeChangesBatchRequest):
+@traced("analyze_changes_batch")
+async def analyze_changes_batch(request: AnalyzeChangesBatchRequest, http_request: Request):
+    # Analyze all paragraphs concurrently
+    deadline = parse_deadline(http_request.headers.get(DEADLINE_HEADER), request.deadlineSeconds)
+    units = _batch_work(request, _client_id(http_request))
+
+    async def analyze_all() -> List[List[dict]]:
+        # Started within _serve, so that the units run under the request's deadline
+        return await asyncio.gather(*units)
+
+    unit_results = await _serve(http_request, analyze_all(), deadline)
+    if isinstance(unit_results, Response):
+        return unit_results
+    entries = {}
+    for unit_entries in unit_results:
+        for entry in unit_entries:
+            entries[entry["paragraphIndex"]] = entry
     results = {}
     for item in request.items:
+        results[item.paragraphIndex] = entries[item.paragraphIndex]
+    # The entries come from validated models: serialize them directly instead of validating
+    # them again against the response_model (see serialization.py)
+    return FastJSONResponse({"results": results})
+
+def _batch_stream(request: AnalyzeChangesBatchRequest, client: Optional[str] = None,
+                  deadline: Optional[Deadline] = None) -> StreamingResponse:
+    """
+    Streams one NDJSON record per paragraph as soon as its analysis (or error) is available,
+    followed by a final {"summary": {...}} record. Paragraphs not analyzed within the deadline
+    get error records; when the client disconnects, the remaining work is cancelled.
+    """
+    async def records():
+        started = time.monotonic()
+        # All units share the deadline of the stream
+        tasks = [asyncio.ensure_future(run_with_deadline(unit, deadline)) for unit in _batch_work(request, client)]
+        failed = 0
+        finished = False
         try:
-            single_result = analyze_changes(
-                AnalyzeChangesRequest(paragraph=item.paragraph, changelog=item.changelog)
-            )
-            # Attach paragraphIndex for client reference
-            if hasattr(single_result, 'dict'):
-                result_dict = single_result.dict()
-            else:
-                result_dict = dict(single_result)
-            result_dict["paragraphIndex"] = item.paragraphIndex
-            results[item.paragraphIndex] = result_dict
-        except Exception as e:
-            results[item.paragraphIndex] = {
-                "paragraphIndex": item.paragraphIndex,
-                "error": str(e)
-            }
-    return {"results": results}
+            for next_done in asyncio.as_completed(tasks):
+                for entry in await next_done:
+                    if "error" in entry:
+                        failed += 1
+                    yield ndjson_line(entry)
+            yield ndjson_line({"summary": {
+                "total": len(request.items),
+                "succeeded": len(request.items) - failed,
+                "failed": failed,
+                "concurrency": BATCH_CONCURRENCY,
+                "elapsedSeconds": round(time.monotonic() - started, 3),
+            }})
+            finished = True
+        finally:
+            # The client went away or the stream finished: stop any remaining work
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+            if not finished and pending:
+                REQUESTS_CANCELLED.inc("disconnect")
+            if deadline is not None:
+                deadline.close()
 
-@app.post("/analyze_clause_changes", response_model=ClauseAnalysisResponse)
-def analyze_clause_changes(request: AnalyzeChangesRequest):
-    change_json = {
-        "paragraph_id": request.paragraph_id,
-        "original_text": request.paragraph,  # For now, use the input as both original and modified
-        "modified_text": request.paragraph,  # In real use, this would be the modified text
-        "changes": [{"type": c.type, "description": c.text} for c in request.changelog]
-    }
+    return StreamingResponse(records(), media_type="application/x-ndjson")
+
+@app.post("/analyze_changes_batch/stream")
+async def analyze_changes_batch_stream(request: AnalyzeChangesBatchRequest, http_request: Request):
+    deadline = parse_deadline(http_request.headers.get(DEADLINE_HEADER), request.deadlineSeconds)
+    return _batch_stream(request, _client_id(http_request), deadline)
+
+def _docx_batch_request(file: UploadFile, packed: bool, document_id: Optional[str]) -> AnalyzeChangesBatchRequest:
+    # The upload is spooled before the endpoint runs, but it is not parsed if too large
+    size = file.size if file.size is not None else file.file.seek(0, os.SEEK_END)
+    file.file.seek(0)
+    if size > DOCX_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"The file is larger than {DOCX_MAX_BYTES} bytes.")
     try:
-        result = analyze_clause_change_for_changes_response(change_json)
-        return result
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f"Error in clause analysis: {str(e)}")
+        items = [AnalyzeChangesBatchItem(**paragraph) for paragraph in iter_tracked_paragraphs(file.file)]
+    except DocxTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except DocxError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return AnalyzeChangesBatchRequest(items=items, packed=packed, documentId=document_id)
+
+@app.post("/analyze_docx")
+async def analyze_docx(
+    http_request: Request,
+    file: UploadFile = File(...),
+    packed: bool = Form(False),
+    documentId: Optional[str] = Form(None),
+):
+    """
+    Extracts the tracked changes of an uploaded .docx (see docx_ingest.py) and streams their
+    analysis like /analyze_changes_batch/stream.
+    """
+    request = await run_in_threadpool(_docx_batch_request, file, packed, documentId)
+    return _batch_stream(request, _client_id(http_request), parse_deadline(http_request.headers.get(DEADLINE_HEADER)))
+
+job_store = JobStore(JOBS_DB)
+job_queue = JobQueue(job_store, lambda request, finished: _batch_work(AnalyzeChangesBatchRequest(**request), finished=finished))
+Gauge("specter_jobs_queued", "Background analysis jobs waiting for a worker.", lambda: job_store.count(QUEUED))
+
+# The job endpoints are async: the queue's wakeup event and running tasks belong to the event loop,
+# so they must not be touched from the threadpool sync endpoints run in
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: AnalyzeChangesBatchRequest):
+    if request.deadlineSeconds is not None:
+        # Jobs run in the background for as long as they need; poll or cancel them instead
+        raise HTTPException(status_code=400, detail="deadlineSeconds is not supported for jobs.")
+    job_id = await job_queue.submit(request.model_dump())
+    return {"jobId": job_id, "status": "queued"}
+
+@app.post("/jobs/docx", status_code=202)
+async def submit_docx_job(
+    file: UploadFile = File(...),
+    packed: bool = Form(False),
+    documentId: Optional[str] = Form(None),
+):
+    request = await run_in_threadpool(_docx_batch_request, file, packed, documentId)
+    job_id = await job_queue.submit(request.model_dump())
+    return {"jobId": job_id, "status": "queued", "paragraphs": len(request.items)}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await run_in_threadpool(job_queue.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    # Partial results are included while the job is still running
+    del job["request"]
+    return job
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = await run_in_threadpool(job_queue.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if not await job_queue.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Job is already {job['status']}.")
+    return {"jobId": job_id, "status": "cancelled"}
+
+@app.post("/analyze_clause_changes", response_model=ClauseAnalysisResponse)
+async def analyze_clause_changes(request: AnalyzeChangesRequest, http_request: Request):
+    change_json = build_change_json(request.paragraph, request.changelog, request.paragraph_id)
+    # A user is waiting on this clause: schedule it ahead of queued batch work
+    return await _serve(http_request, run_as(_analyze_change_json(change_json), INTERACTIVE, _client_id(http_request)))
+
+# The stats endpoints are async as well: they read the in-memory state (flights, schedulers, buckets,
+# metrics) that the event loop mutates, which is not safe to iterate from a threadpool thread.
+# Only the locked SQLite counts are left to the threadpool.
+
+@app.get("/cache_stats")
+async def cache_stats():
+    analysis = await run_in_threadpool(analysis_cache.stats)
+    return {**analysis, "single_flight": analysis_flights.stats(), "triage": triage_stats(),
+            "near_duplicates": near_duplicate_index.stats(), "context_cache": context_cache.stats()}
+
+@app.get("/upstream_stats")
+async def get_upstream_stats():
+    return {**upstream_stats(), "hedging": hedger.stats(), "routing": routing_stats()}
 
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type=CONTENT_TYPE)
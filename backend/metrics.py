@@ -0,0 +1,201 @@
+# metrics.py
+"""
+Minimal Prometheus instrumentation: counters, gauges and histograms rendered
+in the text exposition format on /metrics.
+
+Recording a sample is a dict lookup and an addition (plus a bisect for
+histograms), so the hot path stays cheap; all formatting happens when the
+endpoint is scraped.
+"""
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Seconds; upstream LLM calls take from a few hundred milliseconds to tens of seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.append(self)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down; `function`, if given, is called at scrape time instead.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation)
+        self.value = 0.0
+        self.function = function
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def render(self) -> List[str]:
+        value = self.function() if self.function is not None else self.value
+        return self.header() + [f"{self.name} {_format_value(value)}"]
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: "Histogram", labels: Tuple[str, ...]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "_Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: non-cumulative bucket counts (last one is +Inf), sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def time(self, *labels: str) -> _Timer:
+        """
+        Context manager that observes the duration of its block in seconds.
+        """
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+registry: List[_Metric] = []
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Clause analysis pipeline
+STAGE_SECONDS = Histogram(
+    "specter_stage_seconds",
+    "Time spent per clause analysis stage (prompt_assembly, upstream, json_extraction, validation).",
+    ["stage"],
+)
+PARSE_FAILURES = Counter(
+    "specter_parse_failures_total",
+    "Model responses that could not be turned into an analysis, by reason.",
+    ["reason"],
+)
+PACK_FALLBACKS = Counter(
+    "specter_pack_fallbacks_total",
+    "Paragraphs of packed calls analyzed individually instead, by reason (upstream_error, invalid, missing).",
+    ["reason"],
+)
+STORE_WRITE_ERRORS = Counter(
+    "specter_store_write_errors_total",
+    "Writes to the SQLite caches and indexes that failed and were dropped, by store.",
+    ["store"],
+)
+OUTPUT_REPAIRS = Counter(
+    "specter_output_repairs_total",
+    "Invalid model answers that were repaired, locally or with a repair prompt.",
+    ["method"],
+)
+
+# Upstream LLM calls
+UPSTREAM_RESPONSES = Counter(
+    "specter_upstream_responses_total",
+    "Upstream call attempts by HTTP status code (or transport_error / circuit_open).",
+    ["status"],
+)
+UPSTREAM_TOKENS = Counter(
+    "specter_upstream_tokens_total",
+    "Tokens reported in Gemini usageMetadata, by kind (prompt, cached, response).",
+    ["kind"],
+)
+
+# Batch endpoints
+BATCH_QUEUE_DEPTH = Gauge(
+    "specter_batch_queue_depth", "Batch work units waiting for a concurrency slot."
+)
+BATCH_IN_FLIGHT = Gauge(
+    "specter_batch_in_flight", "Batch work units currently being analyzed."
+)
+BATCH_QUEUE_WAIT = Histogram(
+    "specter_batch_queue_wait_seconds", "Time batch work units waited for a concurrency slot."
+)
@@ -0,0 +1,311 @@
+# mock_gemini.py
+"""
+Local stand-in for the Gemini `generateContent` API, for load tests that must
+not spend real quota.
+
+Run it next to the backend and point the backend at it:
+
+    uvicorn mock_gemini:app --port 8001
+    GEMINI_API_BASE=http://127.0.0.1:8001/v1beta GOOGLE_API_KEY=mock uvicorn main:app
+
+Latency follows a configurable distribution, a configurable fraction of calls
+fails with 429/5xx, and responses are either recorded ones (MOCK_RESPONSES, a
+JSON or JSONL file of raw generateContent responses, replayed round-robin) or
+canned answers shaped like what the backend expects for the prompt (a clause
+analysis, a packed array of analyses, or a list of suggestions). The settings
+can be changed at runtime with POST /mock/config.
+
+Explicit context caching (`cachedContents`) is emulated as well: cached text is
+prepended to the prompt, reported as cachedContentTokenCount, and excluded from
+the optional per-token latency (MOCK_LATENCY_PER_1K_PROMPT_TOKENS_MS).
+
+To test provider pools, a per-key quota (MOCK_QUOTA_RPM_PER_KEY) answers 429
+with a RetryInfo delay once a key exceeds its requests per minute, and an
+OpenAI-compatible POST /v1/chat/completions serves the same canned answers
+(point OPENAI_COMPAT_BASE_URLS at http://127.0.0.1:8001/v1).
+"""
+import asyncio
+import json
+import os
+import itertools
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from few_shot import estimate_tokens
+from packing import PACK_INSTRUCTIONS
+
+config: Dict[str, Any] = {
+    # fixed, uniform, exponential or lognormal
+    "latency_distribution": os.getenv("MOCK_LATENCY_DISTRIBUTION", "lognormal"),
+    # Median latency (mean for exponential, lower bound..2x for uniform)
+    "latency_ms": float(os.getenv("MOCK_LATENCY_MS", "800")),
+    "latency_sigma": float(os.getenv("MOCK_LATENCY_SIGMA", "0.5")),
+    "error_rate": float(os.getenv("MOCK_ERROR_RATE", "0")),
+    "error_statuses": [int(s) for s in os.getenv("MOCK_ERROR_STATUSES", "429,503").split(",") if s],
+    "responses_file": os.getenv("MOCK_RESPONSES", ""),
+    "seed": int(os.getenv("MOCK_SEED", "0")),
+    # Extra latency per 1000 uncached prompt tokens, to make prompt size visible in benchmarks
+    "latency_per_1k_prompt_tokens_ms": float(os.getenv("MOCK_LATENCY_PER_1K_PROMPT_TOKENS_MS", "0")),
+    "caching_supported": os.getenv("MOCK_CACHING_SUPPORTED", "1") == "1",
+    # Requests per minute allowed per API key (0 = unlimited)
+    "quota_rpm_per_key": float(os.getenv("MOCK_QUOTA_RPM_PER_KEY", "0")),
+}
+
+_rng = random.Random(config["seed"])
+_recorded: List[Dict[str, Any]] = []
+_recorded_position = 0
+stats = {"requests": 0, "errors": 0, "cached_requests": 0}
+requests_per_model: Dict[str, int] = {}
+requests_per_key: Dict[str, int] = {}
+# Per API key: times of the requests within the last minute
+_key_windows: Dict[str, Deque[float]] = {}
+_completion_ids = itertools.count(1)
+# cachedContents name -> (text, expiry as time.monotonic(), model)
+_cached_contents: Dict[str, tuple] = {}
+_cache_ids = itertools.count(1)
+
+CANNED_ANALYSIS = {
+    "clauseCategory": "Confidentiality Obligations",
+    "summary": "The change narrows the scope of the confidentiality obligation.",
+    "risksDisclosingParty": "Less information is protected.",
+    "risksReceivingParty": "None; the obligation is lighter.",
+    "improvementsDisclosingParty": "Restore the original scope.",
+    "improvementsReceivingParty": "Accept the change.",
+    "suggestedWording": "The Recipient shall keep the Confidential Information strictly confidential.",
+    "comments_on_changes": "Mock analysis.",
+}
+
+
+def _load_recorded(path: str) -> List[Dict[str, Any]]:
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        content = f.read().strip()
+    if content.startswith("["):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def _latency() -> float:
+    distribution = config["latency_distribution"]
+    median = config["latency_ms"] / 1000.0
+    if distribution == "fixed":
+        return median
+    if distribution == "uniform":
+        return _rng.uniform(median, 2 * median)
+    if distribution == "exponential":
+        return _rng.expovariate(1 / median) if median > 0 else 0.0
+    return _rng.lognormvariate(0, config["latency_sigma"]) * median
+
+
+def _analysis(clause: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "clauseIdentifier": "Mock clause",
+        "originalClauseText": str(clause.get("original_text") or ""),
+        "analysis": dict(CANNED_ANALYSIS),
+    }
+
+
+def _canned_text(prompt: str) -> str:
+    if PACK_INSTRUCTIONS in prompt:
+        try:
+            clauses = json.loads(prompt.rsplit(PACK_INSTRUCTIONS, 1)[1])
+        except ValueError:
+            clauses = []
+        analyses = [{**_analysis(clause), "paragraphIndex": clause.get("paragraphIndex")} for clause in clauses]
+        return "```json\n" + json.dumps(analyses) + "\n```"
+    if "'original_text'" in prompt or '"original_text"' in prompt:
+        return "```json\n" + json.dumps(_analysis({})) + "\n```"
+    return "- Define the term precisely.\n- Limit the obligation in time.\n- Add a carve-out for public information."
+
+
+def _response(prompt: str, cached_text: str = "") -> Dict[str, Any]:
+    global _recorded_position
+    if _recorded:
+        response = _recorded[_recorded_position % len(_recorded)]
+        _recorded_position += 1
+        return response
+    text = _canned_text(cached_text + prompt)
+    cached_tokens = estimate_tokens(cached_text) if cached_text else 0
+    prompt_tokens = cached_tokens + estimate_tokens(prompt)
+    output_tokens = estimate_tokens(text)
+    usage = {
+        "promptTokenCount": prompt_tokens,
+        "candidatesTokenCount": output_tokens,
+        "totalTokenCount": prompt_tokens + output_tokens,
+    }
+    if cached_tokens:
+        usage["cachedContentTokenCount"] = cached_tokens
+    return {
+        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}],
+        "usageMetadata": usage,
+    }
+
+
+def _error(status: int, message: str, reason: str, details: Optional[List[Dict[str, Any]]] = None) -> JSONResponse:
+    error: Dict[str, Any] = {"code": status, "message": message, "status": reason}
+    if details:
+        error["details"] = details
+    return JSONResponse(status_code=status, content={"error": error})
+
+
+def _quota_retry_delay(key: str) -> Optional[float]:
+    """
+    Counts a request against the key's quota; returns the seconds until the key may be used
+    again if it is exhausted.
+    """
+    requests_per_key[key] = requests_per_key.get(key, 0) + 1
+    limit = config["quota_rpm_per_key"]
+    if limit <= 0:
+        return None
+    now = time.monotonic()
+    window = _key_windows.setdefault(key, deque())
+    while window and window[0] <= now - 60:
+        window.popleft()
+    if len(window) >= limit:
+        return window[0] + 60 - now
+    window.append(now)
+    return None
+
+
+async def _simulate_upstream(prompt: str) -> Optional[int]:
+    """
+    Waits for the configured latency; returns an error status if this call should fail.
+    """
+    prompt_latency = estimate_tokens(prompt) / 1000 * config["latency_per_1k_prompt_tokens_ms"] / 1000
+    await asyncio.sleep(_latency() + prompt_latency)
+    if _rng.random() < config["error_rate"]:
+        stats["errors"] += 1
+        return _rng.choice(config["error_statuses"])
+    return None
+
+
+def _prompt_text(contents: List[Dict[str, Any]]) -> str:
+    return "".join(part.get("text", "") for content in contents for part in content.get("parts", []))
+
+
+def _ttl_seconds(ttl: str) -> float:
+    return float(ttl.rstrip("s")) if ttl else 3600.0
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _recorded[:] = _load_recorded(config["responses_file"])
+    yield
+
+app = FastAPI(title="Mock Gemini API", lifespan=lifespan)
+
+
+@app.post("/v1beta/models/{model}:generateContent")
+async def generate_content(model: str, request: Request):
+    stats["requests"] += 1
+    requests_per_model[model] = requests_per_model.get(model, 0) + 1
+    retry_delay = _quota_retry_delay(request.query_params.get("key", ""))
+    if retry_delay is not None:
+        return _error(429, "Resource has been exhausted (e.g. check quota).", "RESOURCE_EXHAUSTED",
+                      [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{retry_delay:.1f}s"}])
+    body = await request.json()
+    prompt = _prompt_text(body.get("contents", []))
+    cached_text = ""
+    if body.get("cachedContent"):
+        cached = _cached_contents.get(body["cachedContent"])
+        if cached is None or cached[1] < time.monotonic():
+            return _error(404, f"CachedContent not found: {body['cachedContent']}", "NOT_FOUND")
+        if cached[2] != f"models/{model}":
+            return _error(400, "Model used by GenerateContent request and CachedContent has to be the same.",
+                          "INVALID_ARGUMENT")
+        cached_text = cached[0]
+        stats["cached_requests"] += 1
+    status = await _simulate_upstream(prompt)
+    if status is not None:
+        return _error(status, "Mock upstream error", "UNAVAILABLE")
+    return _response(prompt, cached_text)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """
+    OpenAI-compatible endpoint, standing in for on-prem inference servers.
+    """
+    stats["requests"] += 1
+    body = await request.json()
+    model = body.get("model", "")
+    requests_per_model[model] = requests_per_model.get(model, 0) + 1
+    prompt = "".join(str(message.get("content") or "") for message in body.get("messages", []))
+    status = await _simulate_upstream(prompt)
+    if status is not None:
+        return JSONResponse(status_code=status, content={"error": {"message": "Mock upstream error", "code": status}})
+    response = _response(prompt)
+    text = "".join(_prompt_text([candidate.get("content", {}) for candidate in response.get("candidates", [])]))
+    usage = response.get("usageMetadata", {})
+    return {
+        "id": f"chatcmpl-mock-{next(_completion_ids)}",
+        "object": "chat.completion",
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": usage.get("promptTokenCount", 0),
+            "completion_tokens": usage.get("candidatesTokenCount", 0),
+            "total_tokens": usage.get("totalTokenCount", 0),
+        },
+    }
+
+
+@app.post("/v1beta/cachedContents")
+async def create_cached_content(request: Request):
+    if not config["caching_supported"]:
+        return _error(400, "Model does not support explicit caching.", "INVALID_ARGUMENT")
+    body = await request.json()
+    name = f"cachedContents/mock-{next(_cache_ids)}"
+    text = _prompt_text(body.get("contents", []))
+    _cached_contents[name] = (text, time.monotonic() + _ttl_seconds(body.get("ttl", "")), body.get("model"))
+    return {"name": name, "model": body.get("model"), "usageMetadata": {"totalTokenCount": estimate_tokens(text)}}
+
+
+@app.patch("/v1beta/cachedContents/{cache_id}")
+async def update_cached_content(cache_id: str, request: Request):
+    name = f"cachedContents/{cache_id}"
+    if name not in _cached_contents:
+        return _error(404, f"CachedContent not found: {name}", "NOT_FOUND")
+    body = await request.json()
+    text, _, model = _cached_contents[name]
+    _cached_contents[name] = (text, time.monotonic() + _ttl_seconds(body.get("ttl", "")), model)
+    return {"name": name}
+
+
+@app.delete("/v1beta/cachedContents/{cache_id}")
+def delete_cached_content(cache_id: str):
+    if _cached_contents.pop(f"cachedContents/{cache_id}", None) is None:
+        return _error(404, f"CachedContent not found: cachedContents/{cache_id}", "NOT_FOUND")
+    return {}
+
+
+@app.get("/mock/stats")
+def get_stats():
+    return {**stats, "models": requests_per_model, "keys": requests_per_key, "cached_contents": len(_cached_contents), "config": config}
+
+
+@app.post("/mock/config")
+def update_config(changes: Dict[str, Any]):
+    """
+    Updates settings for the following calls, e.g. {"error_rate": 0.1, "latency_ms": 200}.
+    Passing "seed" restarts the random sequence; "responses_file" reloads the recorded responses.
+    """
+    global _rng, _recorded_position
+    config.update(changes)
+    if "seed" in changes:
+        _rng = random.Random(config["seed"])
+    if "responses_file" in changes:
+        _recorded[:] = _load_recorded(config["responses_file"])
+        _recorded_position = 0
+    stats["requests"] = stats["errors"] = stats["cached_requests"] = 0
+    requests_per_model.clear()
+    requests_per_key.clear()
+    _key_windows.clear()
+    return config
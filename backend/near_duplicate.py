@@ -0,0 +1,251 @@
+# near_duplicate.py
+"""
+Near-duplicate clause index for reusing prior analyses.
+
+NDAs repeat the same boilerplate with only party names or addresses changed.
+Every analyzed clause is summarized as a MinHash signature over word 3-gram
+shingles and indexed with banded locality-sensitive hashing (LSH). A new clause
+whose text and changelog are both within the similarity threshold of a stored
+one, and whose changes add or remove the same negations, modal verbs and
+numbers, is answered with the stored analysis, marked as reused. Lookups only touch
+the few LSH buckets of the query, so their cost does not grow with the index.
+"""
+import hashlib
+import json
+import operator
+import os
+import random
+import re
+import sqlite3
+import threading
+from array import array
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from sqlite_store import StoreWriter, connect
+
+NEAR_DUP_ENABLED = os.getenv("NEAR_DUP_ENABLED", "1") == "1"
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.8"))
+NEAR_DUP_MAX_ENTRIES = int(os.getenv("NEAR_DUP_MAX_ENTRIES", "200000"))
+# Set NEAR_DUP_DB to an empty string to keep the index in memory only
+NEAR_DUP_DB = os.getenv(
+    "NEAR_DUP_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "near_duplicates.sqlite3")
+)
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+# Bounds the number of candidates compared per bucket for very common boilerplate
+MAX_BUCKET_SIZE = 16
+
+# Clauses this short are left to the exact-match cache; their signatures are too coarse
+MIN_WORDS = int(os.getenv("NEAR_DUP_MIN_WORDS", "12"))
+
+_WORD = re.compile(r"\w+")
+# Words that flip or shift an obligation; changes to them must match exactly for an analysis to be reused
+_MATERIAL_WORDS = frozenset({
+    "not", "no", "never", "nor", "neither", "none", "without", "except", "unless", "cannot",
+    "shall", "must", "may", "will", "should", "can", "might",
+})
+_BIN_BITS = NUM_PERM.bit_length() - 1
+_EMPTY = 1 << 64
+# Fixed per-bin probe orders so densified signatures stay comparable across restarts
+_PROBES = [random.Random(0x5EED + i).sample(range(NUM_PERM), NUM_PERM) for i in range(NUM_PERM)]
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def shingles(text: str) -> List[str]:
+    words = _WORD.findall(text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return [" ".join(words)] if words else []
+    return [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+
+
+def minhash(text: str) -> Optional[array]:
+    """
+    One-permutation MinHash: each shingle hash is routed to one of NUM_PERM bins by its low
+    bits and every bin keeps its minimum, so the signature costs one pass over the shingles.
+    Empty bins are densified by copying the first non-empty bin of their own fixed random
+    probe order, which keeps the similarity estimate unbiased.
+    """
+    words = _WORD.findall(text.lower())
+    if len(words) < MIN_WORDS:
+        return None
+    hashes = {_hash64(s) for s in shingles(text)}
+    bins = [_EMPTY] * NUM_PERM
+    for h in hashes:
+        slot = h & (NUM_PERM - 1)
+        value = h >> _BIN_BITS
+        if value < bins[slot]:
+            bins[slot] = value
+    if _EMPTY in bins:
+        filled = list(bins)
+        for i in range(NUM_PERM):
+            if filled[i] == _EMPTY:
+                bins[i] = next(filled[j] for j in _PROBES[i] if filled[j] != _EMPTY)
+    return array("Q", bins)
+
+
+def changelog_tokens(change_json: Dict[str, Any]) -> FrozenSet[str]:
+    tokens = set()
+    for change in change_json.get("changes", []):
+        change_type = str(change.get("type") or "").lower()
+        tokens.update(f"{change_type}:{word}" for word in _WORD.findall(str(change.get("description") or "").lower()))
+    return frozenset(tokens)
+
+
+def material_tokens(changes: FrozenSet[str]) -> FrozenSet[str]:
+    """
+    The changelog tokens (see changelog_tokens) of negations, modal verbs and numbers.
+    """
+    return frozenset(
+        token for token in changes
+        if token.split(":", 1)[-1] in _MATERIAL_WORDS or any(ch.isdigit() for ch in token)
+    )
+
+
+def _jaccard(first: FrozenSet[str], second: FrozenSet[str]) -> float:
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+def _band_keys(signature: array) -> List[int]:
+    return [hash(tuple(signature[b * ROWS:(b + 1) * ROWS])) for b in range(BANDS)]
+
+
+class _Entry:
+    __slots__ = ("namespace", "signature", "changes", "material", "analysis", "row_id")
+
+    def __init__(self, namespace: str, signature: array, changes: FrozenSet[str], analysis: Optional[str],
+                 row_id: Optional[int] = None):
+        self.namespace = namespace
+        self.signature = signature
+        self.changes = changes
+        self.material = material_tokens(changes)
+        # Kept in memory while there is no database row to load it from
+        self.analysis = analysis
+        # Assigned by SQLite; other processes may add rows to the same database
+        self.row_id = row_id
+
+
+class NearDuplicateIndex:
+    def __init__(self, threshold: float = 0.8, db_path: Optional[str] = None, max_entries: int = 200000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries: List[_Entry] = []
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in range(BANDS)]
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._writer: Optional[StoreWriter] = None
+        self.lookups = 0
+        self.reused = 0
+        if db_path:
+            self._db = connect(db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS near_duplicates "
+                "(id INTEGER PRIMARY KEY, namespace TEXT NOT NULL, signature BLOB NOT NULL, "
+                "changes TEXT NOT NULL, analysis TEXT NOT NULL)"
+            )
+            self._db.commit()
+            self._writer = StoreWriter("near_duplicates", db_path, self._db, self._lock)
+            for row_id, namespace, signature, changes in self._db.execute(
+                "SELECT id, namespace, signature, changes FROM near_duplicates ORDER BY id"
+            ):
+                self._insert(_Entry(namespace, array("Q", signature), frozenset(json.loads(changes)), None, row_id))
+
+    def _insert(self, entry: _Entry) -> int:
+        entry_id = len(self._entries)
+        self._entries.append(entry)
+        for bucket, key in zip(self._buckets, _band_keys(entry.signature)):
+            members = bucket.setdefault(key, [])
+            if len(members) < MAX_BUCKET_SIZE:
+                members.append(entry_id)
+        return entry_id
+
+    def _best_match(self, namespace: str, signature: array, changes: FrozenSet[str]) -> Optional[Tuple[float, int]]:
+        candidates = set()
+        for bucket, key in zip(self._buckets, _band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        best = None
+        material = material_tokens(changes)
+        for entry_id in candidates:
+            entry = self._entries[entry_id]
+            if entry.namespace != namespace or entry.material != material:
+                continue
+            text_similarity = sum(map(operator.eq, signature, entry.signature)) / NUM_PERM
+            if text_similarity < self.threshold:
+                continue
+            similarity = min(text_similarity, _jaccard(changes, entry.changes))
+            if similarity >= self.threshold and (best is None or similarity > best[0]):
+                best = (similarity, entry_id)
+        return best
+
+    def lookup(self, namespace: str, change_json: Dict[str, Any]) -> Optional[Tuple[float, Dict[str, Any]]]:
+        """
+        Returns (similarity, stored analysis) for the closest stored clause above the threshold.
+        """
+        signature = minhash(str(change_json.get("original_text") or ""))
+        if signature is None:
+            return None
+        with self._lock:
+            self.lookups += 1
+            best = self._best_match(namespace, signature, changelog_tokens(change_json))
+            if best is None:
+                return None
+            similarity, entry_id = best
+            entry = self._entries[entry_id]
+            if entry.analysis is not None:
+                analysis = entry.analysis
+            else:
+                analysis = self._db.execute(
+                    "SELECT analysis FROM near_duplicates WHERE id = ?", (entry.row_id,)
+                ).fetchone()[0]
+            self.reused += 1
+        return similarity, json.loads(analysis)
+
+    def add(self, namespace: str, change_json: Dict[str, Any], analysis: Dict[str, Any]) -> None:
+        signature = minhash(str(change_json.get("original_text") or ""))
+        if signature is None:
+            return
+        changes = changelog_tokens(change_json)
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                return
+            best = self._best_match(namespace, signature, changes)
+            if best is not None and best[0] >= 1.0:
+                # An equivalent clause is already indexed
+                return
+            entry = _Entry(namespace, signature, changes, json.dumps(analysis, ensure_ascii=False))
+            self._insert(entry)
+            if self._writer is not None:
+                row = (namespace, signature.tobytes(), json.dumps(sorted(changes), ensure_ascii=False), entry.analysis)
+                self._writer.submit(
+                    lambda db: db.execute(
+                        "INSERT INTO near_duplicates (namespace, signature, changes, analysis) VALUES (?, ?, ?, ?)", row
+                    ).lastrowid,
+                    lambda row_id: self._stored(entry, row_id),
+                )
+
+    def _stored(self, entry: _Entry, row_id: int) -> None:
+        # Committed: the analysis can be loaded from the database from now on
+        with self._lock:
+            entry.row_id = row_id
+            entry.analysis = None
+
+    def flush(self) -> None:
+        if self._writer is not None:
+            self._writer.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "lookups": self.lookups, "reused": self.reused}
+
+
+near_duplicate_index = NearDuplicateIndex(
+    threshold=NEAR_DUP_THRESHOLD,
+    db_path=NEAR_DUP_DB or None,
+    max_entries=NEAR_DUP_MAX_ENTRIES,
+)
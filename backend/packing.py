@@ -0,0 +1,66 @@
+# packing.py
+"""
+Helpers for packed batch analysis: several paragraphs are analyzed in one LLM
+call so the static few-shot prefix is paid once per pack instead of once per
+paragraph. The model is asked for a JSON array with one analysis per clause,
+tagged with its paragraphIndex, which is split back per paragraph.
+"""
+import json
+import os
+from typing import Any, Dict, List, Tuple
+
+from few_shot import estimate_tokens
+from structured_output import parse_json
+
+# Upper bounds for the clause payload carried by a single packed request
+PACK_TOKEN_BUDGET = int(os.getenv("PACK_TOKEN_BUDGET", "6000"))
+PACK_MAX_ITEMS = int(os.getenv("PACK_MAX_ITEMS", "8"))
+
+PACK_INSTRUCTIONS = """
+
+---
+
+**Packed Input:**
+
+You receive a JSON array of clauses instead of a single clause. Each element carries a `paragraphIndex`.
+Analyze every clause independently and return a JSON array that contains exactly one analysis object per clause,
+in the output format shown above, each with an additional `paragraphIndex` field copied from its input.
+Output nothing but the JSON array.
+
+"""
+
+
+def pack_items(items: List[Tuple[int, Dict[str, Any]]], token_budget: int = PACK_TOKEN_BUDGET,
+               max_items: int = PACK_MAX_ITEMS) -> List[List[Tuple[int, Dict[str, Any]]]]:
+    """
+    Greedily groups (paragraphIndex, change_json) pairs into packs that stay within the token budget.
+    A single oversized item still gets a pack of its own.
+    """
+    packs: List[List[Tuple[int, Dict[str, Any]]]] = []
+    current: List[Tuple[int, Dict[str, Any]]] = []
+    used = 0
+    for paragraph_index, change_json in items:
+        tokens = estimate_tokens(json.dumps(change_json, ensure_ascii=False))
+        if current and (used + tokens > token_budget or len(current) >= max_items):
+            packs.append(current)
+            current, used = [], 0
+        current.append((paragraph_index, change_json))
+        used += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+
+def packed_payload(items: List[Tuple[int, Dict[str, Any]]]) -> str:
+    return PACK_INSTRUCTIONS + json.dumps(
+        [{"paragraphIndex": paragraph_index, **change_json} for paragraph_index, change_json in items],
+        ensure_ascii=False,
+    )
+
+
+def parse_packed_array(text: str) -> List[Dict[str, Any]]:
+    """
+    Extracts the JSON array of analyses from a model response; returns [] if there is none.
+    """
+    value = parse_json(text, "[")
+    return [entry for entry in value if isinstance(entry, dict)] if isinstance(value, list) else []
@@ -0,0 +1,414 @@
+# profiling.py
+"""
+Opt-in per-request profiling with trace files that can be opened offline.
+
+A request is profiled when it carries the X-Profile header (`1`, or `cpu` to
+also sample the Python stacks) together with the PROFILE_SECRET in the
+X-Profile-Key header, or is picked at random with PROFILE_SAMPLE_RATE. Without
+a PROFILE_SECRET the header is ignored, so clients cannot make the server
+profile (and write files) on their own.
+For profiled requests, the functions decorated with @traced record a span tree
+(analyze_changes_batch → analyze_changes → analyze_clause_change →
+call_google_gemini_api → generate_content), and with CPU sampling a background
+thread samples the event loop thread's Python stack every PROFILE_CPU_INTERVAL
+seconds. The event loop is shared, so the samples show everything it ran while
+the request was in progress, not only the request's own work; for the same
+reason only one request is CPU-sampled at a time, and the others get spans only.
+
+When the request is finished the trace is written to PROFILE_DIR, in the Chrome
+trace event format (open it in https://ui.perfetto.dev or chrome://tracing) or
+as OTLP-JSON, and its file name is returned in the X-Profile-Trace header. Only
+the newest PROFILE_MAX_FILES traces are kept.
+
+While a request is not profiled, the middleware only looks at the header and a
+traced call costs one context variable lookup, so profiling stays enabled in
+production.
+"""
+import asyncio
+import functools
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from contextvars import Context, ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from metrics import Counter
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_KEY_HEADER = "X-Profile-Key"
+PROFILE_TRACE_HEADER = "X-Profile-Trace"
+# Required in the X-Profile-Key header for X-Profile to be honored (empty = the header is ignored)
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+# Fraction of requests profiled without the header (0 = only on request)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Whether sampled requests also get CPU sampling
+PROFILE_SAMPLE_CPU = os.getenv("PROFILE_SAMPLE_CPU", "0") == "1"
+PROFILE_CPU_INTERVAL = float(os.getenv("PROFILE_CPU_INTERVAL", "0.005"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Older traces in PROFILE_DIR are deleted beyond this many (0 = keep all)
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+# "chrome" (trace event format) or "otlp" (OTLP-JSON)
+PROFILE_FORMAT = os.getenv("PROFILE_FORMAT", "chrome")
+# Bounds the memory of one trace; further spans and samples are dropped
+PROFILE_MAX_SPANS = int(os.getenv("PROFILE_MAX_SPANS", "20000"))
+PROFILE_MAX_SAMPLES = int(os.getenv("PROFILE_MAX_SAMPLES", "100000"))
+# Deepest Python stack recorded per sample
+_MAX_STACK_DEPTH = 64
+
+PROFILES_WRITTEN = Counter("specter_profiles_written_total", "Request traces written, by format.", ["format"])
+
+T = TypeVar("T")
+
+# ASGI header names are lowercase bytes
+_HEADER_KEY = PROFILE_HEADER.lower().encode("latin-1")
+_SECRET_HEADER_KEY = PROFILE_KEY_HEADER.lower().encode("latin-1")
+_TRACE_SUFFIXES = (".trace.json", ".otlp.json")
+
+# Held by the request being CPU-sampled
+_cpu_sampling = threading.Lock()
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "lane", "start", "end", "attributes", "error")
+
+    def __init__(self, span_id: int, parent_id: Optional[int], name: str, lane: int):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        # The asyncio task the span ran in; spans of one task nest properly
+        self.lane = lane
+        self.start = time.perf_counter_ns()
+        self.end: Optional[int] = None
+        self.attributes: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+
+
+class Trace:
+    def __init__(self, name: str, cpu: bool = False):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        # The wall clock time at `start`, to place the spans in absolute time
+        self.start = time.perf_counter_ns()
+        self.wall_start = time.time_ns()
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self._lanes: Dict[int, int] = {}
+        self.sampler = _StackSampler(PROFILE_CPU_INTERVAL) if cpu else None
+
+    def lane(self) -> int:
+        task = asyncio.current_task()
+        return self._lanes.setdefault(id(task), len(self._lanes) + 1)
+
+    def start_span(self, name: str, parent: Optional[Span]) -> Optional[Span]:
+        if len(self.spans) >= PROFILE_MAX_SPANS:
+            self.dropped += 1
+            return None
+        span = Span(len(self.spans) + 1, parent.span_id if parent is not None else None, name, self.lane())
+        self.spans.append(span)
+        return span
+
+
+class _StackSampler(threading.Thread):
+    """
+    Samples the Python stack of the thread that started it (the event loop) until stopped.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.target = threading.get_ident()
+        # (perf_counter_ns, outermost-first frames)
+        self.samples: List[Tuple[int, Tuple[str, ...]]] = []
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval) and len(self.samples) < PROFILE_MAX_SAMPLES:
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None and len(stack) < _MAX_STACK_DEPTH:
+                code = frame.f_code
+                name = getattr(code, "co_qualname", code.co_name)
+                stack.append(f"{name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples.append((time.perf_counter_ns(), tuple(reversed(stack))))
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("profile_trace", default=None)
+_span: ContextVar[Optional[Span]] = ContextVar("profile_span", default=None)
+
+
+def traced(name: str) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """
+    Decorates a coroutine function to record a span named `name` when the current request is profiled.
+    """
+    def decorate(fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            trace = _trace.get()
+            if trace is None:
+                return await fn(*args, **kwargs)
+            span = trace.start_span(name, _span.get())
+            if span is None:
+                return await fn(*args, **kwargs)
+            token = _span.set(span)
+            try:
+                return await fn(*args, **kwargs)
+            except BaseException as e:
+                span.error = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                span.end = time.perf_counter_ns()
+                _span.reset(token)
+        return wrapper
+    return decorate
+
+
+def continue_trace(context: Context) -> None:
+    """
+    Records the spans of work run in `context` (such as a call shared with other requests, see
+    single_flight.py) under the current span of the current request's trace.
+    """
+    context.run(_trace.set, _trace.get())
+    context.run(_span.set, _span.get())
+
+
+def annotate(**attributes: Any) -> None:
+    """
+    Adds attributes to the current span, if the request is profiled.
+    """
+    span = _span.get()
+    if span is not None:
+        span.attributes.update(attributes)
+
+
+def _profile_mode(scope: Dict[str, Any]) -> Optional[str]:
+    """
+    "spans" or "cpu" if the request is to be profiled, else None.
+    """
+    headers = dict(scope["headers"])
+    value = headers.get(_HEADER_KEY)
+    if value is not None and PROFILE_SECRET and hmac.compare_digest(
+        headers.get(_SECRET_HEADER_KEY, b""), PROFILE_SECRET.encode("utf-8")
+    ):
+        value = value.decode("latin-1").strip().lower()
+        if value == "cpu":
+            return "cpu"
+        return "spans" if value not in ("", "0", "false") else None
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "cpu" if PROFILE_SAMPLE_CPU else "spans"
+    return None
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles opted-in requests, including the body of streaming responses.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        mode = _profile_mode(scope) if scope["type"] == "http" else None
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+        cpu = mode == "cpu" and _cpu_sampling.acquire(blocking=False)
+        trace = Trace(f"{scope['method']} {scope['path']}", cpu=cpu)
+        file_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{trace.trace_id[:12]}" + (
+            ".otlp.json" if PROFILE_FORMAT == "otlp" else ".trace.json"
+        )
+        status = {}
+
+        async def send_with_trace_header(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (PROFILE_TRACE_HEADER.lower().encode("latin-1"), file_name.encode("latin-1"))
+                ]
+            await send(message)
+
+        trace_token = _trace.set(trace)
+        # None if PROFILE_MAX_SPANS leaves no room even for the root
+        root = trace.start_span(trace.name, None)
+        span_token = _span.set(root)
+        if trace.sampler is not None:
+            trace.sampler.start()
+        try:
+            await self.app(scope, receive, send_with_trace_header)
+        except BaseException as e:
+            if root is not None:
+                root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _span.reset(span_token)
+            _trace.reset(trace_token)
+            if trace.sampler is not None:
+                trace.sampler.stop()
+            if cpu:
+                _cpu_sampling.release()
+            if root is not None:
+                root.end = time.perf_counter_ns()
+                root.attributes["http.status_code"] = status.get("code")
+            await asyncio.to_thread(write_trace, trace, os.path.join(PROFILE_DIR, file_name))
+
+
+def _microseconds(trace: Trace, perf_ns: int) -> float:
+    return (perf_ns - trace.start) / 1000
+
+
+def chrome_trace(trace: Trace) -> Dict[str, Any]:
+    """
+    The trace in the Chrome trace event format: spans as complete events, one thread per asyncio
+    task, and the CPU samples as a flame chart on thread 0.
+    """
+    events: List[Dict[str, Any]] = [
+        {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": trace.name}},
+    ]
+    lanes = sorted({span.lane for span in trace.spans})
+    events.extend(
+        {"name": "thread_name", "ph": "M", "pid": 1, "tid": lane, "args": {"name": f"task {lane}"}} for lane in lanes
+    )
+    for span in trace.spans:
+        end = span.end if span.end is not None else time.perf_counter_ns()
+        args = dict(span.attributes)
+        if span.error is not None:
+            args["error"] = span.error
+        events.append({
+            "name": span.name, "cat": "span", "ph": "X", "pid": 1, "tid": span.lane,
+            "ts": _microseconds(trace, span.start), "dur": (end - span.start) / 1000, "args": args,
+        })
+    if trace.sampler is not None and trace.sampler.samples:
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": "python (sampled)"}})
+        events.extend(_sample_events(trace, trace.sampler.samples, trace.sampler.interval))
+    return {
+        "traceEvents": events,
+        "displayTimeUnit": "ms",
+        "otherData": {"traceId": trace.trace_id, "droppedSpans": trace.dropped},
+    }
+
+
+def _sample_events(trace: Trace, samples: List[Tuple[int, Tuple[str, ...]]], interval: float) -> List[Dict[str, Any]]:
+    # A frame lasts from the first sample it appears in until the first one that no longer has it
+    events = []
+    open_frames: List[Tuple[str, int]] = []
+
+    def close(depth: int, at: int) -> None:
+        while len(open_frames) > depth:
+            frame, started = open_frames.pop()
+            events.append({
+                "name": frame, "cat": "cpu", "ph": "X", "pid": 1, "tid": 0,
+                "ts": _microseconds(trace, started), "dur": (at - started) / 1000,
+            })
+
+    for at, stack in samples:
+        common = 0
+        while common < len(open_frames) and common < len(stack) and open_frames[common][0] == stack[common]:
+            common += 1
+        close(common, at)
+        open_frames.extend((frame, at) for frame in stack[common:])
+    close(0, samples[-1][0] + int(interval * 1e9))
+    return events
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_trace(trace: Trace) -> Dict[str, Any]:
+    """
+    The spans as an OTLP-JSON ExportTraceServiceRequest. CPU samples are summarized as events of
+    the root span (the most frequent stacks with their sample counts).
+    """
+    def unix_nano(perf_ns: int) -> str:
+        return str(trace.wall_start + perf_ns - trace.start)
+
+    spans = []
+    for span in trace.spans:
+        end = span.end if span.end is not None else time.perf_counter_ns()
+        otlp_span = {
+            "traceId": trace.trace_id,
+            "spanId": f"{span.span_id:016x}",
+            "name": span.name,
+            "kind": 2 if span.parent_id is None else 1,
+            "startTimeUnixNano": unix_nano(span.start),
+            "endTimeUnixNano": unix_nano(end),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in {**span.attributes, "asyncio.task": span.lane}.items() if value is not None
+            ],
+            "status": {"code": 2, "message": span.error} if span.error is not None else {"code": 1},
+        }
+        if span.parent_id is not None:
+            otlp_span["parentSpanId"] = f"{span.parent_id:016x}"
+        spans.append(otlp_span)
+    if spans and trace.sampler is not None and trace.sampler.samples:
+        counts: Dict[Tuple[str, ...], int] = {}
+        for _, stack in trace.sampler.samples:
+            counts[stack] = counts.get(stack, 0) + 1
+        top = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:20]
+        spans[0]["events"] = [
+            {
+                "timeUnixNano": spans[0]["endTimeUnixNano"],
+                "name": "cpu.samples",
+                "attributes": [
+                    {"key": "count", "value": {"intValue": str(count)}},
+                    {"key": "interval_seconds", "value": {"doubleValue": trace.sampler.interval}},
+                    {"key": "stack", "value": {"stringValue": "\n".join(stack)}},
+                ],
+            }
+            for stack, count in top
+        ]
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "specter-backend"}}]},
+            "scopeSpans": [{"scope": {"name": "specter.profiling"}, "spans": spans}],
+        }]
+    }
+
+
+def write_trace(trace: Trace, path: str) -> None:
+    content = otlp_trace(trace) if PROFILE_FORMAT == "otlp" else chrome_trace(trace)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(content, f)
+    PROFILES_WRITTEN.inc(PROFILE_FORMAT)
+    prune_traces(os.path.dirname(path) or ".", PROFILE_MAX_FILES)
+
+
+def prune_traces(directory: str, keep: int) -> None:
+    """
+    Deletes all but the `keep` newest trace files in `directory` (0 keeps all of them).
+    """
+    if keep <= 0:
+        return
+    traces = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.endswith(_TRACE_SUFFIXES):
+                continue
+            try:
+                traces.append((entry.stat().st_mtime, entry.name, entry.path))
+            except FileNotFoundError:
+                # Pruned by another worker sharing the directory
+                continue
+    traces.sort()
+    for _, _, path in traces[:max(0, len(traces) - keep)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
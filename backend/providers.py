@@ -0,0 +1,162 @@
+# providers.py
+"""
+Pluggable LLM providers and a load-balanced pool of them.
+
+A provider is one endpoint plus credential: a Gemini API key, or an
+OpenAI-compatible chat completions endpoint (e.g. an on-prem vLLM or
+llama.cpp server). Each one has its own request/token budgets and circuit
+breaker, so every additional API key adds its own quota. Providers translate
+the Gemini-style request of gemini_client.generate_content into their wire
+format and their answer back into the Gemini response shape, so the rest of
+the backend does not know which one served a call.
+
+The pool sends each call to the provider with the lowest expected wait: its
+observed latency (EWMA) times its calls in flight, plus the time until its
+local quota allows another request. Providers whose circuit breaker is open,
+or that were told by a 429 to back off, are drained until they recover.
+"""
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from rate_limit import CircuitBreaker, TokenBucket
+
+# Weight of the latest call in the latency moving average
+_LATENCY_ALPHA = 0.2
+
+# (url, json body, query params, headers) of one upstream call
+WireRequest = Tuple[str, Dict[str, Any], Dict[str, str], Dict[str, str]]
+
+
+class Provider:
+    kind = ""
+    # Whether the provider can hold the static prompt prefix in a Gemini cachedContents
+    supports_caching = False
+
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0,
+                 breaker_failures: int = 5, breaker_reset: float = 30.0):
+        self.name = name
+        self.request_bucket = TokenBucket(rpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.circuit_breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.latency: Optional[float] = None
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self._cooldown_until = 0.0
+
+    def build_request(self, prompt: str, model: str, response_schema: Optional[Dict[str, Any]],
+                      cached_content: Optional[str]) -> WireRequest:
+        raise NotImplementedError
+
+    def to_gemini_response(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        return data
+
+    def available(self) -> bool:
+        return time.monotonic() >= self._cooldown_until and self.circuit_breaker.available()
+
+    def expected_wait(self) -> float:
+        return (self.latency or 0.0) * (self.in_flight + 1) + self.request_bucket.expected_wait(1)
+
+    def record_success(self, latency: float) -> None:
+        self.latency = latency if self.latency is None else (1 - _LATENCY_ALPHA) * self.latency + _LATENCY_ALPHA * latency
+
+    def record_failure(self, retry_after: Optional[float] = None) -> None:
+        self.failures += 1
+        if retry_after:
+            # Out of quota for now: let the other providers take the load
+            self._cooldown_until = max(self._cooldown_until, time.monotonic() + retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "available": self.available(),
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "failures": self.failures,
+            "latency": round(self.latency, 4) if self.latency is not None else None,
+            "rate_limited_waits": self.request_bucket.waits + self.token_bucket.waits,
+            "circuit_breaker": self.circuit_breaker.stats(),
+        }
+
+
+class GeminiProvider(Provider):
+    kind = "gemini"
+    supports_caching = True
+
+    def __init__(self, name: str, api_key: str, api_base: str, **kwargs: Any):
+        super().__init__(name, **kwargs)
+        self.api_key = api_key
+        self.api_base = api_base
+
+    def build_request(self, prompt: str, model: str, response_schema: Optional[Dict[str, Any]],
+                      cached_content: Optional[str]) -> WireRequest:
+        payload: Dict[str, Any] = {"contents": [{"parts": [{"text": prompt}]}]}
+        if response_schema is not None:
+            payload["generationConfig"] = {"responseMimeType": "application/json", "responseSchema": response_schema}
+        if cached_content is not None:
+            payload["cachedContent"] = cached_content
+        return f"{self.api_base}/models/{model}:generateContent", payload, {"key": self.api_key}, {}
+
+
+class OpenAICompatibleProvider(Provider):
+    """
+    A `/chat/completions` endpoint. It serves its own model whatever Gemini model was asked for.
+    """
+    kind = "openai"
+
+    def __init__(self, name: str, base_url: str, model: str, api_key: str = "", **kwargs: Any):
+        super().__init__(name, **kwargs)
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+
+    def build_request(self, prompt: str, model: str, response_schema: Optional[Dict[str, Any]],
+                      cached_content: Optional[str]) -> WireRequest:
+        payload: Dict[str, Any] = {"model": self.model, "messages": [{"role": "user", "content": prompt}]}
+        # JSON mode is widely supported by local servers; the schema itself is enforced by validation.
+        # It only allows an object at the top level, so an array schema (a packed call) is left to the prompt
+        if response_schema is not None and str(response_schema.get("type", "")).upper() != "ARRAY":
+            payload["response_format"] = {"type": "json_object"}
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        return f"{self.base_url}/chat/completions", payload, {}, headers
+
+    def to_gemini_response(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        usage = data.get("usage") or {}
+        return {
+            "candidates": [
+                {"content": {"parts": [{"text": (choice.get("message") or {}).get("content") or ""}], "role": "model"}}
+                for choice in data.get("choices", [])
+            ],
+            "usageMetadata": {
+                "promptTokenCount": usage.get("prompt_tokens", 0),
+                "candidatesTokenCount": usage.get("completion_tokens", 0),
+            },
+        }
+
+
+class ProviderPool:
+    def __init__(self, members: Sequence[Provider]):
+        self.members: List[Provider] = list(members)
+
+    def choose(self, exclude: Sequence[Provider] = ()) -> Optional[Provider]:
+        """
+        The provider with the lowest expected wait, preferring healthy providers not in `exclude`.
+        If all are drained, one is still returned so that its circuit breaker decides.
+        """
+        candidates = [member for member in self.members if member not in exclude and member.available()]
+        if not candidates:
+            candidates = [member for member in self.members if member.available()] or self.members
+        if not candidates:
+            return None
+        # Ties (e.g. before any latency is known) go to the least used provider
+        return min(candidates, key=lambda member: (member.expected_wait(), member.calls))
+
+    def has_alternative(self, tried: Sequence[Provider]) -> bool:
+        return any(member not in tried and member.available() for member in self.members)
+
+    def caching_provider(self) -> Optional[Provider]:
+        return next((member for member in self.members if member.supports_caching), None)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [member.stats() for member in self.members]
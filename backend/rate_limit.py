@@ -0,0 +1,185 @@
+# rate_limit.py
+"""
+Client-side flow control for upstream LLM calls: token buckets for
+requests-per-minute and tokens-per-minute budgets, jittered exponential
+backoff that honors Retry-After, and a circuit breaker that fails fast while
+the upstream is unhealthy.
+"""
+import asyncio
+import email.utils
+import random
+import re
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+
+class TokenBucket:
+    """
+    Refills `rate_per_minute` units per minute up to `capacity`. A rate of 0 disables the limit.
+    Urgent waiters are served before the others; within each group, in arrival order.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waits = 0
+        self._lock = asyncio.Lock()
+        self._urgent_lock = asyncio.Lock()
+        self._urgent_waiting = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def expected_wait(self, amount: float = 1) -> float:
+        """
+        Seconds until `amount` units would be available, ignoring waiters already queued.
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    async def acquire(self, amount: float = 1, urgent: bool = False) -> None:
+        if self.rate <= 0:
+            return
+        # A single request larger than the bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        if urgent:
+            self._urgent_waiting += 1
+        try:
+            async with self._urgent_lock if urgent else self._lock:
+                self._refill()
+                # Other waiters leave the units to urgent ones and check again once these could have refilled
+                while self.tokens < amount or (not urgent and self._urgent_waiting):
+                    self.waits += 1
+                    shortfall = amount - self.tokens
+                    await asyncio.sleep((shortfall if shortfall > 0 else amount) / self.rate)
+                    self._refill()
+                self.tokens -= amount
+        finally:
+            if urgent:
+                self._urgent_waiting -= 1
+
+
+class CircuitOpenError(httpx.HTTPError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for `reset_timeout`
+    seconds. Afterwards one trial call is let through (half-open); its outcome closes or re-opens it.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def before_call(self) -> None:
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial_started = now
+                return
+            self.rejected += 1
+            raise CircuitOpenError("Upstream circuit breaker is open; failing fast.")
+        if self.state == self.HALF_OPEN:
+            # Only one trial call may pass until it reports back (or is presumed lost)
+            if now - self.trial_started >= self.reset_timeout:
+                self.trial_started = now
+                return
+            self.rejected += 1
+            raise CircuitOpenError("Upstream circuit breaker is half-open; trial call in progress.")
+
+    def available(self) -> bool:
+        """
+        Whether before_call() would currently let a call through, without changing the state.
+        """
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now - self.opened_at >= self.reset_timeout
+        if self.state == self.HALF_OPEN:
+            return now - self.trial_started >= self.reset_timeout
+        return True
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+_RETRY_DELAY = re.compile(r"^([\d.]+)s$")
+
+
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    """
+    Reads the server's requested delay from the Retry-After header (seconds or HTTP date)
+    or from a Gemini `RetryInfo` error detail such as {"retryDelay": "30s"}.
+    """
+    header = response.headers.get("Retry-After")
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(header).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    # Error bodies come from the upstream (or a proxy in front of it); any part may be missing or malformed
+    error = body.get("error") if isinstance(body, dict) else None
+    details = error.get("details") if isinstance(error, dict) else None
+    if not isinstance(details, list):
+        return None
+    for detail in details:
+        if not isinstance(detail, dict):
+            continue
+        match = _RETRY_DELAY.match(str(detail.get("retryDelay", "")))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: Optional[float] = None) -> float:
+    """
+    Full-jitter exponential backoff, never shorter than the server's Retry-After.
+    """
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
@@ -0,0 +1,121 @@
+# routing.py
+"""
+Complexity-based routing of clause analyses across model tiers.
+
+Each change json is scored locally from the clause length, the number and
+size of its tracked changes and keywords of clause categories that need
+careful drafting (indemnities, liability caps, governing law, ...). Clauses
+scoring below ROUTING_THRESHOLD go to the fast tier, the rest to the strong
+tier. When an answer from the fast tier cannot be validated, the analysis is
+escalated to the strong tier. Decisions, escalations and per-tier upstream
+latency are exported on /metrics and /upstream_stats so the threshold can be
+tuned for throughput versus quality.
+"""
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional
+
+from few_shot import estimate_tokens
+from gemini_client import GEMINI_MODEL
+from metrics import Counter, Histogram
+
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "1") == "1"
+GEMINI_FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", GEMINI_MODEL)
+GEMINI_STRONG_MODEL = os.getenv("GEMINI_STRONG_MODEL", "gemini-2.0-flash")
+# Clauses scoring at least this much are analyzed by the strong tier
+ROUTING_THRESHOLD = float(os.getenv("ROUTING_THRESHOLD", "3"))
+ROUTING_ESCALATION = os.getenv("ROUTING_ESCALATION", "1") == "1"
+
+# Score weights: per 500 clause tokens, per tracked change, per 50 tokens of changed text
+# and per sensitive clause category mentioned
+_LENGTH_WEIGHT = 1.0
+_CHANGE_WEIGHT = 0.25
+_CHANGE_SIZE_WEIGHT = 0.5
+_KEYWORD_WEIGHT = 1.5
+
+_SENSITIVE_CATEGORIES = {
+    "indemnity": re.compile(r"\bindemni|\bhold harmless"),
+    "liability": re.compile(r"\bliabilit|\bconsequential|\bdamages\b"),
+    "warranty": re.compile(r"\bwarrant|\brepresent(?:s|ation)"),
+    "jurisdiction": re.compile(r"\bgoverning law|\bjurisdiction|\barbitrat"),
+    "remedies": re.compile(r"\binjunct|\bspecific performance|\bequitable relief"),
+    "restrictive_covenants": re.compile(r"\bnon-?solicit|\bnon-?compet"),
+    "intellectual_property": re.compile(r"\bintellectual property|\blicen[cs]e"),
+}
+
+ROUTING_DECISIONS = Counter(
+    "specter_routing_decisions_total", "Clause analyses routed to each model tier.", ["tier"]
+)
+ROUTING_ESCALATIONS = Counter(
+    "specter_routing_escalations_total", "Analyses escalated to a stronger tier after an invalid answer.", ["from_tier"]
+)
+TIER_SECONDS = Histogram(
+    "specter_tier_upstream_seconds", "Upstream latency of analysis calls per model tier.", ["tier"]
+)
+
+
+@dataclass(frozen=True)
+class Tier:
+    name: str
+    model: str
+
+
+FAST = Tier("fast", GEMINI_FAST_MODEL)
+STRONG = Tier("strong", GEMINI_STRONG_MODEL)
+
+
+def complexity_score(change_json: Dict[str, Any]) -> float:
+    text = str(change_json.get("original_text") or "")
+    changes = change_json.get("changes") or []
+    changed_text = " ".join(str(change.get("description") or "") for change in changes)
+    lowered = f"{text} {changed_text}".lower()
+    categories = sum(1 for pattern in _SENSITIVE_CATEGORIES.values() if pattern.search(lowered))
+    return (
+        _LENGTH_WEIGHT * estimate_tokens(text) / 500
+        + _CHANGE_WEIGHT * len(changes)
+        + _CHANGE_SIZE_WEIGHT * estimate_tokens(changed_text) / 50
+        + _KEYWORD_WEIGHT * categories
+    )
+
+
+def route(change_jsons: Iterable[Dict[str, Any]]) -> Tier:
+    """
+    The tier for one call analyzing the given clauses: the strong tier if any of them
+    scores at or above the threshold.
+    """
+    if not ROUTING_ENABLED:
+        return FAST
+    score = max((complexity_score(change_json) for change_json in change_jsons), default=0.0)
+    tier = STRONG if score >= ROUTING_THRESHOLD else FAST
+    ROUTING_DECISIONS.inc(tier.name)
+    return tier
+
+
+def escalation(tier: Tier) -> Optional[Tier]:
+    """
+    The tier to retry on after `tier` returned an invalid answer, if any.
+    """
+    if ROUTING_ENABLED and ROUTING_ESCALATION and tier is FAST and FAST.model != STRONG.model:
+        ROUTING_ESCALATIONS.inc(tier.name)
+        return STRONG
+    return None
+
+
+def config_tag() -> str:
+    """
+    Identifies the models an analysis may come from and how they are chosen, for use in cache keys.
+    """
+    if not ROUTING_ENABLED:
+        return FAST.model
+    return f"{FAST.model}|{STRONG.model}|threshold{ROUTING_THRESHOLD}|escalation{int(ROUTING_ESCALATION)}"
+
+
+def routing_stats() -> Dict[str, Any]:
+    return {
+        "enabled": ROUTING_ENABLED,
+        "threshold": ROUTING_THRESHOLD,
+        "tiers": {tier.name: tier.model for tier in (FAST, STRONG)},
+        "decisions": {tier.name: int(ROUTING_DECISIONS.value(tier.name)) for tier in (FAST, STRONG)},
+        "escalations": int(ROUTING_ESCALATIONS.value(FAST.name)),
+    }
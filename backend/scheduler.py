@@ -0,0 +1,230 @@
+# scheduler.py
+"""
+Priority scheduling of upstream LLM calls.
+
+Every Gemini call takes a slot from one shared scheduler. Calls belong to a
+priority class, interactive (a user waiting on one clause) or batch (whole
+document reviews), and to a flow (the document or client they were made for).
+Queued interactive calls are always served before queued batch calls, and a
+few slots are reserved for them so that they do not wait behind long-running
+batch calls. Within a class, flows take turns, so one large document cannot
+starve the others.
+
+The class and flow of a call are taken from the context of the request that
+caused it (see `run_as`), so they do not have to be passed through the
+analysis pipeline. Work shared by several requests (see single_flight.py) runs
+in the most urgent class among them; its queued calls move up when a more
+urgent request joins.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import Context, ContextVar
+from typing import Any, AsyncIterator, Awaitable, Deque, Dict, List, Optional, Set, Tuple, TypeVar
+
+from metrics import Gauge, Histogram
+
+# Upstream calls in flight at the same time (0 = unlimited). By default as many as the upstream
+# connection pool holds (GEMINI_MAX_CONNECTIONS, see gemini_client.py): the provider budgets pace
+# the calls, and the slots only keep batch calls from taking the connections reserved below
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", os.getenv("GEMINI_MAX_CONNECTIONS", "200")))
+# Slots batch calls may not use, kept free for interactive calls
+SCHEDULER_INTERACTIVE_RESERVE = int(os.getenv("SCHEDULER_INTERACTIVE_RESERVE", "2"))
+
+INTERACTIVE = 0
+BATCH = 1
+PRIORITY_NAMES = ("interactive", "batch")
+
+SCHEDULER_QUEUE_WAIT = Histogram(
+    "specter_scheduler_queue_wait_seconds",
+    "Time upstream calls waited for a scheduler slot, by priority class.",
+    ["priority"],
+)
+
+# (priority, flow) of the request being served; work without a request context counts as batch
+_current: ContextVar[Tuple[int, str]] = ContextVar("llm_schedule", default=(BATCH, "default"))
+
+T = TypeVar("T")
+
+
+class SharedClass:
+    """
+    The scheduling class of work shared by several requests, raised to the most urgent one among them.
+    """
+    __slots__ = ("priority", "flow", "waiters")
+
+    def __init__(self, priority: int, flow: str):
+        self.priority = priority
+        self.flow = flow
+        # Slot waiters of the shared work that are queued right now
+        self.waiters: Set[asyncio.Future] = set()
+
+
+_shared: ContextVar[Optional[SharedClass]] = ContextVar("llm_shared_schedule", default=None)
+
+
+def _request_class() -> Tuple[int, str]:
+    shared = _shared.get()
+    return (shared.priority, shared.flow) if shared is not None else _current.get()
+
+
+def request_priority() -> int:
+    """
+    The priority class upstream calls of the current request are scheduled in.
+    """
+    return _request_class()[0]
+
+
+def shared_context() -> Tuple[Context, SharedClass]:
+    """
+    A fresh context for work shared by several requests, starting in the current request's
+    class and flow (see Scheduler.promote). Nothing else of the request's context (such as
+    its deadline or trace) is carried over.
+    """
+    shared = SharedClass(*_request_class())
+    context = Context()
+    context.run(_shared.set, shared)
+    return context, shared
+
+
+async def run_as(awaitable: Awaitable[T], priority: int, flow: str) -> T:
+    """
+    Awaits `awaitable` with its upstream calls scheduled in the given priority class and flow.
+    """
+    token = _current.set((priority, flow))
+    try:
+        return await awaitable
+    finally:
+        _current.reset(token)
+
+
+class Scheduler:
+    def __init__(self, concurrency: int = 16, interactive_reserve: int = 2):
+        self.concurrency = concurrency
+        self.batch_limit = max(1, concurrency - interactive_reserve)
+        self._running = [0, 0]
+        # Per priority: waiters per flow, in the order the flows take turns
+        self._queues: List["OrderedDict[str, Deque[asyncio.Future]]"] = [OrderedDict(), OrderedDict()]
+        self.served = [0, 0]
+
+    def _can_run(self, priority: int) -> bool:
+        if self.concurrency <= 0:
+            return True
+        if sum(self._running) >= self.concurrency:
+            return False
+        return priority == INTERACTIVE or self._running[BATCH] < self.batch_limit
+
+    def _queued(self, priority: int) -> int:
+        return sum(len(waiters) for waiters in self._queues[priority].values())
+
+    def _dispatch(self) -> None:
+        for priority in (INTERACTIVE, BATCH):
+            queue = self._queues[priority]
+            while queue and self._can_run(priority):
+                flow, waiters = next(iter(queue.items()))
+                waiter = waiters.popleft()
+                # The flow goes to the back of the line
+                if waiters:
+                    queue.move_to_end(flow)
+                else:
+                    del queue[flow]
+                if waiter.done():
+                    # Cancelled while queued; its caller has not unqueued it yet
+                    continue
+                self._running[priority] += 1
+                # The class the slot was granted in, which a promotion may have changed
+                waiter.set_result(priority)
+
+    def _unqueue(self, waiter: asyncio.Future, flow: str) -> Optional[int]:
+        for priority, queue in enumerate(self._queues):
+            waiters = queue.get(flow)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del queue[flow]
+                return priority
+        return None
+
+    async def acquire(self, priority: int, flow: str, shared: Optional[SharedClass] = None) -> int:
+        """
+        Waits for a slot in the given class and flow; returns the class it was granted in.
+        """
+        waiting_ahead = self._queues[priority] or (priority == BATCH and self._queues[INTERACTIVE])
+        if not waiting_ahead and self._can_run(priority):
+            self._running[priority] += 1
+            SCHEDULER_QUEUE_WAIT.observe(0.0, PRIORITY_NAMES[priority])
+            return priority
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(flow, deque()).append(waiter)
+        if shared is not None:
+            shared.waiters.add(waiter)
+        started = time.perf_counter()
+        try:
+            granted = await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as the caller gave up
+                self.release(waiter.result())
+            else:
+                self._unqueue(waiter, flow)
+            raise
+        finally:
+            if shared is not None:
+                shared.waiters.discard(waiter)
+        SCHEDULER_QUEUE_WAIT.observe(time.perf_counter() - started, PRIORITY_NAMES[granted])
+        return granted
+
+    def promote(self, shared: SharedClass) -> None:
+        """
+        Raises shared work to the current request's class if that is more urgent, moving its
+        queued calls to the front class.
+        """
+        priority, _ = _request_class()
+        if priority >= shared.priority:
+            return
+        shared.priority = priority
+        for waiter in shared.waiters:
+            if self._unqueue(waiter, shared.flow) is not None:
+                self._queues[priority].setdefault(shared.flow, deque()).append(waiter)
+        self._dispatch()
+
+    def release(self, priority: int) -> None:
+        self._running[priority] -= 1
+        self.served[priority] += 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """
+        Holds a slot for one upstream call, in the class and flow of the current request.
+        """
+        shared = _shared.get()
+        priority, flow = _request_class()
+        granted = await self.acquire(priority, flow, shared)
+        try:
+            yield
+        finally:
+            self.release(granted)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "batch_limit": self.batch_limit,
+            **{
+                name: {
+                    "in_flight": self._running[priority],
+                    "queued": self._queued(priority),
+                    "flows": len(self._queues[priority]),
+                    "served": self.served[priority],
+                }
+                for priority, name in enumerate(PRIORITY_NAMES)
+            },
+        }
+
+
+scheduler = Scheduler(SCHEDULER_CONCURRENCY, SCHEDULER_INTERACTIVE_RESERVE)
+Gauge("specter_scheduler_queued", "Upstream calls waiting for a scheduler slot.",
+      lambda: scheduler._queued(INTERACTIVE) + scheduler._queued(BATCH))
+Gauge("specter_scheduler_in_flight", "Upstream calls holding a scheduler slot.", lambda: sum(scheduler._running))
@@ -0,0 +1,40 @@
+# serialization.py
+"""
+Fast JSON serialization of batch results.
+
+Batch results are plain dicts built from already validated models, so they are
+written straight to JSON bytes instead of being validated again against the
+endpoint's response_model. orjson is used when it is installed (it is several
+times faster than the standard library and handles the integer keys of
+results by paragraphIndex); otherwise the standard library is used.
+"""
+import json
+from typing import Any
+
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def ndjson_line(record: Any) -> bytes:
+    return dumps(record) + b"\n"
+
+
+class FastJSONResponse(Response):
+    """
+    A JSON response for content that needs no further validation or conversion.
+    FastAPI returns Response instances as they are, skipping the response_model.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,73 @@
+# single_flight.py
+"""
+Request coalescing for identical in-flight work.
+
+Concurrent callers that ask for the same key share one underlying call and all
+receive its result (or its exception). The shared call is only cancelled once
+every caller waiting on it has been cancelled.
+
+The shared call does not run in the context of the caller that started it: it
+gets a fresh context with the most urgent scheduling class of its callers (see
+scheduler.py), and each caller enforces its own request deadline (see
+deadlines.py) while waiting, so one request's deadline or class is not imposed
+on the others. Only the profiling trace of the first caller is carried over, so
+the shared upstream calls appear in its span tree (see profiling.py).
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from deadlines import exceeded, remaining
+from profiling import continue_trace
+from scheduler import SharedClass, scheduler, shared_context
+
+
+class _Call:
+    def __init__(self, task: "asyncio.Task[Any]", shared: SharedClass):
+        self.task = task
+        self.shared = shared
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            context, shared = shared_context()
+            continue_trace(context)
+            call = _Call(asyncio.get_running_loop().create_task(fn(), context=context), shared)
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _task, key=key, call=call: self._forget(key, call))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            scheduler.promote(call.shared)
+        call.waiters += 1
+        try:
+            # shield() keeps one waiter's cancellation (or deadline) from cancelling the shared call
+            budget = remaining()
+            if budget is None:
+                return await asyncio.shield(call.task)
+            try:
+                return await asyncio.wait_for(asyncio.shield(call.task), max(budget, 0))
+            except asyncio.TimeoutError:
+                if call.task.done():
+                    raise
+                raise exceeded()
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Nobody is interested in the result anymore
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key: str, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "coalesced": self.coalesced}
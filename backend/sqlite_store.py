@@ -0,0 +1,105 @@
+# sqlite_store.py
+"""
+SQLite connections for the stores that are written from the event loop.
+
+The stores open their databases in WAL mode with synchronous=NORMAL, so reads
+are never blocked by a writer and a commit only appends to the write-ahead log.
+Writes still wait for the write lock, which another process sharing the file
+may hold, so each store hands its writes to a StoreWriter: a dedicated thread
+with its own connection that runs the queued writes and commits them, one
+transaction per drain of the queue (at most SQLITE_WRITE_BATCH writes). The
+event loop never waits for a write, and the write lock is only held while a
+transaction runs. A write that fails is counted in
+specter_store_write_errors_total and dropped; it only costs a cache miss and
+never fails the request that made it. flush() waits for the queued writes on
+shutdown.
+"""
+import os
+import queue
+import sqlite3
+import threading
+from typing import Any, Callable, List, Optional, Tuple
+
+from metrics import STORE_WRITE_ERRORS
+
+SQLITE_WRITE_BATCH = int(os.getenv("SQLITE_WRITE_BATCH", "64"))
+
+Write = Callable[[sqlite3.Connection], Any]
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(db_path, check_same_thread=False)
+    # In-memory databases keep their own journal mode
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class StoreWriter:
+    """
+    Runs the writes of one store on a dedicated thread. `write(db)` is called with the writer's
+    connection and `done(result)`, if given, after its transaction was committed.
+    An in-memory database only exists in the connection that created it, so for ":memory:" the
+    writer shares the store's connection and the lock guarding it.
+    """
+
+    def __init__(self, name: str, db_path: str, db: sqlite3.Connection, lock: threading.Lock):
+        self.name = name
+        if db_path == ":memory:":
+            self.db, self._lock = db, lock
+        else:
+            self.db, self._lock = connect(db_path), threading.Lock()
+        self._queue: "queue.Queue[Tuple[Write, Optional[Callable[[Any], None]]]]" = queue.Queue()
+        self.commits = 0
+        self.errors = 0
+        threading.Thread(target=self._run, name=f"{name}-writer", daemon=True).start()
+
+    def submit(self, write: Write, done: Optional[Callable[[Any], None]] = None) -> None:
+        self._queue.put((write, done))
+
+    def flush(self) -> None:
+        """
+        Waits until every write submitted so far is committed (or has failed).
+        """
+        self._queue.join()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < SQLITE_WRITE_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception:
+                # The thread must survive anything a write or its callback raises
+                self._failed(len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch: List[Tuple[Write, Optional[Callable[[Any], None]]]]) -> None:
+        written = []
+        with self._lock:
+            for write, done in batch:
+                try:
+                    written.append((done, write(self.db)))
+                except sqlite3.Error:
+                    # A failed statement is rolled back on its own; the rest of the batch is kept
+                    self._failed(1)
+            try:
+                self.db.commit()
+            except sqlite3.Error:
+                self.db.rollback()
+                self._failed(len(written))
+                return
+            self.commits += 1
+        for done, result in written:
+            if done is not None:
+                done(result)
+
+    def _failed(self, count: int) -> None:
+        self.errors += count
+        STORE_WRITE_ERRORS.inc(self.name, amount=count)
@@ -0,0 +1,238 @@
+# structured_output.py
+"""
+Getting well-formed JSON out of the model without wasting calls.
+
+Gemini is asked for schema-constrained JSON (responseMimeType/responseSchema)
+derived from the pydantic response models. Responses that still do not parse
+are handled locally first: a linear-time, string-aware balanced-brace scanner
+finds the JSON value in surrounding prose or code fences, common syntax
+defects (trailing commas, truncated output) are repaired, and a few missing or
+misplaced fields are completed. Only when all of that fails is a short repair
+prompt worth sending.
+"""
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Type
+
+from pydantic import BaseModel
+
+GEMINI_STRUCTURED_OUTPUT = os.getenv("GEMINI_STRUCTURED_OUTPUT", "1") == "1"
+# Analyses missing more fields than this are not completed locally
+REPAIR_MAX_MISSING_FIELDS = int(os.getenv("REPAIR_MAX_MISSING_FIELDS", "2"))
+REPAIR_PROMPT_ENABLED = os.getenv("REPAIR_PROMPT_ENABLED", "1") == "1"
+
+_GEMINI_TYPES = {
+    "string": "STRING",
+    "number": "NUMBER",
+    "integer": "INTEGER",
+    "boolean": "BOOLEAN",
+    "array": "ARRAY",
+    "object": "OBJECT",
+}
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class StructuredOutputError(Exception):
+    """
+    The model output could not be turned into the expected structure; `text` is the raw output.
+    """
+
+    def __init__(self, message: str, text: str = ""):
+        super().__init__(message)
+        self.text = text
+
+
+def _convert_schema(schema: Dict[str, Any], definitions: Dict[str, Any]) -> Dict[str, Any]:
+    if "$ref" in schema:
+        schema = definitions[schema["$ref"].rsplit("/", 1)[-1]]
+    converted: Dict[str, Any] = {"type": _GEMINI_TYPES[schema.get("type", "string")]}
+    if schema.get("type") == "object":
+        # Optional fields are filled in by the backend, not by the model
+        required = schema.get("required", [])
+        converted["properties"] = {
+            name: _convert_schema(schema["properties"][name], definitions) for name in required
+        }
+        converted["required"] = list(required)
+        converted["propertyOrdering"] = list(required)
+    elif schema.get("type") == "array":
+        converted["items"] = _convert_schema(schema.get("items", {}), definitions)
+    return converted
+
+
+def gemini_schema(model: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    Converts a pydantic model into the OpenAPI subset Gemini accepts as responseSchema.
+    """
+    schema = model.model_json_schema()
+    return _convert_schema(schema, schema.get("$defs", {}))
+
+
+def array_schema(item_schema: Dict[str, Any], **extra_properties: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Schema for a JSON array of objects, each with additional (required) properties.
+    """
+    items = {
+        **item_schema,
+        "properties": {**extra_properties, **item_schema["properties"]},
+        "required": list(extra_properties) + item_schema["required"],
+        "propertyOrdering": list(extra_properties) + item_schema["propertyOrdering"],
+    }
+    return {"type": "ARRAY", "items": items}
+
+
+def balanced_candidates(text: str, opener: str = "{") -> Iterator[str]:
+    """
+    Yields every top-level JSON value starting with `opener` in one pass over the text,
+    respecting strings and escapes. An unterminated value at the end is yielded as is so
+    that it can be repaired.
+    """
+    start = None
+    stack: List[str] = []
+    in_string = escaped = False
+    for i, ch in enumerate(text):
+        if start is None:
+            if ch == opener:
+                start, stack = i, [ch]
+            continue
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in _CLOSERS:
+            stack.append(ch)
+        elif ch in "}]":
+            stack.pop()
+            if not stack:
+                yield text[start:i + 1]
+                start = None
+    if start is not None:
+        yield text[start:]
+
+
+def repair_json(text: str) -> str:
+    """
+    Fixes trailing commas and closes strings, arrays and objects left open by truncated output.
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            elif ch == "\n":
+                ch = "\\n"
+            out.append(ch)
+            continue
+        if ch in "}]":
+            _strip_trailing_comma(out)
+            if stack:
+                stack.pop()
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+        elif ch == '"':
+            in_string = True
+        out.append(ch)
+    if in_string:
+        if escaped:
+            out.pop()
+        out.append('"')
+    _strip_trailing_comma(out)
+    if "".join(out).rstrip().endswith(":"):
+        out.append("null")
+    out.extend(reversed(stack))
+    return "".join(out)
+
+
+def _strip_trailing_comma(out: List[str]) -> None:
+    end = len(out)
+    while end and out[end - 1].isspace():
+        end -= 1
+    if end and out[end - 1] == ",":
+        del out[end - 1:]
+
+
+def parse_json(text: str, opener: str = "{") -> Optional[Any]:
+    """
+    Returns the first JSON value starting with `opener` in the text (repaired if necessary),
+    or None if there is none.
+    """
+    stripped = text.strip()
+    if stripped.startswith(opener):
+        try:
+            return json.loads(stripped)
+        except ValueError:
+            pass
+    for candidate in balanced_candidates(text, opener):
+        for attempt in (candidate, repair_json(candidate)):
+            try:
+                return json.loads(attempt)
+            except ValueError:
+                continue
+    return None
+
+
+def _is_model(annotation: Any) -> bool:
+    return isinstance(annotation, type) and issubclass(annotation, BaseModel)
+
+
+def complete_fields(data: Dict[str, Any], model: Type[BaseModel], defaults: Optional[Dict[str, Any]] = None,
+                    max_missing: int = REPAIR_MAX_MISSING_FIELDS) -> Optional[Dict[str, Any]]:
+    """
+    Repairs an object that failed validation against `model`: fields of a nested model that
+    were returned at the top level are moved into it, lists given for string fields are joined,
+    and up to `max_missing` missing string fields are filled from `defaults` (or left empty).
+    Returns the repaired copy, or None if too much is missing.
+    """
+    defaults = defaults or {}
+    missing = 0
+
+    def complete(value: Dict[str, Any], model: Type[BaseModel], flat: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        nonlocal missing
+        value = dict(value)
+        for name, field in model.model_fields.items():
+            if not field.is_required():
+                continue
+            annotation = field.annotation
+            if _is_model(annotation):
+                nested = value.get(name)
+                if nested is None:
+                    nested = {key: flat[key] for key in annotation.model_fields if key in flat}
+                if not isinstance(nested, dict):
+                    return None
+                nested = complete(nested, annotation, flat)
+                if nested is None:
+                    return None
+                value[name] = nested
+            elif annotation is str:
+                if isinstance(value.get(name), list):
+                    value[name] = "\n".join(str(item) for item in value[name])
+                elif value.get(name) is None:
+                    missing += 1
+                    value[name] = str(defaults.get(name, ""))
+        return value
+
+    completed = complete(data, model, data)
+    if completed is None or missing > max_missing:
+        return None
+    return completed
+
+
+def repair_prompt(text: str, schema: Dict[str, Any], error: str) -> str:
+    return (
+        "The following output was supposed to be a single JSON object matching this schema, "
+        "but it is invalid.\n\n"
+        f"Schema: {json.dumps(schema)}\n\n"
+        f"Problem: {error}\n\n"
+        f"Output:\n{text}\n\n"
+        "Return only the corrected JSON object. Keep the content; do not add explanations."
+    )
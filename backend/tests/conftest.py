@@ -0,0 +1,89 @@
+# conftest.py
+"""
+Shared test setup: the backend modules are imported from backend/, with the
+persistent stores in memory and a fake Gemini API in place of the real one.
+"""
+import asyncio
+import json
+import os
+import sys
+
+# Settings are read at import time, so they are fixed before the backend is imported
+os.environ.update({
+    "GOOGLE_API_KEY": "test-key",
+    "GEMINI_API_BASE": "http://gemini.test/v1beta",
+    "ANALYSIS_CACHE_DB": "",
+    "NEAR_DUP_DB": "",
+    "NEAR_DUP_ENABLED": "0",
+    "DOCUMENT_DB": ":memory:",
+    "JOBS_DB": ":memory:",
+    "CONTEXT_CACHE_ENABLED": "0",
+    "ROUTING_ENABLED": "0",
+    "HEDGING_ENABLED": "0",
+    "GEMINI_BACKOFF_BASE": "0.01",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+
+ANALYSIS = {
+    "clauseIdentifier": "Clause 1",
+    "originalClauseText": "The Recipient shall keep the information confidential.",
+    "analysis": {
+        "clauseCategory": "Confidentiality Obligations",
+        "summary": "The obligation is narrowed.",
+        "risksDisclosingParty": "Less information is protected.",
+        "risksReceivingParty": "None.",
+        "improvementsDisclosingParty": "Restore the original scope.",
+        "improvementsReceivingParty": "Accept the change.",
+        "suggestedWording": "The Recipient shall keep the information strictly confidential.",
+        "comments_on_changes": "Narrows the obligation.",
+    },
+}
+
+
+class FakeGemini:
+    """
+    Answers generateContent calls with `reply(prompt)` (the answer text, or an httpx.Response)
+    after `delay` seconds, recording the prompts and the highest number of concurrent calls.
+    """
+
+    def __init__(self):
+        self.prompts = []
+        self.delay = 0.0
+        self.reply = lambda prompt: json.dumps(ANALYSIS)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        prompt = json.loads(request.content)["contents"][0]["parts"][0]["text"]
+        self.prompts.append(prompt)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        answer = self.reply(prompt)
+        if isinstance(answer, httpx.Response):
+            return answer
+        return httpx.Response(200, json={"candidates": [{"content": {"parts": [{"text": answer}]}}]})
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    import gemini_client
+
+    fake = FakeGemini()
+    monkeypatch.setattr(gemini_client, "_client", httpx.AsyncClient(transport=httpx.MockTransport(fake.handle)))
+    return fake
+
+
+@pytest.fixture(autouse=True)
+def empty_analysis_cache():
+    from analysis_cache import analysis_cache
+
+    analysis_cache.clear()
+    yield
+    analysis_cache.clear()
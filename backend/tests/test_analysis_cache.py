@@ -0,0 +1,55 @@
+# test_analysis_cache.py
+import sqlite3
+
+from analysis_cache import AnalysisCache, make_cache_key
+
+
+def _key(text):
+    return make_cache_key("model", "v1", {"original_text": text, "modified_text": text, "changes": []})
+
+
+def test_cache_key_ignores_whitespace_and_paragraph_id():
+    first = {"paragraph_id": "a", "original_text": "The  Recipient\nshall", "modified_text": "x", "changes": []}
+    second = {"paragraph_id": "b", "original_text": "The Recipient shall ", "modified_text": "x", "changes": []}
+    assert make_cache_key("m", "v", first) == make_cache_key("m", "v", second)
+    assert make_cache_key("m", "v", first) != make_cache_key("other", "v", first)
+
+
+def test_disk_writes_are_made_by_the_writer_thread(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    first = AnalysisCache(max_entries=1, db_path=path)
+    # Another worker process sharing the file
+    second = AnalysisCache(max_entries=1, db_path=path)
+    first.set(_key("one"), {"value": 1})
+    second.set(_key("two"), {"value": 2})
+    first.set(_key("three"), {"value": 3})
+    first.flush()
+    second.flush()
+    assert sqlite3.connect(path).execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0] == 3
+    # Evicted from memory, read back from disk
+    assert first.get(_key("one")) == {"value": 1}
+    assert second.get(_key("three")) == {"value": 3}
+    assert first._writer.errors == second._writer.errors == 0
+
+
+def test_failed_disk_writes_are_counted_not_raised(tmp_path):
+    from metrics import STORE_WRITE_ERRORS
+
+    cache = AnalysisCache(db_path=str(tmp_path / "cache.sqlite3"))
+    cache._writer.db.execute("DROP TABLE analysis_cache")
+    before = STORE_WRITE_ERRORS.value("analysis_cache")
+    cache.set(_key("one"), {"value": 1})
+    cache.flush()
+    assert STORE_WRITE_ERRORS.value("analysis_cache") == before + 1
+    assert cache.get(_key("one")) == {"value": 1}
+
+
+def test_analysis_keys_follow_the_tier_models(monkeypatch):
+    import clause_analysis
+    import routing
+
+    change_json = {"original_text": "The Recipient shall", "modified_text": "x", "changes": []}
+    key, namespace = clause_analysis._analysis_cache_key(change_json), clause_analysis.analysis_namespace()
+    monkeypatch.setattr(routing, "FAST", routing.Tier("fast", "another-model"))
+    assert clause_analysis._analysis_cache_key(change_json) != key
+    assert clause_analysis.analysis_namespace() != namespace
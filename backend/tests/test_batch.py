@@ -0,0 +1,114 @@
+# test_batch.py
+import asyncio
+import json
+import time
+
+import httpx
+
+import main
+
+
+def _items(count, tag):
+    return [
+        {
+            "paragraphIndex": i,
+            "paragraph": f"{tag}: The Recipient shall keep the information of project {i} confidential.",
+            "changelog": [{"type": "Added", "text": f"for {i + 2} years", "author": "Test"}],
+        }
+        for i in range(count)
+    ]
+
+
+async def _post(path, body):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.post(path, json=body)
+
+
+def test_batch_is_analyzed_concurrently_within_the_limit(gemini, monkeypatch):
+    monkeypatch.setattr(main, "BATCH_CONCURRENCY", 3)
+    gemini.delay = 0.05
+    response = asyncio.run(_post("/analyze_changes_batch", {"items": _items(9, "concurrency")}))
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert sorted(int(index) for index in results) == list(range(9))
+    assert all("error" not in entry for entry in results.values())
+    assert gemini.max_in_flight == 3
+
+
+def test_failing_paragraph_only_fails_its_own_entry(gemini, monkeypatch):
+    monkeypatch.setattr(main, "BATCH_CONCURRENCY", 4)
+    # Not retried: the request itself is at fault
+    answer = gemini.reply
+    gemini.reply = lambda prompt: (
+        httpx.Response(400, json={"error": {"message": "bad"}}) if "project 1 " in prompt else answer(prompt)
+    )
+    response = asyncio.run(_post("/analyze_changes_batch", {"items": _items(3, "failure")}))
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert "error" in results["1"]
+    assert results["1"]["paragraphIndex"] == 1
+    assert "error" not in results["0"] and "error" not in results["2"]
+
+
+def test_stats_endpoints_run_on_the_event_loop():
+    async def get(path):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get(path)
+
+    for path in ("/cache_stats", "/upstream_stats", "/metrics"):
+        route = next(route for route in main.app.routes if getattr(route, "path", None) == path)
+        assert asyncio.iscoroutinefunction(route.endpoint)
+        assert asyncio.run(get(path)).status_code == 200
+
+
+def test_stream_sends_each_paragraph_when_it_is_done(gemini, monkeypatch):
+    import gemini_client
+
+    answer = gemini.reply
+    gemini.reply = lambda prompt: (
+        httpx.Response(400, json={"error": {"message": "bad"}}) if "project 1 " in prompt else answer(prompt)
+    )
+
+    async def handle(request):
+        # Paragraph 0 is analyzed long after the others
+        if b"project 0 " in request.content:
+            await asyncio.sleep(0.3)
+        return await gemini.handle(request)
+
+    monkeypatch.setattr(gemini_client, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+
+    body = json.dumps({"items": _items(4, "stream")}).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/analyze_changes_batch/stream", "raw_path": b"/analyze_changes_batch/stream",
+        "root_path": "", "query_string": b"", "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 1234), "server": ("test", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    chunks = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        # ASGITransport would only hand over the body once complete: record when each chunk is sent
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks.append((message["body"], time.monotonic() - started))
+
+    started = time.monotonic()
+    asyncio.run(main.app(scope, receive, send))
+    records = [(json.loads(line), elapsed) for chunk, elapsed in chunks for line in chunk.splitlines()]
+    *entries, (summary, _) = records
+    assert sorted(entry["paragraphIndex"] for entry, _ in entries) == [0, 1, 2, 3]
+    # The slow paragraph does not hold back the others
+    assert entries[-1][0]["paragraphIndex"] == 0
+    assert all(elapsed < 0.2 for _, elapsed in entries[:-1]) and entries[-1][1] >= 0.2
+    errors = [entry["paragraphIndex"] for entry, _ in entries if "error" in entry]
+    assert errors == [1]
+    assert summary["summary"]["total"] == 4
+    assert summary["summary"]["succeeded"] == 3
+    assert summary["summary"]["failed"] == 1
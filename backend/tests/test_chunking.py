@@ -0,0 +1,61 @@
+# test_chunking.py
+from chunking import changed_chunks, make_chunks, reduce_analyses
+
+FILLER = "The parties shall cooperate in good faith and keep records of their performance. " * 25
+
+
+def _clause(*sub_clauses):
+    return " ".join(f"{number} {text} {FILLER}" for number, text in sub_clauses)
+
+
+CLAUSE = _clause(
+    ("1.1.", "Any notice under this Agreement shall be given in writing."),
+    ("1.2.", "The Recipient may disclose the information to its advisers."),
+    ("9.1.", "The Recipient shall not disclose the information to third parties."),
+)
+
+
+def _change_json(*changes):
+    return {
+        "original_text": CLAUSE,
+        "modified_text": CLAUSE,
+        "changes": [{"type": change_type, "description": description} for change_type, description in changes],
+    }
+
+
+def _labels(chunks):
+    return [chunk.label for chunk in chunks]
+
+
+def test_changes_are_mapped_on_word_boundaries():
+    chunks = make_chunks(_change_json(("Deleted", "not")))
+    assert _labels(chunks) == ["1.1.", "1.2.", "9.1."]
+    assert _labels(changed_chunks(chunks)) == ["9.1."]
+
+
+def test_ambiguous_changes_go_to_every_matching_chunk():
+    chunks = make_chunks(_change_json(("Deleted", "the information"), ("Added", "promptly")))
+    assert _labels(changed_chunks(chunks)) == ["1.2.", "9.1."]
+    # A change that cannot be located goes to every changed chunk
+    assert all(len(chunk.changes) == 2 for chunk in changed_chunks(chunks))
+
+
+def test_suggested_wording_keeps_one_chunk_per_line():
+    change_json = _change_json(("Deleted", "not"))
+    chunks = make_chunks(change_json)
+    analyzed = changed_chunks(chunks)
+    analysis = {
+        "clauseIdentifier": "9.1.",
+        "analysis": {
+            "clauseCategory": "Confidentiality Obligations",
+            "suggestedWording": "9.1. The Recipient shall not disclose the information.",
+            **{name: name for name in (
+                "summary", "risksDisclosingParty", "risksReceivingParty", "improvementsDisclosingParty",
+                "improvementsReceivingParty", "comments_on_changes",
+            )},
+        },
+    }
+    reduced = reduce_analyses(change_json, chunks, analyzed, [analysis])
+    lines = reduced["analysis"]["suggestedWording"].split("\n")
+    assert [line.split()[0] for line in lines] == ["1.1.", "1.2.", "9.1."]
+    assert lines[2] == "9.1. The Recipient shall not disclose the information."
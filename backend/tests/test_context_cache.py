@@ -0,0 +1,98 @@
+# test_context_cache.py
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import gemini_client
+from context_cache import ContextCache
+
+ANSWER = {"candidates": [{"content": {"parts": [{"text": "{}"}]}}]}
+
+
+class FakeCachingGemini:
+    """
+    Creates cachedContents (after `create_delay` seconds, or failing for the models in `broken`)
+    and answers generateContent with `generate(body)`, an httpx.Response.
+    """
+
+    def __init__(self):
+        self.create_delay = 0.0
+        self.broken = set()
+        self.created = []
+        self.generate = lambda body: httpx.Response(200, json=ANSWER)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content) if request.content else {}
+        if request.url.path.endswith("/cachedContents"):
+            await asyncio.sleep(self.create_delay)
+            if body["model"] in self.broken:
+                return httpx.Response(400, json={"error": {"message": "Model does not support caching"}})
+            self.created.append(body["model"])
+            return httpx.Response(200, json={"name": f"cachedContents/{len(self.created)}"})
+        return self.generate(body)
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeCachingGemini()
+    monkeypatch.setattr(gemini_client, "_client", httpx.AsyncClient(transport=httpx.MockTransport(fake.handle)))
+    return fake
+
+
+def test_slow_creation_does_not_hold_up_other_calls(fake):
+    cache = ContextCache()
+    fake.create_delay = 0.2
+
+    async def run():
+        creating = asyncio.create_task(cache.get("prefix", "model-a"))
+        await asyncio.sleep(0.05)
+        # The same cache is being created: fall back instead of waiting
+        assert await asyncio.wait_for(cache.get("prefix", "model-a"), 0.05) is None
+        fake.create_delay = 0.0
+        assert await asyncio.wait_for(cache.get("prefix", "model-b"), 0.1) is not None
+        assert await creating is not None
+
+    asyncio.run(run())
+    assert fake.created == ["models/model-b", "models/model-a"]
+
+
+def test_failure_only_pauses_caching_for_that_model(fake):
+    cache = ContextCache()
+    fake.broken = {"models/model-a"}
+
+    async def run():
+        assert await cache.get("prefix", "model-a") is None
+        fake.broken = set()
+        assert await cache.get("prefix", "model-a") is None
+        assert await cache.get("prefix", "model-b") is not None
+
+    asyncio.run(run())
+    assert cache.failures == 1
+
+
+def test_only_cache_errors_invalidate_the_cache(fake):
+    cache = ContextCache()
+    sent = []
+
+    def generate(body):
+        sent.append(body)
+        if "cachedContent" not in body:
+            return httpx.Response(200, json=ANSWER)
+        return fake.reply
+
+    fake.generate = generate
+
+    async def run():
+        fake.reply = httpx.Response(400, json={"error": {"message": "Invalid JSON schema"}})
+        with pytest.raises(httpx.HTTPStatusError):
+            await cache.generate("prefix", "suffix", lambda: "prefix suffix")
+        assert cache.stats()["entries"] == 1
+        fake.reply = httpx.Response(403, json={"error": {"message": "CachedContent not found (or permission denied)"}})
+        await cache.generate("prefix", "suffix", lambda: "prefix suffix")
+        assert cache.stats()["entries"] == 0
+
+    asyncio.run(run())
+    assert cache.fallbacks == 1
+    assert "cachedContent" not in sent[-1]
@@ -0,0 +1,162 @@
+# test_deadlines.py
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import deadlines
+import main
+from deadlines import (
+    REQUESTS_CANCELLED, UPSTREAM_CALLS_CANCELLED, ClientDisconnected, Deadline, cancel_on_disconnect,
+    parse_deadline, remaining, run_with_deadline,
+)
+
+CHANGE = {
+    "paragraph": "The Recipient shall keep the information confidential for two years.",
+    "changelog": [{"type": "Added", "text": "two years", "author": "Test"}],
+}
+
+
+def _seconds(deadline):
+    return None if deadline is None else deadline.at - time.monotonic()
+
+
+@pytest.mark.parametrize("header, field, expected", [
+    (None, None, None),
+    ("5", None, 5),
+    ("5", 2, 2),
+    (None, 2, 2),
+    ("soon", None, None),
+    ("0", None, None),
+    (None, -1, None),
+])
+def test_parse_deadline_prefers_the_body_field(header, field, expected):
+    seconds = _seconds(parse_deadline(header, field))
+    if expected is None:
+        assert seconds is None
+    else:
+        assert seconds == pytest.approx(expected, abs=0.05)
+
+
+def test_parse_deadline_caps_client_budgets(monkeypatch):
+    monkeypatch.setattr(deadlines, "MAX_REQUEST_DEADLINE", 10)
+    assert _seconds(parse_deadline("600")) == pytest.approx(10, abs=0.05)
+    assert _seconds(parse_deadline(None, 3)) == pytest.approx(3, abs=0.05)
+    monkeypatch.setattr(deadlines, "DEFAULT_REQUEST_DEADLINE", 60)
+    assert _seconds(parse_deadline(None)) == pytest.approx(10, abs=0.05)
+
+
+def test_nested_deadline_keeps_the_shorter_one():
+    async def budget():
+        return remaining()
+
+    async def scenario():
+        assert await run_with_deadline(budget(), None) is None
+        outer = Deadline(1)
+        assert await run_with_deadline(run_with_deadline(budget(), Deadline(10)), outer) <= 1
+        assert await run_with_deadline(run_with_deadline(budget(), Deadline(0.5)), outer) <= 0.5
+        # The enclosing deadline is back in place afterwards
+        assert remaining() is None
+
+    asyncio.run(scenario())
+
+
+def _receive(*messages, disconnect_after=None):
+    """An ASGI receive channel sending `messages`, then http.disconnect after `disconnect_after` seconds."""
+    pending = list(messages)
+
+    async def receive():
+        if pending:
+            return pending.pop(0)
+        if disconnect_after is None:
+            await asyncio.Event().wait()
+        await asyncio.sleep(disconnect_after)
+        return {"type": "http.disconnect"}
+
+    return receive
+
+
+def test_disconnect_cancels_the_work():
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        task = cancel_on_disconnect(_receive(disconnect_after=0.02), work())
+        with pytest.raises(ClientDisconnected):
+            await task
+        await asyncio.sleep(0)
+
+    before = REQUESTS_CANCELLED.value("disconnect")
+    asyncio.run(scenario())
+    assert cancelled == [True]
+    assert REQUESTS_CANCELLED.value("disconnect") == before + 1
+
+
+def test_finished_work_is_returned_while_connected():
+    async def work():
+        return "done"
+
+    assert asyncio.run(cancel_on_disconnect(_receive(), work())) == "done"
+
+
+def test_batch_deadline_turns_slow_paragraphs_into_errors(gemini):
+    gemini.delay = 1.0
+    items = [{"paragraphIndex": i, **CHANGE, "paragraph": f"{CHANGE['paragraph']} ({i})"} for i in range(2)]
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/analyze_changes_batch", json={"items": items, "deadlineSeconds": 0.1})
+
+    before = UPSTREAM_CALLS_CANCELLED.value("in_flight")
+    started = time.monotonic()
+    response = asyncio.run(scenario())
+    assert time.monotonic() - started < gemini.delay
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert all("error" in entry for entry in results.values())
+    assert UPSTREAM_CALLS_CANCELLED.value("in_flight") == before + 2
+
+
+def test_deadline_header_answers_slow_requests_with_504(gemini):
+    gemini.delay = 1.0
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/analyze_changes", json=CHANGE, headers={"X-Request-Deadline": "0.1"})
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 504
+
+
+def test_client_disconnect_cancels_the_upstream_call(gemini):
+    gemini.delay = 5.0
+    body = json.dumps(CHANGE).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/analyze_changes", "raw_path": b"/analyze_changes", "root_path": "",
+        "query_string": b"", "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 1234), "server": ("test", 80),
+    }
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    before = UPSTREAM_CALLS_CANCELLED.value("in_flight")
+    receive = _receive({"type": "http.request", "body": body, "more_body": False}, disconnect_after=0.1)
+    started = time.monotonic()
+    asyncio.run(main.app(scope, receive, send))
+    assert time.monotonic() - started < gemini.delay
+    assert gemini.prompts and gemini.in_flight == 0
+    assert sent[0]["status"] == main.CLIENT_CLOSED_REQUEST
+    assert UPSTREAM_CALLS_CANCELLED.value("in_flight") == before + 1
@@ -0,0 +1,24 @@
+# test_document_store.py
+import time
+
+from document_store import DocumentStore, paragraph_fingerprint
+
+CHANGE = {"original_text": "The Recipient shall", "modified_text": "The Recipient may", "changes": []}
+
+
+def test_fingerprint_depends_on_the_analysis_namespace():
+    assert paragraph_fingerprint(CHANGE, "model:v1") == paragraph_fingerprint(dict(CHANGE), "model:v1")
+    assert paragraph_fingerprint(CHANGE, "model:v1") != paragraph_fingerprint(CHANGE, "model:v2")
+
+
+def test_expired_results_are_ignored_and_dropped():
+    store = DocumentStore(":memory:", ttl=60)
+    store.save("doc", "fresh", {"summary": "fresh"})
+    store.save("doc", "old", {"summary": "old"})
+    store.save("other", "old", {"summary": "old"})
+    store.flush()
+    store._db.execute("UPDATE document_paragraphs SET updated_at = ? WHERE fingerprint = 'old'", (time.time() - 120,))
+    assert store.results("doc") == {"fresh": {"summary": "fresh"}}
+    store.retain("doc", ["fresh", "old"])
+    store.flush()
+    assert store._db.execute("SELECT COUNT(*) FROM document_paragraphs").fetchone()[0] == 1
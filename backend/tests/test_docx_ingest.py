@@ -0,0 +1,98 @@
+# test_docx_ingest.py
+import asyncio
+import io
+import zipfile
+
+import httpx
+import pytest
+
+import main
+from docx_ingest import DocxError, DocxTooLarge, iter_tracked_paragraphs
+
+NS = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+
+BODY = """
+<w:p><w:r><w:t>Definitions.</w:t></w:r></w:p>
+<w:p>
+  <w:r><w:t xml:space="preserve">The Recipient shall </w:t></w:r>
+  <w:ins w:id="1" w:author="Alice"><w:r><w:t xml:space="preserve">promptly </w:t></w:r></w:ins>
+  <w:del w:id="2" w:author="Bob"><w:r><w:delText xml:space="preserve">immediately </w:delText></w:r></w:del>
+  <w:r><w:t>return the records.</w:t></w:r>
+</w:p>
+<w:tbl><w:tr><w:tc>
+  <w:p><w:r><w:t>Cell without changes</w:t></w:r></w:p>
+  <w:p>
+    <w:r><w:t xml:space="preserve">Term: </w:t></w:r>
+    <w:ins w:id="3" w:author="Carol"><w:r><w:t>five years</w:t></w:r></w:ins>
+  </w:p>
+</w:tc></w:tr></w:tbl>
+<w:p>
+  <w:r>
+    <w:rPr><w:b/><w:rPrChange w:id="4" w:author="Dave"><w:rPr/></w:rPrChange></w:rPr>
+    <w:t>Governing law</w:t>
+  </w:r>
+  <w:r><w:t xml:space="preserve"> is Swiss law.</w:t></w:r>
+</w:p>
+<w:p><w:r><w:t>Signatures.</w:t></w:r></w:p>
+"""
+
+
+def _docx(body=BODY):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", "<Types/>")
+        archive.writestr("word/document.xml", f"<w:document {NS}><w:body>{body}</w:body></w:document>")
+    buffer.seek(0)
+    return buffer
+
+
+def test_tracked_paragraphs_are_extracted_with_their_word_indices():
+    assert list(iter_tracked_paragraphs(_docx())) == [
+        {
+            "paragraphIndex": 1,
+            "paragraph": "The Recipient shall promptly immediately return the records.",
+            "changelog": [
+                {"type": "Added", "text": "promptly ", "author": "Alice"},
+                {"type": "Deleted", "text": "immediately ", "author": "Bob"},
+            ],
+        },
+        # Table cell paragraphs count like any other body paragraph
+        {
+            "paragraphIndex": 3,
+            "paragraph": "Term: five years",
+            "changelog": [{"type": "Added", "text": "five years", "author": "Carol"}],
+        },
+        {
+            "paragraphIndex": 4,
+            "paragraph": "Governing law is Swiss law.",
+            "changelog": [{"type": "Formatted", "text": "Governing law", "author": "Dave"}],
+        },
+    ]
+
+
+def test_invalid_files_are_rejected():
+    with pytest.raises(DocxError):
+        list(iter_tracked_paragraphs(io.BytesIO(b"not a zip")))
+    with pytest.raises(DocxError):
+        list(iter_tracked_paragraphs(_docx("<w:p>")))
+
+
+def test_document_part_is_limited_by_its_uncompressed_size():
+    # Compresses to a fraction of its size, like a zip bomb
+    body = "<w:p><w:r><w:t>filler</w:t></w:r></w:p>" * 2000
+    assert len(_docx(body).getvalue()) < 2000
+    with pytest.raises(DocxTooLarge):
+        list(iter_tracked_paragraphs(_docx(body), max_xml_bytes=10_000))
+
+
+def test_oversized_upload_is_refused(monkeypatch):
+    monkeypatch.setattr(main, "DOCX_MAX_BYTES", 100)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            files = {"file": ("contract.docx", _docx().getvalue())}
+            return await client.post("/analyze_docx", files=files)
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 413
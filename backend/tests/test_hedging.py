@@ -0,0 +1,79 @@
+# test_hedging.py
+import asyncio
+import json
+
+import httpx
+
+import clause_analysis
+import gemini_client
+from hedging import Hedger
+from packing import PACK_INSTRUCTIONS
+
+
+def _hedger():
+    hedger = Hedger(enabled=True, budget=1.0)
+    hedger._delay = 0.02
+    return hedger
+
+
+def _attempts(*answers):
+    """Attempts answering `answers` in turn, each (delay, value)."""
+    calls = iter(answers)
+
+    async def attempt():
+        delay, value = next(calls)
+        await asyncio.sleep(delay)
+        return value
+
+    return attempt
+
+
+def test_hedge_wins_when_the_first_answer_is_not_accepted():
+    attempt = _attempts((0.05, {"valid": False}), (0.1, {"valid": True}))
+    result = asyncio.run(_hedger().run(attempt, lambda answer: answer["valid"]))
+    assert result == {"valid": True}
+
+
+def test_first_answer_is_returned_when_none_is_accepted():
+    attempt = _attempts((0.05, {"valid": False, "call": 1}), (0.06, {"valid": False, "call": 2}))
+    result = asyncio.run(_hedger().run(attempt, lambda answer: answer["valid"]))
+    assert result == {"valid": False, "call": 1}
+
+
+def _change(i):
+    return {
+        "paragraph_id": None,
+        "original_text": f"The Recipient shall destroy all records of matter {i} on request.",
+        "modified_text": "",
+        "changes": [{"type": "Added", "description": f"within {i + 5} days"}],
+    }
+
+
+def test_pack_calls_are_hedged_until_every_item_is_valid(gemini, monkeypatch):
+    monkeypatch.setattr(clause_analysis, "hedger", _hedger())
+    single = gemini.reply
+    packed_calls = []
+
+    def reply(prompt):
+        if PACK_INSTRUCTIONS not in prompt:
+            return single(prompt)
+        packed_calls.append(prompt)
+        indexes = [item["paragraphIndex"] for item in json.loads(prompt.split(PACK_INSTRUCTIONS, 1)[1])]
+        entries = [{**json.loads(single(prompt)), "paragraphIndex": index} for index in indexes]
+        if len(packed_calls) == 1:
+            # Parses, but the first item does not match the schema
+            entries[0] = {"paragraphIndex": indexes[0], "summary": "incomplete"}
+        return json.dumps(entries)
+
+    async def handle(request):
+        # Slower than the hedge delay, so the hedge is sent before the first answer arrives
+        await asyncio.sleep(0.05)
+        return await gemini.handle(request)
+
+    monkeypatch.setattr(gemini_client, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+    gemini.reply = reply
+    results = asyncio.run(clause_analysis.analyze_clause_pack([(i, _change(i)) for i in range(3)]))
+    assert all(not isinstance(result, Exception) for result in results.values())
+    assert len(packed_calls) == 2
+    # The hedge's answer was complete, so no item was retried on its own
+    assert len(gemini.prompts) == 2
@@ -0,0 +1,94 @@
+# test_jobs.py
+import asyncio
+
+import httpx
+
+import main
+from jobs import CANCELLED, DONE, JobQueue, JobStore
+
+
+def _request(count):
+    return {"items": [{"paragraphIndex": i, "paragraph": f"Paragraph {i}", "changelog": []} for i in range(count)]}
+
+
+def _run_batch(request, finished):
+    async def unit(item):
+        await asyncio.sleep(0.01)
+        return [{"paragraphIndex": item["paragraphIndex"], "summary": "ok"}]
+    return [unit(item) for item in request["items"] if item["paragraphIndex"] not in finished]
+
+
+async def _wait_for_status(store, job_id, status):
+    for _ in range(200):
+        job = store.get(job_id)
+        if job["status"] == status:
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"job stayed {store.get(job_id)['status']}")
+
+
+def test_submitted_job_wakes_an_idle_worker():
+    async def scenario():
+        # Polling alone would take far longer than the test waits
+        queue = JobQueue(JobStore(":memory:"), _run_batch, workers=1, poll_interval=60)
+        await queue.start()
+        await asyncio.sleep(0.05)
+        try:
+            job_id = await queue.submit(_request(3))
+            job = await _wait_for_status(queue.store, job_id, DONE)
+        finally:
+            await queue.stop()
+        assert job["completed"] == 3 and job["failed"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_running_job_can_be_cancelled():
+    def slow_batch(request, finished):
+        async def unit(item):
+            await asyncio.sleep(10)
+            return []
+        return [unit(item) for item in request["items"] if item["paragraphIndex"] not in finished]
+
+    async def scenario():
+        queue = JobQueue(JobStore(":memory:"), slow_batch, workers=1, poll_interval=60)
+        await queue.start()
+        try:
+            job_id = await queue.submit(_request(2))
+            await asyncio.sleep(0.05)
+            assert await queue.cancel(job_id)
+            await _wait_for_status(queue.store, job_id, CANCELLED)
+            assert not await queue.cancel(job_id)
+        finally:
+            await queue.stop()
+
+    asyncio.run(scenario())
+
+
+def test_jobs_reject_deadlines():
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/jobs", json={**_request(1), "deadlineSeconds": 5})
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 400
+
+
+def test_resumed_job_keeps_the_stored_results_of_its_finished_paragraphs(gemini):
+    request = main.AnalyzeChangesBatchRequest(documentId="resumed-doc", items=[
+        {"paragraphIndex": i, "paragraph": f"The Recipient shall return the records of matter {i}.",
+         "changelog": [{"type": "Insertion", "text": f"within {i + 5} days", "author": "Counsel"}]}
+        for i in range(3)
+    ])
+
+    async def run(finished=()):
+        return [entry for entries in await asyncio.gather(*main._batch_work(request, finished=finished))
+                for entry in entries]
+
+    assert len(asyncio.run(run())) == 3
+    main.document_store.flush()
+    # Only the unfinished paragraph is answered; the whole document is still retained
+    assert [entry["paragraphIndex"] for entry in asyncio.run(run(finished={0, 1}))] == [2]
+    main.document_store.flush()
+    assert len(main.document_store.results("resumed-doc")) == 3
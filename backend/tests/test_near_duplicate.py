@@ -0,0 +1,50 @@
+# test_near_duplicate.py
+from near_duplicate import NearDuplicateIndex
+
+CLAUSE = (
+    "The Recipient shall keep all Confidential Information strictly confidential and shall use it "
+    "solely for the purpose of evaluating the proposed transaction between the parties."
+)
+
+
+def _change(text, *changes):
+    return {
+        "original_text": text,
+        "modified_text": text,
+        "changes": [{"type": change_type, "description": description} for change_type, description in changes],
+    }
+
+
+def test_near_identical_clause_reuses_the_analysis():
+    index = NearDuplicateIndex(threshold=0.8)
+    index.add("ns", _change(CLAUSE, ("Added", "and its affiliates")), {"summary": "stored"})
+    similar = CLAUSE.replace("The Recipient", "Recipient")
+    similarity, analysis = index.lookup("ns", _change(similar, ("Added", "and its affiliates")))
+    assert similarity >= 0.8
+    assert analysis == {"summary": "stored"}
+    assert index.lookup("other", _change(similar, ("Added", "and its affiliates"))) is None
+
+
+def test_changes_to_negations_or_numbers_are_not_reused():
+    index = NearDuplicateIndex(threshold=0.5)
+    index.add("ns", _change(CLAUSE, ("Added", "within 30 days of any request by the Discloser")), {"summary": "a"})
+    index.add("ns", _change(CLAUSE, ("Deleted", "shall"), ("Added", "may")), {"summary": "b"})
+    assert index.lookup("ns", _change(CLAUSE, ("Added", "within 60 days of any request by the Discloser"))) is None
+    assert index.lookup("ns", _change(CLAUSE, ("Added", "not within 30 days of any request by the Discloser"))) is None
+    assert index.lookup("ns", _change(CLAUSE, ("Deleted", "shall"), ("Added", "shall not"))) is None
+    assert index.lookup("ns", _change(CLAUSE, ("Deleted", "shall"), ("Added", "may")))[1] == {"summary": "b"}
+
+
+def test_indexes_sharing_a_database_read_their_own_rows(tmp_path):
+    path = str(tmp_path / "near_dup.sqlite3")
+    first = NearDuplicateIndex(db_path=path)
+    second = NearDuplicateIndex(db_path=path)
+    other = CLAUSE.replace("evaluating the proposed transaction", "performing the services agreement")
+    first.add("ns", _change(CLAUSE, ("Added", "and its affiliates")), {"summary": "first"})
+    first.flush()
+    second.add("ns", _change(other, ("Added", "and its advisers")), {"summary": "second"})
+    second.flush()
+    assert first.lookup("ns", _change(CLAUSE, ("Added", "and its affiliates")))[1] == {"summary": "first"}
+    assert second.lookup("ns", _change(other, ("Added", "and its advisers")))[1] == {"summary": "second"}
+    reloaded = NearDuplicateIndex(db_path=path)
+    assert reloaded.lookup("ns", _change(other, ("Added", "and its advisers")))[1] == {"summary": "second"}
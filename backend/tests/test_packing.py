@@ -0,0 +1,77 @@
+# test_packing.py
+import asyncio
+import json
+
+import httpx
+
+from clause_analysis import analyze_clause_pack
+from metrics import PACK_FALLBACKS
+from packing import PACK_INSTRUCTIONS, pack_items, parse_packed_array
+
+
+def _change(i):
+    return {
+        "paragraph_id": None,
+        "original_text": f"The Recipient shall return all documents of project {i} within thirty days.",
+        "modified_text": "",
+        "changes": [{"type": "Added", "description": f"and delete all copies {i}"}],
+    }
+
+
+def _packed_indexes(prompt):
+    return [item["paragraphIndex"] for item in json.loads(prompt.split(PACK_INSTRUCTIONS, 1)[1])]
+
+
+def test_pack_items_respects_the_item_limit():
+    items = [(i, _change(i)) for i in range(20)]
+    packs = pack_items(items, max_items=8)
+    assert [index for pack in packs for index, _ in pack] == list(range(20))
+    assert all(len(pack) <= 8 for pack in packs)
+
+
+def test_parse_packed_array_keeps_only_objects():
+    text = 'Here you go:\n```json\n[{"paragraphIndex": 1}, "noise", {"paragraphIndex": 2},]\n```'
+    assert parse_packed_array(text) == [{"paragraphIndex": 1}, {"paragraphIndex": 2}]
+    assert parse_packed_array("no array here") == []
+
+
+def test_packed_answer_is_split_and_gaps_are_analyzed_individually(gemini):
+    single = gemini.reply
+
+    def reply(prompt):
+        if PACK_INSTRUCTIONS not in prompt:
+            return single(prompt)
+        entries = []
+        for index in _packed_indexes(prompt):
+            if index == 1:
+                continue  # missing from the array
+            entry = {**json.loads(single(prompt)), "paragraphIndex": index}
+            if index == 2:
+                entry = {"paragraphIndex": index, "summary": "incomplete"}
+            entries.append(entry)
+        return json.dumps(entries)
+
+    gemini.reply = reply
+    missing_before = PACK_FALLBACKS.value("missing")
+    invalid_before = PACK_FALLBACKS.value("invalid")
+    results = asyncio.run(analyze_clause_pack([(i, _change(i)) for i in range(4)]))
+
+    assert sorted(results) == [0, 1, 2, 3]
+    assert all(not isinstance(result, Exception) for result in results.values())
+    packed_calls = [prompt for prompt in gemini.prompts if PACK_INSTRUCTIONS in prompt]
+    assert len(packed_calls) == 1
+    # Paragraphs 1 (missing) and 2 (invalid) were retried on their own
+    assert len(gemini.prompts) == 3
+    assert PACK_FALLBACKS.value("missing") == missing_before + 1
+    assert PACK_FALLBACKS.value("invalid") == invalid_before + 1
+
+
+def test_failed_packed_call_falls_back_to_individual_calls(gemini):
+    single = gemini.reply
+    gemini.reply = lambda prompt: (
+        httpx.Response(400, json={"error": {"message": "bad"}}) if PACK_INSTRUCTIONS in prompt else single(prompt)
+    )
+    before = PACK_FALLBACKS.value("upstream_error")
+    results = asyncio.run(analyze_clause_pack([(i, _change(i + 10)) for i in range(3)]))
+    assert all(not isinstance(result, Exception) for result in results.values())
+    assert PACK_FALLBACKS.value("upstream_error") == before + 3
@@ -0,0 +1,100 @@
+# test_profiling.py
+import asyncio
+import os
+
+import httpx
+import pytest
+
+import profiling
+from profiling import PROFILE_TRACE_HEADER, ProfilingMiddleware, prune_traces, traced
+
+
+@traced("work")
+async def _work():
+    await asyncio.sleep(0)
+
+
+async def _app(scope, receive, send):
+    await _work()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "PROFILE_SECRET", "s3cret")
+    return tmp_path
+
+
+def _get(headers):
+    async def get():
+        transport = httpx.ASGITransport(app=ProfilingMiddleware(_app))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/", headers=headers)
+
+    return asyncio.run(get())
+
+
+def test_profile_header_needs_the_secret(profile_dir, monkeypatch):
+    assert PROFILE_TRACE_HEADER not in _get({"X-Profile": "cpu"}).headers
+    assert PROFILE_TRACE_HEADER not in _get({"X-Profile": "cpu", "X-Profile-Key": "guess"}).headers
+    monkeypatch.setattr(profiling, "PROFILE_SECRET", "")
+    assert PROFILE_TRACE_HEADER not in _get({"X-Profile": "1", "X-Profile-Key": ""}).headers
+    assert os.listdir(profile_dir) == []
+
+
+def test_profiled_request_writes_a_trace(profile_dir):
+    response = _get({"X-Profile": "cpu", "X-Profile-Key": "s3cret"})
+    assert os.listdir(profile_dir) == [response.headers[PROFILE_TRACE_HEADER]]
+
+
+def test_trace_without_room_for_spans_is_still_written(profile_dir, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_MAX_SPANS", 0)
+    response = _get({"X-Profile": "1", "X-Profile-Key": "s3cret"})
+    assert response.status_code == 200
+    assert os.listdir(profile_dir) == [response.headers[PROFILE_TRACE_HEADER]]
+
+
+def test_only_the_newest_traces_are_kept(tmp_path):
+    for i in range(5):
+        path = tmp_path / f"{i}.trace.json"
+        path.write_text("{}")
+        os.utime(path, (1000 + i, 1000 + i))
+    (tmp_path / "notes.txt").write_text("kept")
+    prune_traces(str(tmp_path), 2)
+    assert sorted(os.listdir(tmp_path)) == ["3.trace.json", "4.trace.json", "notes.txt"]
+
+
+def test_batch_request_traces_its_upstream_calls(gemini, monkeypatch):
+    import main
+
+    monkeypatch.setattr(profiling, "PROFILE_SECRET", "s3cret")
+    traces = []
+    monkeypatch.setattr(profiling, "write_trace", lambda trace, path: traces.append(trace))
+    body = {"items": [{
+        "paragraphIndex": 0,
+        "paragraph": "The Recipient shall keep the information of the profiled project confidential.",
+        "changelog": [{"type": "Added", "text": "for five years", "author": "Test"}],
+    }]}
+
+    async def post():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post(
+                "/analyze_changes_batch", json=body, headers={"X-Profile": "1", "X-Profile-Key": "s3cret"}
+            )
+
+    assert asyncio.run(post()).status_code == 200
+    spans = {span.span_id: span for span in traces[0].spans}
+
+    def ancestors(span):
+        names = []
+        while span.parent_id is not None:
+            span = spans[span.parent_id]
+            names.append(span.name)
+        return names
+
+    upstream = next(span for span in spans.values() if span.name == "generate_content")
+    assert ancestors(upstream)[:3] == ["call_google_gemini_api", "analyze_clause_change", "analyze_changes"]
+    assert ancestors(upstream)[-1] == "POST /analyze_changes_batch"
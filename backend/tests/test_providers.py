@@ -0,0 +1,134 @@
+# test_providers.py
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import gemini_client
+from clause_analysis import ANALYSIS_SCHEMA, PACKED_SCHEMA
+from providers import GeminiProvider, OpenAICompatibleProvider, ProviderPool
+
+
+def _gemini(name, **kwargs):
+    return GeminiProvider(name, f"{name}-key", "http://gemini.test/v1beta", **kwargs)
+
+
+def _answer(text):
+    return httpx.Response(200, json={"candidates": [{"content": {"parts": [{"text": text}]}}]})
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """
+    A pool of the Gemini keys "a" and "b" behind a fake API that answers each key with
+    `replies[key]()` and records the keys called, in order.
+    """
+    calls = []
+    replies = {"a": lambda: _answer("from a"), "b": lambda: _answer("from b")}
+
+    def handle(request):
+        key = request.url.params["key"].removesuffix("-key")
+        calls.append(key)
+        return replies[key]()
+
+    pool = ProviderPool([_gemini("a"), _gemini("b")])
+    monkeypatch.setattr(gemini_client, "provider_pool", pool)
+    monkeypatch.setattr(gemini_client, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+    return pool, replies, calls
+
+
+def _text(data):
+    return data["candidates"][0]["content"]["parts"][0]["text"]
+
+
+def test_pool_prefers_the_provider_with_the_shortest_expected_wait():
+    slow, fast = _gemini("slow"), _gemini("fast")
+    slow.latency, fast.latency = 2.0, 0.5
+    pool = ProviderPool([slow, fast])
+    assert pool.choose() is fast
+    # Calls in flight add to the wait
+    fast.in_flight = 4
+    assert pool.choose() is slow
+    assert pool.choose(exclude=[slow]) is fast
+
+
+def test_pool_avoids_a_provider_out_of_local_quota():
+    limited, spare = _gemini("limited", rpm=60), _gemini("spare", rpm=60)
+    limited.request_bucket.tokens = 0
+    limited.request_bucket.updated = time.monotonic()
+    pool = ProviderPool([limited, spare])
+    assert pool.choose() is spare
+    spare.request_bucket.tokens = 0
+    spare.request_bucket.updated = limited.request_bucket.updated - 0.5
+    assert pool.choose() is spare
+
+
+def test_rate_limited_provider_cools_down_for_its_retry_after(upstream):
+    pool, replies, calls = upstream
+    replies["a"] = lambda: httpx.Response(429, headers={"Retry-After": "30"})
+    data = asyncio.run(gemini_client.generate_content("prompt"))
+    assert _text(data) == "from b"
+    assert calls == ["a", "b"]
+    a, b = pool.members
+    assert not a.available() and b.available()
+    # Until the cooldown ends, calls go to the other key only
+    asyncio.run(gemini_client.generate_content("prompt"))
+    assert calls == ["a", "b", "b"]
+
+
+@pytest.mark.parametrize("status", [401, 403])
+def test_rejected_key_fails_over_to_the_next_one(upstream, status):
+    pool, replies, calls = upstream
+    replies["a"] = lambda: httpx.Response(status, json={"error": {"message": "API key not valid"}})
+    data = asyncio.run(gemini_client.generate_content("prompt"))
+    assert _text(data) == "from b"
+    assert calls == ["a", "b"]
+    assert pool.members[0].failures == 1
+
+
+def test_rejected_key_is_raised_without_an_alternative(upstream, monkeypatch):
+    pool, replies, calls = upstream
+    monkeypatch.setattr(gemini_client, "provider_pool", ProviderPool(pool.members[:1]))
+    replies["a"] = lambda: httpx.Response(401)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(gemini_client.generate_content("prompt"))
+    assert calls == ["a"]
+
+
+def test_chat_completions_answer_is_returned_in_the_gemini_shape(monkeypatch):
+    requests = []
+
+    def handle(request):
+        requests.append(request)
+        return httpx.Response(200, json={
+            "choices": [{"message": {"role": "assistant", "content": '{"ok": true}'}}],
+            "usage": {"prompt_tokens": 12, "completion_tokens": 3},
+        })
+
+    provider = OpenAICompatibleProvider("local", "http://llm.test/v1/", "local-model", api_key="secret")
+    monkeypatch.setattr(gemini_client, "provider_pool", ProviderPool([provider]))
+    monkeypatch.setattr(gemini_client, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+    data = asyncio.run(gemini_client.generate_content("prompt", response_schema=ANALYSIS_SCHEMA))
+    assert data == {
+        "candidates": [{"content": {"parts": [{"text": '{"ok": true}'}], "role": "model"}}],
+        "usageMetadata": {"promptTokenCount": 12, "candidatesTokenCount": 3},
+    }
+    request, = requests
+    assert str(request.url) == "http://llm.test/v1/chat/completions"
+    assert request.headers["Authorization"] == "Bearer secret"
+    body = json.loads(request.content)
+    assert body["model"] == "local-model"
+    assert body["messages"] == [{"role": "user", "content": "prompt"}]
+
+
+def test_json_mode_is_only_requested_for_object_schemas():
+    provider = OpenAICompatibleProvider("local", "http://llm.test/v1", "local-model")
+    _, single, _, _ = provider.build_request("prompt", "gemini", ANALYSIS_SCHEMA, None)
+    assert single["response_format"] == {"type": "json_object"}
+    # JSON mode would force an object where a packed call expects a top-level array
+    _, packed, _, _ = provider.build_request("prompt", "gemini", PACKED_SCHEMA, None)
+    assert "response_format" not in packed
+    _, plain, _, _ = provider.build_request("prompt", "gemini", None, None)
+    assert "response_format" not in plain
@@ -0,0 +1,41 @@
+# test_rate_limit.py
+import asyncio
+
+import httpx
+import pytest
+
+import gemini_client
+from rate_limit import backoff_delay, parse_retry_after
+
+
+def _response(status, **kwargs):
+    return httpx.Response(status, request=httpx.Request("POST", "http://gemini.test"), **kwargs)
+
+
+@pytest.mark.parametrize("kwargs, expected", [
+    ({"headers": {"Retry-After": "7"}}, 7.0),
+    ({"json": {"error": {"details": [{"@type": "RetryInfo", "retryDelay": "30s"}]}}}, 30.0),
+    ({"json": {"error": {"details": ["quota exceeded", {"retryDelay": "2.5s"}]}}}, 2.5),
+    ({"json": {"error": {"details": ["quota exceeded", 42]}}}, None),
+    ({"json": {"error": {"details": "quota exceeded"}}}, None),
+    ({"json": {"error": "quota exceeded"}}, None),
+    ({"json": ["quota exceeded"]}, None),
+    ({"content": b"<html>Too Many Requests</html>"}, None),
+])
+def test_parse_retry_after(kwargs, expected):
+    assert parse_retry_after(_response(429, **kwargs)) == expected
+
+
+def test_backoff_never_undercuts_the_server_delay():
+    assert all(backoff_delay(attempt, 1, 30, retry_after=5) >= 5 for attempt in range(5))
+    assert all(backoff_delay(attempt, 1, 30) <= 30 for attempt in range(10))
+
+
+def test_malformed_rate_limit_answer_is_retried(gemini, monkeypatch):
+    monkeypatch.setattr(gemini_client, "GEMINI_BACKOFF_MAX", 0.01)
+    answers = [_response(429, json={"error": {"details": ["not a dict"]}})]
+    single = gemini.reply
+    gemini.reply = lambda prompt: answers.pop() if answers else single(prompt)
+    data = asyncio.run(gemini_client.generate_content("prompt"))
+    assert data["candidates"]
+    assert len(gemini.prompts) == 2
@@ -0,0 +1,75 @@
+# test_scheduler.py
+import asyncio
+
+from rate_limit import TokenBucket
+from scheduler import BATCH, INTERACTIVE, Scheduler
+
+
+def test_waiter_cancelled_as_a_slot_frees_up_does_not_leak_it():
+    scheduler = Scheduler(concurrency=1, interactive_reserve=0)
+
+    async def scenario():
+        held = await scheduler.acquire(BATCH, "doc")
+        cancelled = asyncio.ensure_future(scheduler.acquire(BATCH, "doc"))
+        waiting = asyncio.ensure_future(scheduler.acquire(BATCH, "doc"))
+        await asyncio.sleep(0)
+        # Cancelled in the same loop iteration as the release, before it could unqueue itself
+        cancelled.cancel()
+        scheduler.release(held)
+        assert await asyncio.wait_for(waiting, 1) == BATCH
+        scheduler.release(BATCH)
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert cancelled.cancelled()
+
+    asyncio.run(scenario())
+    stats = scheduler.stats()
+    assert stats["batch"]["in_flight"] == 0 and stats["batch"]["queued"] == 0
+    assert stats["batch"]["served"] == 2
+
+
+def test_slots_are_accounted_per_class():
+    scheduler = Scheduler(concurrency=2, interactive_reserve=1)
+
+    async def scenario():
+        batch = await scheduler.acquire(BATCH, "doc")
+        queued = asyncio.ensure_future(scheduler.acquire(BATCH, "doc"))
+        await asyncio.sleep(0)
+        # The reserved slot is left to interactive calls
+        assert not queued.done()
+        interactive = await asyncio.wait_for(scheduler.acquire(INTERACTIVE, "user"), 1)
+        assert interactive == INTERACTIVE
+        scheduler.release(interactive)
+        assert not queued.done()
+        scheduler.release(batch)
+        scheduler.release(await queued)
+
+    asyncio.run(scenario())
+    stats = scheduler.stats()
+    assert [stats[name]["in_flight"] for name in ("interactive", "batch")] == [0, 0]
+    assert [stats[name]["served"] for name in ("interactive", "batch")] == [1, 2]
+
+
+def test_urgent_callers_get_the_budget_before_waiting_ones():
+    bucket = TokenBucket(rate_per_minute=1200, capacity=1)
+    order = []
+
+    async def take(name, urgent):
+        await bucket.acquire(1, urgent)
+        order.append(name)
+
+    async def scenario():
+        await bucket.acquire(1)
+        first = asyncio.ensure_future(take("batch", False))
+        await asyncio.sleep(0)
+        await asyncio.gather(first, take("interactive", True))
+
+    asyncio.run(scenario())
+    assert order == ["interactive", "batch"]
+
+
+def test_default_concurrency_matches_the_connection_pool():
+    import gemini_client
+    import scheduler
+
+    assert scheduler.SCHEDULER_CONCURRENCY == gemini_client.GEMINI_MAX_CONNECTIONS
+    assert scheduler.scheduler.batch_limit == gemini_client.GEMINI_MAX_CONNECTIONS - scheduler.SCHEDULER_INTERACTIVE_RESERVE
@@ -0,0 +1,158 @@
+# test_single_flight.py
+import asyncio
+
+import pytest
+
+from deadlines import Deadline, DeadlineExceeded, remaining, run_with_deadline
+from scheduler import BATCH, INTERACTIVE, Scheduler, _request_class, run_as, shared_context
+from single_flight import SingleFlight
+
+
+def test_callers_share_one_call_and_its_error():
+    flights = SingleFlight()
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def scenario():
+        return await asyncio.gather(*(flights.do("key", failing) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flights.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 2}
+
+
+def test_shared_call_is_cancelled_only_when_every_caller_is():
+    flights = SingleFlight()
+    cancelled = asyncio.Event()
+
+    async def slow():
+        try:
+            await asyncio.sleep(0.05)
+            return "result"
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def scenario():
+        first = asyncio.ensure_future(flights.do("key", slow))
+        second = asyncio.ensure_future(flights.do("key", slow))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == "result"
+        assert not cancelled.is_set()
+
+        third = asyncio.ensure_future(flights.do("other", slow))
+        fourth = asyncio.ensure_future(flights.do("other", slow))
+        await asyncio.sleep(0.01)
+        third.cancel()
+        fourth.cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled.is_set()
+        assert flights.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_each_caller_keeps_its_own_deadline():
+    flights = SingleFlight()
+    seen_deadlines = []
+
+    async def slow():
+        seen_deadlines.append(remaining())
+        await asyncio.sleep(0.1)
+        return "result"
+
+    async def scenario():
+        hurried = asyncio.ensure_future(run_with_deadline(flights.do("key", slow), Deadline(0.02)))
+        await asyncio.sleep(0)
+        patient = asyncio.ensure_future(flights.do("key", slow))
+        with pytest.raises(DeadlineExceeded):
+            await hurried
+        assert await patient == "result"
+
+    asyncio.run(scenario())
+    # The shared call does not run under the first caller's deadline
+    assert seen_deadlines == [None]
+
+
+def test_shared_call_runs_in_the_most_urgent_class_of_its_callers():
+    flights = SingleFlight()
+    classes = []
+    joined = asyncio.Event()
+
+    async def shared():
+        await joined.wait()
+        classes.append(_request_class()[0])
+        return "result"
+
+    async def scenario():
+        leader = asyncio.ensure_future(run_as(flights.do("key", shared), BATCH, "document"))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(run_as(flights.do("key", shared), INTERACTIVE, "user"))
+        await asyncio.sleep(0)
+        joined.set()
+        return await asyncio.gather(leader, follower)
+
+    assert asyncio.run(scenario()) == ["result", "result"]
+    assert classes == [INTERACTIVE]
+
+
+def test_promotion_moves_queued_shared_calls_ahead():
+    scheduler = Scheduler(concurrency=1, interactive_reserve=0)
+    order = []
+
+    async def call(name):
+        async with scheduler.slot():
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        blocker = asyncio.ensure_future(run_as(call("blocker"), BATCH, "a"))
+        await asyncio.sleep(0)
+        other = asyncio.ensure_future(run_as(call("other batch"), BATCH, "b"))
+        await asyncio.sleep(0)
+        context, shared = shared_context()
+        shared_call = asyncio.get_running_loop().create_task(call("shared"), context=context)
+        await asyncio.sleep(0)
+        await run_as(_promote(scheduler, shared), INTERACTIVE, "user")
+        await asyncio.gather(blocker, other, shared_call)
+        assert scheduler.stats()["interactive"]["in_flight"] == 0
+        assert scheduler.stats()["batch"]["in_flight"] == 0
+
+    asyncio.run(scenario())
+    assert order == ["blocker", "shared", "other batch"]
+
+
+async def _promote(scheduler, shared):
+    scheduler.promote(shared)
+
+
+def test_shared_call_is_traced_under_the_leaders_span():
+    import profiling
+
+    flights = SingleFlight()
+
+    @profiling.traced("shared")
+    async def shared():
+        await asyncio.sleep(0.01)
+        return "result"
+
+    @profiling.traced("caller")
+    async def caller():
+        return await flights.do("key", shared)
+
+    async def scenario():
+        trace = profiling.Trace("request")
+        profiling._trace.set(trace)
+        await asyncio.gather(caller(), caller())
+        return trace
+
+    trace = asyncio.run(scenario())
+    spans = {span.name: span for span in trace.spans}
+    assert [span.name for span in trace.spans].count("shared") == 1
+    assert spans["shared"].parent_id in {span.span_id for span in trace.spans if span.name == "caller"}
@@ -0,0 +1,96 @@
+# test_structured_output.py
+import json
+
+import pytest
+
+from clause_analysis import ClauseAnalysisResponse
+from conftest import ANALYSIS
+from structured_output import balanced_candidates, complete_fields, gemini_schema, parse_json, repair_json
+
+ANALYSIS_FIELDS = list(ANALYSIS["analysis"])
+FLAT = {"clauseIdentifier": ANALYSIS["clauseIdentifier"], "originalClauseText": ANALYSIS["originalClauseText"],
+        **ANALYSIS["analysis"]}
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": 1}', ['{"a": 1}']),
+    ('Here you go:\n```json\n{"a": {"b": [1, 2]}}\n```', ['{"a": {"b": [1, 2]}}']),
+    ('{"a": "}"} and {"b": "{"}', ['{"a": "}"}', '{"b": "{"}']),
+    ('{"a": "say \\"}\\" twice"}', ['{"a": "say \\"}\\" twice"}']),
+    ('no json here', []),
+    ('{"a": [1, {"b": 2', ['{"a": [1, {"b": 2']),
+])
+def test_balanced_candidates(text, expected):
+    assert list(balanced_candidates(text)) == expected
+
+
+def test_balanced_candidates_of_arrays():
+    assert list(balanced_candidates('packed: [{"a": "]"}, {"b": 2}] done', "[")) == ['[{"a": "]"}, {"b": 2}]']
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": 1,}', {"a": 1}),
+    ('{"a": [1, 2, ], }', {"a": [1, 2]}),
+    ('{"a": "x, }"}', {"a": "x, }"}),
+    ('{"a": "trunc', {"a": "trunc"}),
+    ('{"a": "ends in \\', {"a": "ends in "}),
+    ('{"a": 1, "b":', {"a": 1, "b": None}),
+    ('{"a": [1, {"b": "c"', {"a": [1, {"b": "c"}]}),
+    ('{"a": "line\nbreak"}', {"a": "line\nbreak"}),
+])
+def test_repair_json(text, expected):
+    assert json.loads(repair_json(text)) == expected
+
+
+def test_parse_json_repairs_output_in_prose():
+    text = 'Sure!\n{"clauseIdentifier": "Clause 1", "analysis": {"summary": "cut off'
+    assert parse_json(text) == {"clauseIdentifier": "Clause 1", "analysis": {"summary": "cut off"}}
+    assert parse_json("I cannot help with that.") is None
+
+
+def _without(*fields):
+    analysis = {name: value for name, value in ANALYSIS["analysis"].items() if name not in fields}
+    return {**ANALYSIS, "analysis": analysis}
+
+
+@pytest.mark.parametrize("data, expected", [
+    (ANALYSIS, ANALYSIS),
+    # Analysis fields returned at the top level are moved into the analysis
+    (FLAT, {**FLAT, "analysis": ANALYSIS["analysis"]}),
+    (_without("comments_on_changes"), {**ANALYSIS, "analysis": {**ANALYSIS["analysis"], "comments_on_changes": ""}}),
+    (_without("summary", "suggestedWording"),
+     {**ANALYSIS, "analysis": {**ANALYSIS["analysis"], "summary": "", "suggestedWording": ""}}),
+    (_without("summary", "suggestedWording", "comments_on_changes"), None),
+    ({**ANALYSIS, "analysis": "not an object"}, None),
+])
+def test_complete_fields(data, expected):
+    assert complete_fields(data, ClauseAnalysisResponse) == expected
+
+
+def test_complete_fields_uses_defaults_and_joins_lists():
+    data = {**ANALYSIS, "originalClauseText": None,
+            "analysis": {**ANALYSIS["analysis"], "risksReceivingParty": ["One.", "Two."]}}
+    completed = complete_fields(data, ClauseAnalysisResponse, defaults={"originalClauseText": "The clause."})
+    assert completed["originalClauseText"] == "The clause."
+    assert completed["analysis"]["risksReceivingParty"] == "One.\nTwo."
+    assert complete_fields(data, ClauseAnalysisResponse, max_missing=0) is None
+
+
+def test_gemini_schema_of_the_analysis_response():
+    string = {"type": "STRING"}
+    assert gemini_schema(ClauseAnalysisResponse) == {
+        "type": "OBJECT",
+        # The optional fields set by the backend are left out
+        "properties": {
+            "clauseIdentifier": string,
+            "originalClauseText": string,
+            "analysis": {
+                "type": "OBJECT",
+                "properties": {name: string for name in ANALYSIS_FIELDS},
+                "required": ANALYSIS_FIELDS,
+                "propertyOrdering": ANALYSIS_FIELDS,
+            },
+        },
+        "required": ["clauseIdentifier", "originalClauseText", "analysis"],
+        "propertyOrdering": ["clauseIdentifier", "originalClauseText", "analysis"],
+    }
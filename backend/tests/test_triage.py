@@ -0,0 +1,47 @@
+# test_triage.py
+import pytest
+
+from triage import triage_analysis, triage_rules
+
+
+def _change_json(changes, text="1. The Receiving Party shall pay 5% of the fees under clause 2. of this Agreement."):
+    return {
+        "original_text": text,
+        "modified_text": text,
+        "changes": [{"type": change_type, "description": description} for change_type, description in changes],
+    }
+
+
+@pytest.mark.parametrize("changes, rules", [
+    ([("Formatted", "bold")], ["formatting"]),
+    ([("Added", "  ")], ["whitespace"]),
+    ([("Added", ","), ("Deleted", ";")], ["punctuation"]),
+    ([("Deleted", "receiving party"), ("Added", "Receiving Party")], ["capitalization"]),
+    ([("Added", "1.")], ["numbering"]),
+])
+def test_editorial_changes_are_triaged(changes, rules):
+    assert triage_rules(_change_json(changes)) == rules
+
+
+@pytest.mark.parametrize("changes", [
+    # Swapping the parties is substantive even though each pair of texts matches case-insensitively
+    [("Deleted", "Receiving"), ("Added", "Disclosing"), ("Deleted", "Disclosing"), ("Added", "Receiving")],
+    [("Deleted", "Receiving"), ("Added", "Receiving")],
+    # A cross-reference, not the paragraph's number
+    [("Deleted", "2."), ("Added", "9.")],
+    [("Added", "%")],
+    [("Deleted", "$")],
+    [("Added", ">")],
+    [("Added", "not")],
+    [],
+])
+def test_material_changes_go_to_the_llm(changes):
+    assert triage_rules(_change_json(changes)) is None
+    assert triage_analysis(_change_json(changes)) is None
+
+
+def test_triaged_analysis_keeps_the_clause_text():
+    change_json = _change_json([("Added", ".")])
+    analysis = triage_analysis(change_json)
+    assert analysis["triageRule"] == "punctuation"
+    assert analysis["analysis"]["suggestedWording"] == change_json["original_text"]
@@ -0,0 +1,132 @@
+# triage.py
+"""
+Local triage of tracked changes before the LLM is called.
+
+Redlines often contain edits that cannot change the meaning of a clause:
+formatting-only revisions, whitespace, punctuation, capitalization or
+re-numbering. When every change of a paragraph is such an edit, a templated
+analysis is returned instead of a full few-shot LLM analysis, and the rule that
+fired is recorded.
+"""
+import os
+import re
+import string
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+TRIAGE_ENABLED = os.getenv("TRIAGE_ENABLED", "1") == "1"
+
+# Symbols that carry meaning (amounts, percentages, comparisons) are not punctuation here
+_PUNCTUATION = (set(string.punctuation) - set("%$<>=+")) | set("“”„‘’«»–—…")
+_NUMBERING = re.compile(r"^\s*(?:\(?(?:\d+|[a-z]|i{1,3}|iv|vi{0,3}|ix|xi{0,3})[.)]\s*)+$", re.IGNORECASE)
+
+RULE_DESCRIPTIONS = {
+    "formatting": "formatting-only",
+    "whitespace": "whitespace",
+    "punctuation": "punctuation",
+    "capitalization": "capitalization",
+    "numbering": "numbering",
+}
+
+rule_counts: Counter = Counter()
+
+
+def _at_paragraph_start(text: str, change_json: Dict[str, Any]) -> bool:
+    """
+    Whether `text` is the leading number of the paragraph rather than, say, a cross-reference.
+    """
+    text = text.strip()
+    return any(
+        str(change_json.get(field) or "").lstrip().startswith(text) for field in ("original_text", "modified_text")
+    )
+
+
+def _single_change_rule(change: Dict[str, Any], change_json: Dict[str, Any]) -> Optional[str]:
+    change_type = str(change.get("type") or "").lower()
+    text = str(change.get("description") or "")
+    if change_type in ("formatted", "format", "formatting"):
+        return "formatting"
+    if not text.strip():
+        return "whitespace"
+    if all(ch in _PUNCTUATION or ch.isspace() for ch in text):
+        return "punctuation"
+    if _NUMBERING.match(text) and _at_paragraph_start(text, change_json):
+        return "numbering"
+    return None
+
+
+def _capitalization_pairs(changes: List[Dict[str, Any]]) -> List[int]:
+    """
+    Returns the positions of deleted/added pairs that only differ in letter case.
+    """
+    paired: List[int] = []
+    for i, first in enumerate(changes):
+        if i in paired:
+            continue
+        for j in range(i + 1, len(changes)):
+            if j in paired:
+                continue
+            second = changes[j]
+            types = {str(first.get("type") or "").lower(), str(second.get("type") or "").lower()}
+            first_text = str(first.get("description") or "").strip()
+            second_text = str(second.get("description") or "").strip()
+            if (types == {"added", "deleted"} and first_text != second_text
+                    and first_text.lower() == second_text.lower()):
+                paired.extend([i, j])
+                break
+    return paired
+
+
+def triage_rules(change_json: Dict[str, Any]) -> Optional[List[str]]:
+    """
+    Returns the rules that explain every tracked change of the paragraph, or None if at least
+    one change may be substantive (or there are no changes at all).
+    """
+    changes = change_json.get("changes", [])
+    if not changes:
+        return None
+    paired = _capitalization_pairs(changes)
+    rules = ["capitalization"] if paired else []
+    for i, change in enumerate(changes):
+        if i in paired:
+            continue
+        rule = _single_change_rule(change, change_json)
+        if rule is None:
+            return None
+        if rule not in rules:
+            rules.append(rule)
+    return rules
+
+
+def triage_analysis(change_json: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Returns a templated ClauseAnalysisResponse dict for trivially changed paragraphs, else None.
+    """
+    if not TRIAGE_ENABLED:
+        return None
+    rules = triage_rules(change_json)
+    if rules is None:
+        return None
+    for rule in rules:
+        rule_counts[rule] += 1
+    kinds = ", ".join(RULE_DESCRIPTIONS[rule] for rule in rules)
+    original_text = str(change_json.get("original_text") or "")
+    return {
+        "clauseIdentifier": "Editorial change",
+        "originalClauseText": original_text,
+        "analysis": {
+            "clauseCategory": "Editorial / Formatting",
+            "summary": f"The tracked changes are {kinds} edits only; the substance of the clause is unchanged.",
+            "risksDisclosingParty": "No new risks arise from these changes.",
+            "risksReceivingParty": "No new risks arise from these changes.",
+            "improvementsDisclosingParty": "No action required.",
+            "improvementsReceivingParty": "No action required.",
+            "suggestedWording": original_text,
+            "comments_on_changes": f"Classified locally as {kinds} changes; no LLM analysis was performed.",
+        },
+        "triageRule": "+".join(rules),
+    }
+
+
+def triage_stats() -> Dict[str, int]:
+    return dict(rule_counts)
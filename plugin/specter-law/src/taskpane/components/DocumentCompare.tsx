@@ -4,7 +4,7 @@ import { useState } from "react";
 import { Button, Field, tokens, makeStyles } from "@fluentui/react-components";
 import { compareDocuments } from "../office/compare";
 import { extractParagraphs, extractDocumentObject } from "../business/extractParagraphs";
-import { sendParagraphsToApi, sendTrackedChangesToApi } from "../office/sendToApi";
+import { getDocumentId, sendParagraphsToApi, streamTrackedChangesToApi } from "../office/sendToApi";
 import { extractTrackedChanges } from "../office/extractTrackedChanges";
 
 const useStyles = makeStyles({
@@ -192,18 +192,21 @@ const DocumentCompare: React.FC<DocumentCompareProps> = ({ onCompareResults, onS
         changelog
       }));
       setApiPayloads(payloads);
-      // Send to API with debug logging
+      // Stream results from the API: each paragraph is shown as soon as it has been analyzed
       const debug: string[] = [];
-      const response = await sendTrackedChangesToApi(changes, paragraphs, (msg: string) => {
-        debug.push(msg);
-        setDebugLogs(logs => [...logs, msg]);
-      });
-      // The batch API now returns { results: { [paragraphIndex]: result, ... } }
-      if (response && typeof response === 'object' && response.results && typeof response.results === 'object') {
-        setApiResponse(response.results);
-      } else {
-        setApiResponse({});
-      }
+      setApiResponse({});
+      await streamTrackedChangesToApi(
+        changes,
+        paragraphs,
+        (paragraphIndex: number, result: any) => {
+          setApiResponse(current => ({ ...(current || {}), [paragraphIndex]: result }));
+        },
+        (msg: string) => {
+          debug.push(msg);
+          setDebugLogs(logs => [...logs, msg]);
+        },
+        await getDocumentId()
+      );
       setDebugLogs(debug);
     } catch (e) {
       setError("Failed to send tracked changes to API. See console for details.");
@@ -22,11 +22,12 @@ function sanitizeText(text: string): string {
   return text.replace(/[\u0000-\u001F\u007F]/g, " ");
 }
 
-export async function sendTrackedChangesToApi(
+type BatchItem = { paragraphIndex: number; paragraph: string; changelog: { type: string; text: string; author: string }[] };
+
+function buildBatchPayload(
   trackedChanges: Array<{ key: string; type: string; author: string; date: string; text: string; paragraphIndex: number }>,
-  paragraphs: string[],
-  debugLog?: (msg: string) => void
-): Promise<{ results: { [paragraphIndex: number]: any } }> {
+  paragraphs: string[]
+): BatchItem[] {
   // Group tracked changes by paragraphIndex
   const grouped: { [pIdx: number]: { type: string; text: string; author: string }[] } = {};
   trackedChanges.forEach(tc => {
@@ -39,7 +40,7 @@ export async function sendTrackedChangesToApi(
   });
 
   // Build batch payload: one entry per paragraph with tracked changes
-  const batchPayload: Array<{ paragraphIndex: number; paragraph: string; changelog: { type: string; text: string; author: string }[] }> = [];
+  const batchPayload: BatchItem[] = [];
   for (const [pIdx, changelog] of Object.entries(grouped)) {
     const idx = Number(pIdx);
     if (!changelog.length) continue;
@@ -56,6 +57,15 @@ export async function sendTrackedChangesToApi(
       changelog: sanitizedChangelog
     });
   }
+  return batchPayload;
+}
+
+export async function sendTrackedChangesToApi(
+  trackedChanges: Array<{ key: string; type: string; author: string; date: string; text: string; paragraphIndex: number }>,
+  paragraphs: string[],
+  debugLog?: (msg: string) => void
+): Promise<{ results: { [paragraphIndex: number]: any } }> {
+  const batchPayload = buildBatchPayload(trackedChanges, paragraphs);
   if (debugLog) debugLog("Sending batch payload to API: " + JSON.stringify(batchPayload));
   try {
     const apiUrl = "https://specter-law.onrender.com/analyze_changes_batch";
@@ -83,6 +93,81 @@ export async function sendTrackedChangesToApi(
   }
 }
 
+const DOCUMENT_ID_SETTING = "specterDocumentId";
+
+// An opaque id for the open document, for the backend's incremental re-analysis. It is a random id
+// kept in the document's own settings, so neither the file name nor its location leave the client.
+// Resolves with undefined where the host has no document settings.
+export async function getDocumentId(): Promise<string | undefined> {
+  const settings = Office.context.document.settings;
+  if (!settings) return undefined;
+  const stored = settings.get(DOCUMENT_ID_SETTING);
+  if (typeof stored === "string" && stored) return stored;
+  const bytes = crypto.getRandomValues(new Uint8Array(16));
+  const documentId = Array.from(bytes, b => b.toString(16).padStart(2, "0")).join("");
+  settings.set(DOCUMENT_ID_SETTING, documentId);
+  // The id is only kept once the settings are saved; until then every run starts a new document
+  await new Promise<void>(resolve => settings.saveAsync(() => resolve()));
+  return documentId;
+}
+
+// Stream the batch analysis: onResult is called for every paragraph as soon as the backend
+// has analyzed it (the record has either the analysis or an "error" field, plus paragraphIndex).
+// Resolves with the final summary record. With a documentId, paragraphs that are unchanged since
+// the last submission of the same document are answered from the backend's store.
+export async function streamTrackedChangesToApi(
+  trackedChanges: Array<{ key: string; type: string; author: string; date: string; text: string; paragraphIndex: number }>,
+  paragraphs: string[],
+  onResult: (paragraphIndex: number, result: any) => void,
+  debugLog?: (msg: string) => void,
+  documentId?: string
+): Promise<any> {
+  const batchPayload = buildBatchPayload(trackedChanges, paragraphs);
+  if (debugLog) debugLog("Streaming batch payload to API: " + JSON.stringify(batchPayload));
+  const apiUrl = "https://specter-law.onrender.com/analyze_changes_batch/stream";
+  //const apiUrl = "http://127.0.0.1:8000/analyze_changes_batch/stream";
+  const response = await fetch(apiUrl, {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+      "Accept": "application/x-ndjson"
+    },
+    body: JSON.stringify({ items: batchPayload, documentId }),
+  });
+  if (debugLog) debugLog("API response status: " + response.status);
+  if (!response.ok || !response.body) {
+    const responseText = await response.text();
+    throw new Error(`Failed to stream tracked changes batch: "${responseText}"`);
+  }
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let summary: any = null;
+  const handleLine = (line: string) => {
+    if (!line.trim()) return;
+    const record = JSON.parse(line);
+    if (record.summary) {
+      summary = record.summary;
+      if (debugLog) debugLog("API stream summary: " + JSON.stringify(summary));
+    } else {
+      onResult(record.paragraphIndex, record);
+    }
+  };
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let newline = buffer.indexOf("\n");
+    while (newline >= 0) {
+      handleLine(buffer.slice(0, newline));
+      buffer = buffer.slice(newline + 1);
+      newline = buffer.indexOf("\n");
+    }
+  }
+  handleLine(buffer + decoder.decode());
+  return summary;
+}
+
 // Send a single paragraph and its tracked changes to the non-batch endpoint
 export async function sendSingleTrackedChangesToApi(
   paragraph: string,